@@ -0,0 +1,322 @@
+# shared by the ansible modules in ../ansible_modules, which import it with
+#     from ansible.module_utils.irods_plugin_testing_utils import *
+# ansible inlines it into each module, so it shares the module's globals (trace_spans, get_irods_version, ...)
+
+import copy
+import hashlib
+import json
+import multiprocessing.pool
+import os
+import socket
+import stat
+import tempfile
+import threading
+import time
+
+setup_state_file = '/var/lib/irods_plugin_testing/setup_state.json'
+setup_state_version = 1
+setup_state_lock = threading.Lock()
+
+def read_setup_state():
+    if not os.path.isfile(setup_state_file):
+        return {}
+    with open(setup_state_file) as f:
+        return json.load(f)
+
+def record_setup_step(key, fingerprint, result):
+    with setup_state_lock:
+        state = read_setup_state()
+        state[key] = {'fingerprint': fingerprint, 'result': result, 'completed_at': time.time()}
+        if not os.path.isdir(os.path.dirname(setup_state_file)):
+            os.makedirs(os.path.dirname(setup_state_file))
+        with open(setup_state_file + '.tmp', 'w') as f:
+            json.dump(state, f, indent=4, sort_keys=True)
+        os.rename(setup_state_file + '.tmp', setup_state_file)
+
+class StepFailure(Exception):
+    def __init__(self, fail_json_arguments):
+        super(StepFailure, self).__init__(fail_json_arguments.get('msg'))
+        self.fail_json_arguments = fail_json_arguments
+
+def run_step_graph(module, steps, state_name=None, max_workers=4):
+    # steps are (name, dependencies, function[, inputs]) tuples; a step starts as soon as all of its dependencies
+    # have succeeded, and nothing new is started once a step has failed.  with a state_name, a step with inputs
+    # is recorded on the host when it succeeds and skipped on later runs while its inputs are unchanged and
+    # none of its dependencies had to run again.  steps without inputs are idempotent and run every time; they
+    # only make their dependents run again when one of their own dependencies did
+    functions = dict((step[0], step[2]) for step in steps)
+    dependencies = dict((step[0], set(step[1])) for step in steps)
+    fingerprints = {}
+    for step in steps:
+        if state_name is not None and len(step) > 3 and step[3] is not None:
+            fingerprints[step[0]] = hashlib.sha256(json.dumps({'version': setup_state_version, 'step': '{0}.{1}'.format(state_name, step[0]), 'inputs': step[3]}, sort_keys=True)).hexdigest()
+    for name, step_dependencies in dependencies.items():
+        unknown = step_dependencies - set(functions)
+        if unknown:
+            module.fail_json(msg='step {0} depends on unknown steps {1}'.format(name, sorted(unknown)))
+    recorded_steps = read_setup_state() if fingerprints else {}
+    results = {}
+    executed = set()
+    failures = []
+    started = set()
+    running = set()
+    condition = threading.Condition()
+
+    def run_step(name):
+        start = time.time()
+        key = '{0}.{1}'.format(state_name, name)
+        with condition:
+            skipped = name in fingerprints and not (dependencies[name] & executed) and recorded_steps.get(key, {}).get('fingerprint') == fingerprints[name]
+        try:
+            if skipped:
+                result = recorded_steps[key]['result']
+            else:
+                result = functions[name](results)
+                if name in fingerprints:
+                    record_setup_step(key, fingerprints[name], result)
+        except BaseException as e:
+            with condition:
+                failures.append((name, e))
+        else:
+            with condition:
+                results[name] = result
+                if (name in fingerprints and not skipped) or (name not in fingerprints and dependencies[name] & executed):
+                    executed.add(name)
+        finally:
+            trace_spans.append({'name': name, 'start': start, 'end': time.time(), 'args': {'dependencies': sorted(dependencies[name]), 'skipped': skipped}})
+            with condition:
+                running.discard(name)
+                condition.notify()
+
+    # fail_json prints the module result and exits, so inside the steps it only raises; the first failure is
+    # reported from this thread once the steps that were already running have finished
+    def raise_step_failure(**kwargs):
+        raise StepFailure(kwargs)
+    fail_json = module.fail_json
+    module.fail_json = raise_step_failure
+    thread_pool = multiprocessing.pool.ThreadPool(max_workers)
+    try:
+        with condition:
+            while True:
+                if not failures:
+                    for step in steps:
+                        name = step[0]
+                        if name not in started and dependencies[name] <= set(results):
+                            started.add(name)
+                            running.add(name)
+                            thread_pool.apply_async(run_step, (name,))
+                if not running:
+                    break
+                condition.wait()
+    finally:
+        thread_pool.close()
+        thread_pool.join()
+        module.fail_json = fail_json
+    if failures:
+        name, e = failures[0]
+        if isinstance(e, StepFailure):
+            fail_json_arguments = dict(e.fail_json_arguments)
+            fail_json_arguments['msg'] = 'setup step {0} failed: {1}'.format(name, fail_json_arguments.get('msg'))
+            fail_json_arguments.setdefault('trace_spans', trace_spans)
+            module.fail_json(**fail_json_arguments)
+        module.fail_json(msg='setup step {0} failed: {1}'.format(name, e), trace_spans=trace_spans)
+    if len(results) != len(steps):
+        module.fail_json(msg='steps {0} could not run because of a dependency cycle'.format(sorted(set(functions) - set(results))))
+    return results
+
+def resolve_package(module, package_directory, package_prefix):
+    manifest_file = os.path.join(package_directory, 'manifest.json')
+    if not os.path.isfile(manifest_file):
+        package_basename = filter(lambda x:package_prefix in x, os.listdir(package_directory))[0]
+        return os.path.join(package_directory, package_basename)
+    with open(manifest_file) as f:
+        manifest = json.load(f)
+    candidates = [p for p in manifest['packages'] if os.path.basename(p['path']).startswith(package_prefix)] or \
+                 [p for p in manifest['packages'] if package_prefix in os.path.basename(p['path'])]
+    if len(candidates) != 1:
+        module.fail_json(msg='expected exactly one package matching [{0}] in {1}, found {2}'.format(package_prefix, manifest_file, [p['path'] for p in candidates]))
+    package = candidates[0]
+    package_path = os.path.join(package_directory, package['path'])
+    if os.path.getsize(package_path) != package['size'] or sha256_of_file(package_path) != package['sha256']:
+        module.fail_json(msg='package {0} does not match its manifest entry in {1}'.format(package_path, manifest_file))
+    return package_path
+
+def sha256_of_file(filename):
+    h = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+package_requirements = []
+package_transactions = []
+
+def require_os_packages(packages, stage=0):
+    # requirements are collected for the whole module run and installed together by install_required_packages;
+    # a later stage may need package repositories set up by an earlier one
+    package_requirements.append((stage, False, list(packages)))
+
+def require_os_packages_from_files(package_files, stage=0):
+    package_requirements.append((stage, True, list(package_files)))
+
+def get_installed_os_packages(module, packages):
+    if not packages:
+        return set()
+    if os.path.isfile('/usr/bin/dpkg-query'):
+        _, out, _ = module.run_command(['dpkg-query', '-W', '-f', '${Package} ${Status}\n'] + packages)
+        return set(l.split()[0] for l in out.splitlines() if l.endswith(' installed'))
+    _, out, _ = module.run_command(['rpm', '-q', '--qf', '%{NAME}\n'] + packages)
+    return set(l.strip() for l in out.splitlines()) & set(packages)
+
+def plan_package_transactions(module):
+    installed_packages = get_installed_os_packages(module, sorted(set(p for _, from_files, packages in package_requirements if not from_files for p in packages)))
+    # yum installs local package files alongside repository packages, so there each stage is one transaction
+    combine_package_files = os.path.isfile('/usr/bin/yum')
+    transactions = []
+    for stage in sorted(set(r[0] for r in package_requirements)):
+        packages = []
+        package_files = []
+        for requirement_stage, from_files, requirement_packages in package_requirements:
+            if requirement_stage != stage:
+                continue
+            for p in requirement_packages:
+                if from_files and p not in package_files:
+                    package_files.append(p)
+                elif not from_files and p not in packages and p not in installed_packages:
+                    packages.append(p)
+        if combine_package_files and packages and package_files:
+            packages, package_files = packages + package_files, []
+        if packages:
+            transactions.append((False, packages))
+        if package_files:
+            transactions.append((True, package_files))
+    return transactions
+
+def install_required_packages(module):
+    transactions = plan_package_transactions(module)
+    del package_requirements[:]
+    for from_files, packages in transactions:
+        start = time.time()
+        if from_files:
+            install_os_packages_from_files(packages)
+        else:
+            install_os_packages(packages)
+        package_transactions.append({'packages': packages, 'from_files': from_files, 'start': start, 'end': time.time()})
+    return transactions
+
+server_config_file = '/etc/irods/server_config.json'
+server_config_patches = []
+irods_restart_reasons = []
+irods_restarts = []
+
+def patch_server_config(patch):
+    # patches are collected from any number of setup steps and written together by restart_irods_if_needed
+    server_config_patches.append(patch)
+
+def request_irods_restart(reason):
+    irods_restart_reasons.append(reason)
+
+def merge_server_config_patch(config, patch):
+    for key, value in patch.items():
+        if isinstance(value, dict) and isinstance(config.get(key), dict):
+            merge_server_config_patch(config[key], value)
+        else:
+            config[key] = value
+
+def apply_server_config_patches():
+    if not server_config_patches:
+        return False
+    with open(server_config_file) as f:
+        original_config = json.load(f)
+    config = copy.deepcopy(original_config)
+    for patch in server_config_patches:
+        merge_server_config_patch(config, patch)
+    del server_config_patches[:]
+    if config == original_config:
+        return False
+    original_stat = os.stat(server_config_file)
+    fd, temporary_file = tempfile.mkstemp(prefix='.server_config.json.', dir=os.path.dirname(server_config_file))
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(config, f, indent=4, sort_keys=True)
+        os.chmod(temporary_file, stat.S_IMODE(original_stat.st_mode))
+        os.chown(temporary_file, original_stat.st_uid, original_stat.st_gid)
+        os.rename(temporary_file, server_config_file)
+    except Exception:
+        if os.path.exists(temporary_file):
+            os.unlink(temporary_file)
+        raise
+    return True
+
+def restart_irods_if_needed(restart_irods):
+    if apply_server_config_patches():
+        request_irods_restart('server_config.json changed')
+    if not irods_restart_reasons:
+        return False
+    restart_irods()
+    irods_restarts.append(list(irods_restart_reasons))
+    del irods_restart_reasons[:]
+    return True
+
+readiness_waits = []
+
+def wait_for_readiness(module, name, probe, timeout=300, initial_delay=1, max_delay=30, backoff=2):
+    start = time.time()
+    delay = initial_delay
+    attempts = 0
+    while True:
+        attempts += 1
+        if probe():
+            readiness_waits.append({'name': name, 'seconds': time.time() - start, 'attempts': attempts})
+            return
+        elapsed = time.time() - start
+        if elapsed >= timeout:
+            readiness_waits.append({'name': name, 'seconds': elapsed, 'attempts': attempts, 'timed_out': True})
+            module.fail_json(msg='{0} not ready after {1} seconds ({2} attempts)'.format(name, int(elapsed), attempts), readiness_waits=readiness_waits)
+        time.sleep(min(delay, timeout - elapsed))
+        delay = min(delay * backoff, max_delay)
+
+def irods_server_answers(port=1247):
+    try:
+        s = socket.create_connection(('localhost', port), 5)
+    except socket.error:
+        return False
+    s.close()
+    return True
+
+python_test_shard_module = 'python_test_shard'
+
+def write_python_test_shard(module, tests_directory, test_names):
+    shard_file = os.path.join(tests_directory, python_test_shard_module + '.py')
+    contents = 'import unittest\n\ntest_names = {0!r}\n\ndef load_tests(loader, tests, pattern):\n    return loader.loadTestsFromNames(test_names)\n'.format(test_names)
+    module.run_command(['sudo', 'tee', shard_file], data=contents, check_rc=True)
+    return shard_file
+
+def run_python_tests(module, python_tests_to_run, pydevtest_output_file=None):
+    # run_tests.py takes a single --run_specific_test, so a shard of several tests runs through a generated
+    # module that loads all of them
+    test_names = python_tests_to_run.split()
+    if not test_names:
+        return
+    if get_irods_version() >= (4, 2):
+        tests_directory, test_name_prefix = '/var/lib/irods/scripts/irods/test', 'irods.test.'
+        command = 'cd scripts; python run_tests.py --xml_output --run_specific_test {0}'
+    else:
+        tests_directory, test_name_prefix = '/var/lib/irods/tests/pydevtest', ''
+        command = 'cd tests/pydevtest; python run_tests.py --xml_output --run_specific_test {0}'
+        if pydevtest_output_file is not None:
+            command += ' > ' + pydevtest_output_file
+    shard_file = None
+    if len(test_names) == 1:
+        test_to_run = test_names[0]
+    else:
+        shard_file = write_python_test_shard(module, tests_directory, [test_name_prefix + test_name for test_name in test_names])
+        test_to_run = python_test_shard_module
+    cmd = ['sudo', 'su', '-', 'irods', '-c', command.format(test_to_run)]
+    try:
+        rc, out, err = module.run_command(cmd)
+    finally:
+        if shard_file is not None:
+            module.run_command(['sudo', 'rm', '-f', shard_file, shard_file + 'c'])
+    if rc != 0:
+        module.fail_json(msg='python tests failed: {0}'.format(', '.join(test_names)), cmd=cmd, rc=rc, stdout=out, stderr=err, trace_spans=trace_spans)
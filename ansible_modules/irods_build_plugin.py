@@ -1,9 +1,17 @@
 #!/usr/bin/python
 
 import abc
+import contextlib
+import fnmatch
+import gzip
+import hashlib
 import json
+import multiprocessing
+import multiprocessing.pool
 import os
+import re
 import shutil
+import time
 
 class UnimplementedStrategy(object):
     def __init__(self, module):
@@ -13,6 +21,9 @@ class UnimplementedStrategy(object):
     def build(self):
         self.unimplemented_error()
 
+    def prepare(self):
+        self.unimplemented_error()
+
     def unimplemented_error(self):
         platform = get_platform()
         distribution = get_distribution()
@@ -35,6 +46,15 @@ class Builder(object):
     def build(self):
         return self.strategy.build()
 
+    def prepare(self):
+        return self.strategy.prepare()
+
+# intermediate build products stay on the build host
+default_build_output_collection_rules = {
+    'exclude': ['*.o', '*.a', '*.so', '*.d', '*.gch', '*CMakeFiles/', '*CMakeFiles/*'],
+    'compress': False,
+}
+
 class GenericStrategy(object):
     __metaclass__ = abc.ABCMeta
     def __init__(self, module):
@@ -43,52 +63,184 @@ class GenericStrategy(object):
         self.irods_packages_root_directory = module.params['irods_packages_root_directory']
         self.git_repository = module.params['git_repository']
         self.git_commitish = module.params['git_commitish']
+        self.git_checkout_plan = module.params['git_checkout_plan']
         self.local_plugin_dir = os.path.expanduser('~/irods_build_local_plugin_dir')
+        self.dependency_layer_fingerprint_file = os.path.expanduser('~/.irods_build_plugin_dependency_layer.json')
+        self.dependency_layer_fingerprint = None
+        self.dependency_layer_reused = False
+        self.compiler_cache_root_directory = module.params['compiler_cache_root_directory']
+        self.build_jobs = module.params['build_jobs']
+        self.compiler_cache_statistics = None
+        self.build_parallelism = None
+        self.build_output_collection_rules = module.params['build_output_collection_rules'] or default_build_output_collection_rules
+        self.build_output_collection = None
 
     @abc.abstractproperty
     def building_dependencies(self):
         pass
 
+    @property
+    def plugin_specific_building_dependency_files(self):
+        return []
+
     @property
     def irods_packages_directory(self):
         return os.path.join(self.irods_packages_root_directory, get_irods_platform_string())
 
+    @property
+    def compiler_cache_directory(self):
+        if not self.compiler_cache_root_directory:
+            return None
+        return os.path.join(self.compiler_cache_root_directory, get_irods_platform_string())
+
+    @property
+    def ccache_bin_directory(self):
+        for d in ['/usr/lib64/ccache', '/usr/lib/ccache']:
+            if os.path.isdir(d):
+                return d
+        return None
+
     @property
     def output_directory(self):
         return os.path.join(self.output_root_directory, get_irods_platform_string())
 
-    def install_dev_and_runtime_packages(self):
-        dev_package_basename = filter(lambda x:'irods-dev-' in x, os.listdir(self.irods_packages_directory))[0]
-        dev_package = os.path.join(self.irods_packages_directory, dev_package_basename)
-        install_os_packages_from_files([dev_package])
-        runtime_package_basename = filter(lambda x:'irods-runtime-' in x, os.listdir(self.irods_packages_directory))[0]
-        runtime_package = os.path.join(self.irods_packages_directory, runtime_package_basename)
-        install_os_packages_from_files([runtime_package])
+    @property
+    def dev_package(self):
+        return resolve_package(self.module, self.irods_packages_directory, 'irods-dev-')
+
+    @property
+    def runtime_package(self):
+        return resolve_package(self.module, self.irods_packages_directory, 'irods-runtime-')
+
+    def prepare(self):
+        # warm pool VMs get their dependency layer before they are leased
+        with trace_span('install_building_dependencies'):
+            self.install_building_dependencies()
 
     def build(self):
-        self.install_building_dependencies()
-        self.prepare_git_repository()
-        self.build_plugin_package()
-        self.copy_build_output()
+        with trace_span('install_building_dependencies'):
+            self.install_building_dependencies()
+        with trace_span('prepare_git_repository'):
+            self.prepare_git_repository()
+        with trace_span('build_plugin_package'):
+            self.build_plugin_package()
+        with trace_span('copy_build_output'):
+            self.copy_build_output()
 
     def install_building_dependencies(self):
-        install_os_packages(self.building_dependencies)
-        self.install_dev_and_runtime_packages()
-        self.install_plugin_specific_building_dependencies()
+        self.dependency_layer_fingerprint = self.compute_dependency_layer_fingerprint()
+        self.dependency_layer_reused = self.read_installed_dependency_layer_fingerprint() == self.dependency_layer_fingerprint
+        if not self.dependency_layer_reused:
+            require_os_packages(self.building_dependencies)
+            require_os_packages_from_files([self.dev_package, self.runtime_package] + self.plugin_specific_building_dependency_files)
+        if self.compiler_cache_directory:
+            require_os_packages(['ccache'])
+        install_required_packages(self.module)
+        if not self.dependency_layer_reused:
+            self.install_plugin_specific_building_dependencies()
+            self.write_installed_dependency_layer_fingerprint(self.dependency_layer_fingerprint)
+
+    def compute_dependency_layer_fingerprint(self):
+        fingerprint_material = {
+            'strategy': self.__class__.__name__,
+            'irods_platform_string': get_irods_platform_string(),
+            'building_dependencies': sorted(self.building_dependencies),
+            'irods_packages': dict((os.path.basename(p), sha256_of_file(p)) for p in [self.dev_package, self.runtime_package]),
+            'plugin_specific_building_dependency_files': dict((p, sha256_of_file(p)) for p in self.plugin_specific_building_dependency_files),
+        }
+        return hashlib.sha256(json.dumps(fingerprint_material, sort_keys=True)).hexdigest()
+
+    def read_installed_dependency_layer_fingerprint(self):
+        try:
+            with open(self.dependency_layer_fingerprint_file) as f:
+                return json.load(f)['fingerprint']
+        except (IOError, ValueError, KeyError):
+            return None
+
+    def write_installed_dependency_layer_fingerprint(self, fingerprint):
+        with open(self.dependency_layer_fingerprint_file, 'w') as f:
+            json.dump({'fingerprint': fingerprint}, f)
 
     def install_plugin_specific_building_dependencies(self):
         pass
 
     def prepare_git_repository(self):
+        # a reused host still has the previous build's tree, partly owned by root from the sudo build
+        if os.path.lexists(self.local_plugin_dir):
+            self.module.run_command(['sudo', 'rm', '-rf', self.local_plugin_dir], check_rc=True)
+        if self.git_checkout_plan:
+            self.checkout_from_mirror(self.git_checkout_plan, self.local_plugin_dir)
+            return
         self.module.run_command('git clone --recursive {0} {1}'.format(self.git_repository, self.local_plugin_dir), check_rc=True)
         self.module.run_command('git checkout {0}'.format(self.git_commitish), cwd=self.local_plugin_dir, check_rc=True)
 
+    def checkout_from_mirror(self, checkout_plan, directory):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.module.run_command(['git', 'init', '-q'], cwd=directory, check_rc=True)
+        rc, _, _ = self.module.run_command(['git', 'fetch', '-q', '--depth', '1', checkout_plan['mirror_url'], checkout_plan['commit']], cwd=directory)
+        if rc != 0:
+            # git too old to fetch a single commit by sha
+            self.module.run_command(['git', 'fetch', '-q', checkout_plan['mirror_url'], '+refs/*:refs/remotes/mirror/*'], cwd=directory, check_rc=True)
+        self.module.run_command(['git', 'checkout', '-q', checkout_plan['commit']], cwd=directory, check_rc=True)
+        for submodule_plan in checkout_plan['submodules']:
+            self.checkout_from_mirror(submodule_plan, os.path.join(directory, submodule_plan['path']))
+
     def build_plugin_package(self):
-        os.makedirs(os.path.join(self.local_plugin_dir, 'build'))
-        self.module.run_command(['sudo', 'su', '-c', './packaging/build.sh -r 2>&1 | tee ./build/build_plugin_output.log; exit $PIPESTATUS'], cwd=self.local_plugin_dir, check_rc=True)
+        if not os.path.isdir(os.path.join(self.local_plugin_dir, 'build')):
+            os.makedirs(os.path.join(self.local_plugin_dir, 'build'))
+        self.build_parallelism = self.build_jobs if self.build_jobs else get_automatic_build_parallelism()
+        environment = ['export MAKEFLAGS=-j{0}'.format(self.build_parallelism)]
+        if self.compiler_cache_directory:
+            self.module.run_command(['sudo', 'mkdir', '-p', self.compiler_cache_directory], check_rc=True)
+            environment.append('export CCACHE_DIR={0}'.format(self.compiler_cache_directory))
+            if self.ccache_bin_directory:
+                environment.append('export PATH={0}:$PATH'.format(self.ccache_bin_directory))
+            statistics_before = self.read_compiler_cache_statistics()
+        build_command = './packaging/build.sh -r 2>&1 | tee ./build/build_plugin_output.log; exit $PIPESTATUS'
+        self.module.run_command(['sudo', 'su', '-c', '; '.join(environment + [build_command])], cwd=self.local_plugin_dir, check_rc=True)
+        if self.compiler_cache_directory:
+            statistics_after = self.read_compiler_cache_statistics()
+            self.compiler_cache_statistics = summarize_compiler_cache_statistics(statistics_before, statistics_after)
+
+    def read_compiler_cache_statistics(self):
+        _, out, _ = self.module.run_command(['sudo', 'env', 'CCACHE_DIR={0}'.format(self.compiler_cache_directory), 'ccache', '-s'], check_rc=True)
+        return parse_ccache_statistics(out)
 
     def copy_build_output(self):
-        shutil.copytree(os.path.join(self.local_plugin_dir, 'build'), self.output_directory)
+        self.build_output_collection = collect_artifacts(os.path.join(self.local_plugin_dir, 'build'), self.output_directory, self.build_output_collection_rules)
+        self.write_package_manifest()
+
+    def write_package_manifest(self):
+        packages = []
+        for basename in sorted(os.listdir(self.output_directory)):
+            if os.path.splitext(basename)[1] not in ['.deb', '.rpm']:
+                continue
+            package_path = os.path.join(self.output_directory, basename)
+            packages.append({
+                'path': basename,
+                'size': os.path.getsize(package_path),
+                'sha256': sha256_of_file(package_path),
+                'version': self.get_package_version(package_path),
+                'platform': get_irods_platform_string(),
+            })
+        manifest = {
+            'git_repository': self.git_repository,
+            'git_commitish': self.git_commitish,
+            'platform': get_irods_platform_string(),
+            'packages': packages,
+        }
+        with open(os.path.join(self.output_directory, 'manifest.json'), 'w') as f:
+            json.dump(manifest, f, indent=4, sort_keys=True)
+
+    def get_package_version(self, package_path):
+        if package_path.endswith('.deb'):
+            rc, out, _ = self.module.run_command(['dpkg-deb', '-f', package_path, 'Version'])
+        else:
+            rc, out, _ = self.module.run_command(['rpm', '-qp', '--qf', '%{VERSION}-%{RELEASE}', package_path])
+        if rc != 0:
+            return None
+        return out.strip()
 
 class RedHatStrategy(GenericStrategy):
     @property
@@ -96,18 +248,24 @@ class RedHatStrategy(GenericStrategy):
         gsi_dependencies = ['globus-proxy-utils', 'globus-gssapi-gsi-devel']
         return ['python-devel', 'help2man', 'unixODBC', 'fuse-devel', 'curl-devel', 'bzip2-devel', 'zlib-devel', 'pam-devel', 'openssl-devel', 'libxml2-devel', 'krb5-devel', 'unixODBC-devel', 'perl-JSON'] + gsi_dependencies
 
+    @property
+    def plugin_specific_building_dependency_files(self):
+        return self.hpss_packages
+
+    @property
+    def hpss_packages(self):
+        return ['/projects/irods/vsphere-testing/externals/hpss/hpss-lib-7.4.3.2-0.el6.x86_64.rpm',
+                '/projects/irods/vsphere-testing/externals/hpss/hpss-lib-devel-7.4.3.2-0.el6.x86_64.rpm',
+                '/projects/irods/vsphere-testing/externals/hpss/hpss-clnt-7.4.3.2-0.el6.x86_64.rpm']
+
     def install_plugin_specific_building_dependencies(self):
         # hpss
-        hpss_packages = ['/projects/irods/vsphere-testing/externals/hpss/hpss-lib-7.4.3.2-0.el6.x86_64.rpm',
-                         '/projects/irods/vsphere-testing/externals/hpss/hpss-lib-devel-7.4.3.2-0.el6.x86_64.rpm',
-                         '/projects/irods/vsphere-testing/externals/hpss/hpss-clnt-7.4.3.2-0.el6.x86_64.rpm']
-        install_os_packages_from_files(hpss_packages)
-        self.module.run_command(['sudo', 'ln', '-s', '/hpss_src/hpss-7.4.3.2-0.el6', '/opt/hpss'], check_rc=True)
+        self.module.run_command(['sudo', 'ln', '-sfn', '/hpss_src/hpss-7.4.3.2-0.el6', '/opt/hpss'], check_rc=True)
 
         # gsi
-        install_command = ['sudo', 'ln', '-s', '/usr/lib64/libglobus_callout.so.0', '/usr/lib64/libglobus_callout.so']
+        install_command = ['sudo', 'ln', '-sfn', '/usr/lib64/libglobus_callout.so.0', '/usr/lib64/libglobus_callout.so']
         self.module.run_command(install_command, check_rc=True)
-        install_command = ['sudo', 'ln', '-s', '/usr/lib64/libglobus_gss_assist.so.3', '/usr/lib64/libglobus_gss_assist.so']
+        install_command = ['sudo', 'ln', '-sfn', '/usr/lib64/libglobus_gss_assist.so.3', '/usr/lib64/libglobus_gss_assist.so']
         self.module.run_command(install_command, check_rc=True)
 
 class DebianStrategy(GenericStrategy):
@@ -119,14 +277,14 @@ class DebianStrategy(GenericStrategy):
     def install_plugin_specific_building_dependencies(self):
         # gsi
         # Ubuntu_12
-        install_command = ['sudo', 'ln', '-s', '/usr/lib/libglobus_callout.so.0', '/usr/lib/libglobus_callout.so']
+        install_command = ['sudo', 'ln', '-sfn', '/usr/lib/libglobus_callout.so.0', '/usr/lib/libglobus_callout.so']
         self.module.run_command(install_command, check_rc=True)
-        install_command = ['sudo', 'ln', '-s', '/usr/lib/libglobus_gss_assist.so.3', '/usr/lib/libglobus_gss_assist.so']
+        install_command = ['sudo', 'ln', '-sfn', '/usr/lib/libglobus_gss_assist.so.3', '/usr/lib/libglobus_gss_assist.so']
         self.module.run_command(install_command, check_rc=True)
         # Ubuntu_14
-        install_command = ['sudo', 'ln', '-s', '/usr/lib/x86_64-linux-gnu/libglobus_callout.so.0', '/usr/lib/x86_64-linux-gnu/libglobus_callout.so']
+        install_command = ['sudo', 'ln', '-sfn', '/usr/lib/x86_64-linux-gnu/libglobus_callout.so.0', '/usr/lib/x86_64-linux-gnu/libglobus_callout.so']
         self.module.run_command(install_command, check_rc=True)
-        install_command = ['sudo', 'ln', '-s', '/usr/lib/x86_64-linux-gnu/libglobus_gss_assist.so.3', '/usr/lib/x86_64-linux-gnu/libglobus_gss_assist.so']
+        install_command = ['sudo', 'ln', '-sfn', '/usr/lib/x86_64-linux-gnu/libglobus_gss_assist.so.3', '/usr/lib/x86_64-linux-gnu/libglobus_gss_assist.so']
         self.module.run_command(install_command, check_rc=True)
 
 class SuseStrategy(GenericStrategy):
@@ -134,6 +292,143 @@ class SuseStrategy(GenericStrategy):
     def building_dependencies(self):
         return ['python-devel', 'help2man', 'unixODBC', 'fuse-devel', 'libcurl-devel', 'libbz2-devel', 'libopenssl-devel', 'libxml2-devel', 'krb5-devel', 'perl-JSON', 'unixODBC-devel']
 
+trace_spans = []
+
+@contextlib.contextmanager
+def trace_span(name):
+    start = time.time()
+    try:
+        yield
+    finally:
+        trace_spans.append({'name': name, 'start': start, 'end': time.time()})
+
+def get_automatic_build_parallelism(memory_per_job_kb=1536*1024):
+    cpu_count = multiprocessing.cpu_count()
+    with open('/proc/meminfo') as f:
+        for l in f:
+            if l.startswith('MemTotal:'):
+                memory_kb = int(l.split()[1])
+                break
+        else:
+            return cpu_count
+    return max(1, min(cpu_count, memory_kb // memory_per_job_kb))
+
+def parse_ccache_statistics(ccache_output):
+    statistics = {}
+    for l in ccache_output.splitlines():
+        m = re.match(r'^\s*(cache hit \(direct\)|cache hit \(preprocessed\)|cache miss)\s+(\d+)', l)
+        if m:
+            statistics[m.group(1)] = int(m.group(2))
+    return statistics
+
+def summarize_compiler_cache_statistics(before, after):
+    delta = dict((k, after.get(k, 0) - before.get(k, 0)) for k in after)
+    hits = delta.get('cache hit (direct)', 0) + delta.get('cache hit (preprocessed)', 0)
+    misses = delta.get('cache miss', 0)
+    return {
+        'hits': hits,
+        'misses': misses,
+        'hit_rate': float(hits) / (hits + misses) if hits + misses else None,
+    }
+
+default_uncompressed_patterns = ['*.deb', '*.rpm', '*.gz', '*.tgz', '*.bz2', '*.xz', '*.zip', '*.jar', '*.xml', '*.json']
+
+def path_matches(relative_path, patterns):
+    return any(fnmatch.fnmatch(relative_path, p) or fnmatch.fnmatch(os.path.basename(relative_path.rstrip('/')), p) for p in patterns)
+
+def select_artifacts(source_directory, collection_rules):
+    include = collection_rules.get('include') or ['*']
+    exclude = collection_rules.get('exclude') or []
+    max_file_size = collection_rules.get('max_file_size')
+    selected = []
+    skipped = {}
+    for root, dirs, files in os.walk(source_directory):
+        dirs[:] = sorted(d for d in dirs if not path_matches(os.path.relpath(os.path.join(root, d), source_directory) + '/', exclude))
+        for f in sorted(files):
+            source = os.path.join(root, f)
+            relative_path = os.path.relpath(source, source_directory)
+            if os.path.islink(source) or not os.path.isfile(source):
+                continue
+            if not path_matches(relative_path, include) or path_matches(relative_path, exclude):
+                continue
+            size = os.path.getsize(source)
+            if max_file_size is not None and size > max_file_size:
+                skipped[relative_path] = 'size {0} exceeds max_file_size {1}'.format(size, max_file_size)
+                continue
+            selected.append(relative_path)
+    return selected, skipped
+
+def collect_artifact(source_directory, destination_directory, relative_path, previous, compress):
+    source = os.path.join(source_directory, relative_path)
+    size = os.path.getsize(source)
+    mtime = os.path.getmtime(source)
+    if previous is not None and os.path.isfile(os.path.join(destination_directory, previous['stored_as'])):
+        if previous['size'] == size and previous['mtime'] == mtime:
+            return previous, False
+        sha256 = sha256_of_file(source)
+        if previous['size'] == size and previous['sha256'] == sha256:
+            return dict(previous, mtime=mtime), False
+    else:
+        sha256 = sha256_of_file(source)
+    stored_as = relative_path + '.gz' if compress else relative_path
+    destination = os.path.join(destination_directory, stored_as)
+    if not os.path.isdir(os.path.dirname(destination)):
+        os.makedirs(os.path.dirname(destination))
+    partial_destination = destination + '.partial'
+    if compress:
+        with open(source, 'rb') as f:
+            compressed = gzip.open(partial_destination, 'wb')
+            try:
+                shutil.copyfileobj(f, compressed, 1024 * 1024)
+            finally:
+                compressed.close()
+    else:
+        shutil.copyfile(source, partial_destination)
+    os.rename(partial_destination, destination)
+    if previous is not None and previous['stored_as'] != stored_as and os.path.isfile(os.path.join(destination_directory, previous['stored_as'])):
+        os.unlink(os.path.join(destination_directory, previous['stored_as']))
+    return {'size': size, 'mtime': mtime, 'sha256': sha256, 'stored_as': stored_as}, True
+
+def collect_artifacts(source_directory, destination_directory, collection_rules, parallelism=8):
+    if not os.path.isdir(destination_directory):
+        os.makedirs(destination_directory)
+    manifest_file = os.path.join(destination_directory, 'artifact_manifest.json')
+    previous_artifacts = {}
+    if os.path.isfile(manifest_file):
+        with open(manifest_file) as f:
+            previous_artifacts = json.load(f)['artifacts']
+
+    selected, skipped = select_artifacts(source_directory, collection_rules)
+    uncompressed_patterns = collection_rules.get('uncompressed', default_uncompressed_patterns)
+    def collect(relative_path):
+        compress = collection_rules.get('compress', False) and not path_matches(relative_path, uncompressed_patterns)
+        return collect_artifact(source_directory, destination_directory, relative_path, previous_artifacts.get(relative_path), compress)
+
+    thread_pool = multiprocessing.pool.ThreadPool(max(1, min(parallelism, len(selected))))
+    try:
+        results = thread_pool.map(collect, selected)
+    finally:
+        thread_pool.close()
+        thread_pool.join()
+
+    artifacts = {}
+    transferred = []
+    for relative_path, (entry, copied) in zip(selected, results):
+        artifacts[relative_path] = entry
+        if copied:
+            transferred.append(relative_path)
+    with open(manifest_file + '.tmp', 'w') as f:
+        json.dump({'source_directory': source_directory, 'artifacts': artifacts, 'skipped': skipped}, f, indent=4, sort_keys=True)
+    os.rename(manifest_file + '.tmp', manifest_file)
+    return {
+        'source_directory': source_directory,
+        'destination_directory': destination_directory,
+        'selected': len(selected),
+        'transferred': len(transferred),
+        'transferred_bytes': sum(artifacts[p]['size'] for p in transferred),
+        'skipped': skipped,
+    }
+
 class CentOS6Builder(Builder):
     platform = 'Linux'
     distribution = 'Centos'
@@ -157,25 +452,46 @@ class OpenSuseBuilder(Builder):
 def main():
     module = AnsibleModule(
         argument_spec = dict(
-            output_root_directory=dict(type='str', required=True),
+            output_root_directory=dict(type='str', required=False, default=None),
             irods_packages_root_directory=dict(type='str', required=True),
-            git_repository=dict(type='str', required=True),
-            git_commitish=dict(type='str', required=True),
-            debug_build=dict(type='bool', required=True),
+            git_repository=dict(type='str', required=False, default=None),
+            git_commitish=dict(type='str', required=False, default=None),
+            git_checkout_plan=dict(type='dict', required=False, default=None),
+            compiler_cache_root_directory=dict(type='str', required=False, default=None),
+            build_jobs=dict(type='int', required=False, default=0),
+            build_output_collection_rules=dict(type='dict', required=False, default=None),
+            debug_build=dict(type='bool', required=False, default=False),
+            prepare_only=dict(type='bool', required=False, default=False),
         ),
         supports_check_mode=False,
     )
 
     builder = Builder(module)
-    builder.build()
+    if module.params['prepare_only']:
+        builder.prepare()
+    else:
+        missing = [name for name in ['output_root_directory', 'git_repository', 'git_commitish'] if module.params[name] is None]
+        if missing:
+            module.fail_json(msg='missing required arguments: {0}'.format(', '.join(missing)))
+        builder.build()
 
     result = {
         'changed': True,
         'complex_args': module.params,
+        'trace_spans': trace_spans,
         'irods_platform_string': get_irods_platform_string(),
+        'dependency_layer': {
+            'fingerprint': builder.strategy.dependency_layer_fingerprint,
+            'reused': builder.strategy.dependency_layer_reused,
+        },
+        'compiler_cache': builder.strategy.compiler_cache_statistics,
+        'build_parallelism': builder.strategy.build_parallelism,
+        'build_output_collection': builder.strategy.build_output_collection,
+        'package_transactions': package_transactions,
     }
     module.exit_json(**result)
 
+from ansible.module_utils.irods_plugin_testing_utils import *
 from ansible.module_utils.basic import *
 from ansible.module_utils.local_ansible_utils_extension import *
 main()
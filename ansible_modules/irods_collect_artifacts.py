@@ -0,0 +1,152 @@
+#!/usr/bin/python
+
+import contextlib
+import fnmatch
+import gzip
+import json
+import multiprocessing.pool
+import os
+import shutil
+import socket
+import time
+
+trace_spans = []
+
+@contextlib.contextmanager
+def trace_span(name):
+    start = time.time()
+    try:
+        yield
+    finally:
+        trace_spans.append({'name': name, 'start': start, 'end': time.time()})
+
+default_uncompressed_patterns = ['*.deb', '*.rpm', '*.gz', '*.tgz', '*.bz2', '*.xz', '*.zip', '*.jar', '*.xml', '*.json']
+
+def path_matches(relative_path, patterns):
+    return any(fnmatch.fnmatch(relative_path, p) or fnmatch.fnmatch(os.path.basename(relative_path.rstrip('/')), p) for p in patterns)
+
+def select_artifacts(source_directory, collection_rules):
+    include = collection_rules.get('include') or ['*']
+    exclude = collection_rules.get('exclude') or []
+    max_file_size = collection_rules.get('max_file_size')
+    selected = []
+    skipped = {}
+    for root, dirs, files in os.walk(source_directory):
+        dirs[:] = sorted(d for d in dirs if not path_matches(os.path.relpath(os.path.join(root, d), source_directory) + '/', exclude))
+        for f in sorted(files):
+            source = os.path.join(root, f)
+            relative_path = os.path.relpath(source, source_directory)
+            if os.path.islink(source) or not os.path.isfile(source):
+                continue
+            if not path_matches(relative_path, include) or path_matches(relative_path, exclude):
+                continue
+            size = os.path.getsize(source)
+            if max_file_size is not None and size > max_file_size:
+                skipped[relative_path] = 'size {0} exceeds max_file_size {1}'.format(size, max_file_size)
+                continue
+            selected.append(relative_path)
+    return selected, skipped
+
+def collect_artifact(source_directory, destination_directory, relative_path, previous, compress):
+    source = os.path.join(source_directory, relative_path)
+    size = os.path.getsize(source)
+    mtime = os.path.getmtime(source)
+    if previous is not None and os.path.isfile(os.path.join(destination_directory, previous['stored_as'])):
+        if previous['size'] == size and previous['mtime'] == mtime:
+            return previous, False
+        sha256 = sha256_of_file(source)
+        if previous['size'] == size and previous['sha256'] == sha256:
+            return dict(previous, mtime=mtime), False
+    else:
+        sha256 = sha256_of_file(source)
+    stored_as = relative_path + '.gz' if compress else relative_path
+    destination = os.path.join(destination_directory, stored_as)
+    if not os.path.isdir(os.path.dirname(destination)):
+        os.makedirs(os.path.dirname(destination))
+    partial_destination = destination + '.partial'
+    if compress:
+        with open(source, 'rb') as f:
+            compressed = gzip.open(partial_destination, 'wb')
+            try:
+                shutil.copyfileobj(f, compressed, 1024 * 1024)
+            finally:
+                compressed.close()
+    else:
+        shutil.copyfile(source, partial_destination)
+    os.rename(partial_destination, destination)
+    if previous is not None and previous['stored_as'] != stored_as and os.path.isfile(os.path.join(destination_directory, previous['stored_as'])):
+        os.unlink(os.path.join(destination_directory, previous['stored_as']))
+    return {'size': size, 'mtime': mtime, 'sha256': sha256, 'stored_as': stored_as}, True
+
+def collect_artifacts(source_directory, destination_directory, collection_rules, parallelism=8):
+    if not os.path.isdir(destination_directory):
+        os.makedirs(destination_directory)
+    manifest_file = os.path.join(destination_directory, 'artifact_manifest.json')
+    previous_artifacts = {}
+    if os.path.isfile(manifest_file):
+        with open(manifest_file) as f:
+            previous_artifacts = json.load(f)['artifacts']
+
+    selected, skipped = select_artifacts(source_directory, collection_rules)
+    uncompressed_patterns = collection_rules.get('uncompressed', default_uncompressed_patterns)
+    def collect(relative_path):
+        compress = collection_rules.get('compress', False) and not path_matches(relative_path, uncompressed_patterns)
+        return collect_artifact(source_directory, destination_directory, relative_path, previous_artifacts.get(relative_path), compress)
+
+    thread_pool = multiprocessing.pool.ThreadPool(max(1, min(parallelism, len(selected))))
+    try:
+        results = thread_pool.map(collect, selected)
+    finally:
+        thread_pool.close()
+        thread_pool.join()
+
+    artifacts = {}
+    transferred = []
+    for relative_path, (entry, copied) in zip(selected, results):
+        artifacts[relative_path] = entry
+        if copied:
+            transferred.append(relative_path)
+    with open(manifest_file + '.tmp', 'w') as f:
+        json.dump({'source_directory': source_directory, 'artifacts': artifacts, 'skipped': skipped}, f, indent=4, sort_keys=True)
+    os.rename(manifest_file + '.tmp', manifest_file)
+    return {
+        'source_directory': source_directory,
+        'destination_directory': destination_directory,
+        'selected': len(selected),
+        'transferred': len(transferred),
+        'transferred_bytes': sum(artifacts[p]['size'] for p in transferred),
+        'skipped': skipped,
+    }
+
+def main():
+    module = AnsibleModule(
+        argument_spec = dict(
+            output_directory=dict(type='str', required=True),
+            collection_rules=dict(type='dict', required=True),
+        ),
+        supports_check_mode=False,
+    )
+
+    collection_rules = module.params['collection_rules']
+    host_output_directory = os.path.join(module.params['output_directory'], socket.gethostname())
+    collections = []
+    for source_directory in collection_rules.get('source_directories', []):
+        if not os.path.isdir(source_directory):
+            continue
+        with trace_span('collect_artifacts'):
+            collections.append(collect_artifacts(source_directory, os.path.join(host_output_directory, source_directory.strip('/')), collection_rules, collection_rules.get('parallelism', 8)))
+
+    result = {
+        'changed': any(c['transferred'] for c in collections),
+        'complex_args': module.params,
+        'trace_spans': trace_spans,
+        'collections': collections,
+    }
+
+    module.exit_json(**result)
+
+
+from ansible.module_utils.irods_plugin_testing_utils import *
+from ansible.module_utils.basic import *
+from ansible.module_utils.local_ansible_utils_extension import *
+main()
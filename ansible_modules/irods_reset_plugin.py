@@ -0,0 +1,55 @@
+#!/usr/bin/python
+
+import json
+import os
+
+
+def get_installed_packages_matching(module, package_prefix):
+    if os.path.exists('/usr/bin/dpkg-query'):
+        _, out, _ = module.run_command(['dpkg-query', '-W', '-f', '${Package}\\n'], check_rc=True)
+    else:
+        _, out, _ = module.run_command(['rpm', '-qa', '--qf', '%{NAME}\\n'], check_rc=True)
+    return sorted(set(p.strip() for p in out.splitlines() if package_prefix in p))
+
+def remove_packages(module, packages):
+    if not packages:
+        return
+    if os.path.exists('/usr/bin/dpkg-query'):
+        module.run_command(['dpkg', '--purge'] + packages, check_rc=True)
+    else:
+        module.run_command(['rpm', '-e', '--nodeps'] + packages, check_rc=True)
+
+def restart_irods(module):
+    if get_irods_version() >= (4, 2):
+        module.run_command(['su', '-', 'irods', '-c', '/var/lib/irods/irodsctl restart'], check_rc=True)
+    else:
+        module.run_command(['su', '-', 'irods', '-c', '/var/lib/irods/iRODS/irodsctl restart'], check_rc=True)
+
+def main():
+    module = AnsibleModule(
+        argument_spec = dict(
+            plugin_package_prefixes=dict(type='list', required=True),
+        ),
+        supports_check_mode=False,
+    )
+
+    removed_packages = []
+    for plugin_package_prefix in module.params['plugin_package_prefixes']:
+        packages = get_installed_packages_matching(module, plugin_package_prefix)
+        remove_packages(module, packages)
+        removed_packages.extend(packages)
+    if removed_packages:
+        restart_irods(module)
+
+    result = {
+        'changed': bool(removed_packages),
+        'complex_args': module.params,
+        'removed_packages': removed_packages,
+    }
+
+    module.exit_json(**result)
+
+
+from ansible.module_utils.basic import *
+from ansible.module_utils.local_ansible_utils_extension import *
+main()
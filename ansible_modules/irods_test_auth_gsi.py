@@ -1,9 +1,12 @@
 #!/usr/bin/python
 
 import abc
+import contextlib
 import json
 import os
 import pwd
+import threading
+import time
 
 
 class UnimplementedStrategy(object):
@@ -40,40 +43,42 @@ class GenericStrategy(object):
     __metaclass__ = abc.ABCMeta
     def __init__(self, module):
         self.module = module
+        # grid-ca-sign bumps the simple CA's serial number, so signing is serialized
+        self.certificate_authority_lock = threading.Lock()
 
     @abc.abstractproperty
     def globus_toolkit_package_name(self):
         pass
 
     def run_tests(self):
-        self.install_testing_dependencies()
-        self.install_plugin()
-        self.do_globus_config()
-        if get_irods_version() >= (4, 2):
-            self.module.run_command(['sudo', 'su', '-', 'irods', '-c', 'cd scripts; python run_tests.py --xml_output --run_specific_test {0}'.format(self.module.params['python_test_module_to_run'])], check_rc=True)
-        else:
-            self.module.run_command(['sudo', 'su', '-', 'irods', '-c', 'cd tests/pydevtest; python run_tests.py --xml_output --run_specific_test {0}'.format(self.module.params['python_test_module_to_run'])], check_rc=True)
+        with trace_span('install_testing_dependencies'):
+            self.install_testing_dependencies()
+        with trace_span('do_globus_config'):
+            self.do_globus_config()
+        with trace_span('run_python_tests'):
+            run_python_tests(self.module, self.module.params['python_test_module_to_run'])
 
     def install_testing_dependencies(self):
         self.module.run_command(['wget', 'http://toolkit.globus.org/ftppub/gt6/installers/repo/{0}'.format(self.globus_toolkit_package_name)], check_rc=True)
-        install_os_packages_from_files([self.globus_toolkit_package_name])
-        install_os_packages(['globus-gsi'])
-
-    def install_plugin(self):
+        # globus-gsi and the plugin's globus dependencies come from the repository the globus toolkit package sets up
+        require_os_packages_from_files([self.globus_toolkit_package_name], stage=0)
+        require_os_packages(['globus-gsi'], stage=1)
         plugin_directory = os.path.join(self.module.params['plugin_package_root_directory'], get_irods_platform_string())
-        plugin_basename = filter(lambda x:self.module.params['plugin_package_prefix'] in x, os.listdir(plugin_directory))[0]
-        package_name = os.path.join(plugin_directory, plugin_basename)
-        install_os_packages_from_files([package_name])
+        require_os_packages_from_files([resolve_package(self.module, plugin_directory, self.module.params['plugin_package_prefix'])], stage=1)
+        install_required_packages(self.module)
 
     def do_globus_config(self):
-        self.module.run_command(['chmod', 'o+rx', '/home/irodsbuild'], check_rc=True) # so user simpleca can read ~irodsbuild/.globus/usercert_request.pem
-        irodsbuild_password = self.create_irodsbuild_certificate()
-        self.create_irods_certificate()
-        self.generate_proxy('irodsbuild', irodsbuild_password)
-        self.generate_proxy('irods', None)
-        irodsbuild_proxy_copy = self.make_irods_readable_copy_of_irodsbuild_proxy()
-        irodsbuild_distinguished_name = self.get_irodsbuild_distinguished_name()
-        self.create_test_configuration_json(irodsbuild_proxy_copy, irodsbuild_distinguished_name)
+        run_step_graph(self.module, [
+            ('open_irodsbuild_home', [], lambda results: self.module.run_command(['chmod', 'o+rx', '/home/irodsbuild'], check_rc=True)), # so user simpleca can read ~irodsbuild/.globus/usercert_request.pem
+            ('create_irodsbuild_certificate', ['open_irodsbuild_home'], lambda results: self.create_irodsbuild_certificate(), {'cn': 'gsi_client_user'}),
+            ('create_irods_certificate', [], lambda results: self.create_irods_certificate(), {'cn': 'irods_service'}),
+            ('generate_irodsbuild_proxy', ['create_irodsbuild_certificate'], lambda results: self.generate_proxy('irodsbuild', results['create_irodsbuild_certificate'])),
+            ('generate_irods_proxy', ['create_irods_certificate'], lambda results: self.generate_proxy('irods', None)),
+            ('make_irods_readable_copy_of_irodsbuild_proxy', ['generate_irodsbuild_proxy'], lambda results: self.make_irods_readable_copy_of_irodsbuild_proxy()),
+            ('get_irodsbuild_distinguished_name', ['create_irodsbuild_certificate'], lambda results: self.get_irodsbuild_distinguished_name()),
+            ('create_test_configuration_json', ['make_irods_readable_copy_of_irodsbuild_proxy', 'get_irodsbuild_distinguished_name'],
+             lambda results: self.create_test_configuration_json(results['make_irods_readable_copy_of_irodsbuild_proxy'], results['get_irodsbuild_distinguished_name'])),
+        ], state_name='irods_test_auth_gsi')
 
     def create_irodsbuild_certificate(self):
         self.module.run_command(['sudo', 'su', '-', 'irodsbuild', '-c', 'grid-cert-request -nopw -force -cn gsi_client_user'], check_rc=True)
@@ -82,8 +87,9 @@ class GenericStrategy(object):
         self.module.run_command(['openssl', 'rsa', '-in', '.globus/userkey.pem', '-out', '~irodsbuild/.globus/userkey.pem', '-des3', '-passout', 'pass:{0}'.format(private_key_password)], check_rc=True)
         self.module.run_command(['chmod', '400', '~irodsbuild/.globus/userkey.pem'], check_rc=True)
 
-        temporary_certificate_location = '/tmp/gsicert'
-        self.module.run_command(['sudo', 'su', '-s', '/bin/bash', '-c', 'grid-ca-sign -in ~irodsbuild/.globus/usercert_request.pem -out {0}'.format(temporary_certificate_location), 'simpleca'], check_rc=True)
+        temporary_certificate_location = '/tmp/gsicert_irodsbuild'
+        with self.certificate_authority_lock:
+            self.module.run_command(['sudo', 'su', '-s', '/bin/bash', '-c', 'grid-ca-sign -in ~irodsbuild/.globus/usercert_request.pem -out {0}'.format(temporary_certificate_location), 'simpleca'], check_rc=True)
 
         self.module.run_command(['cp', temporary_certificate_location, '.globus/usercert.pem'], check_rc=True)
         self.module.run_command(['sudo', 'rm', temporary_certificate_location], check_rc=True)
@@ -92,8 +98,9 @@ class GenericStrategy(object):
     def create_irods_certificate(self):
         self.module.run_command(['sudo', 'su', '-', 'irods', '-c', 'grid-cert-request -nopw -force -cn irods_service'], check_rc=True)
 
-        temporary_certificate_location = '/tmp/gsicert'
-        self.module.run_command(['sudo', 'su', '-s', '/bin/bash', '-c', 'grid-ca-sign -in ~irods/.globus/usercert_request.pem -out {0}'.format(temporary_certificate_location), 'simpleca'], check_rc=True)
+        temporary_certificate_location = '/tmp/gsicert_irods'
+        with self.certificate_authority_lock:
+            self.module.run_command(['sudo', 'su', '-s', '/bin/bash', '-c', 'grid-ca-sign -in ~irods/.globus/usercert_request.pem -out {0}'.format(temporary_certificate_location), 'simpleca'], check_rc=True)
 
         self.module.run_command(['sudo', 'cp', temporary_certificate_location, '~irods/.globus/usercert.pem'], check_rc=True)
         self.module.run_command(['sudo', 'rm', temporary_certificate_location], check_rc=True)
@@ -124,6 +131,16 @@ class GenericStrategy(object):
             json.dump(config, f)
         self.module.run_command(['sudo', 'chmod', '777', config_file], check_rc=True)
 
+trace_spans = []
+
+@contextlib.contextmanager
+def trace_span(name):
+    start = time.time()
+    try:
+        yield
+    finally:
+        trace_spans.append({'name': name, 'start': start, 'end': time.time()})
+
 class DebianStrategy(GenericStrategy):
     @property
     def globus_toolkit_package_name(self):
@@ -166,11 +183,14 @@ def main():
     result = {
         'changed': True,
         'complex_args': module.params,
+        'trace_spans': trace_spans,
+        'package_transactions': package_transactions,
     }
 
     module.exit_json(**result)
 
 
+from ansible.module_utils.irods_plugin_testing_utils import *
 from ansible.module_utils.basic import *
 from ansible.module_utils.local_ansible_utils_extension import *
 main()
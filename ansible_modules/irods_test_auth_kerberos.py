@@ -1,13 +1,17 @@
 #!/usr/bin/python
 
 import abc
+import contextlib
+import hashlib
 import json
 import os
 import pwd
+import re
 import shutil
 import socket
 import stat
 import tempfile
+import time
 
 
 class UnimplementedStrategy(object):
@@ -46,9 +50,12 @@ class GenericStrategy(object):
         self.module = module
         self.kdc_database_master_key = 'krbtest'
         self.unprivileged_principal_password = 'krbtest'
+        self.kadmin_operation_results = []
+        self.realm_snapshot_root_directory = module.params['kerberos_realm_cache_directory']
+        self.realm_snapshot_restored = False
 
     @abc.abstractmethod
-    def install_kerberos_packages(self):
+    def require_kerberos_packages(self):
         pass
 
     @abc.abstractmethod
@@ -59,58 +66,141 @@ class GenericStrategy(object):
     def enable_admin_privileges(self):
         pass
 
+    @abc.abstractproperty
+    def realm_snapshot_files(self):
+        pass
+
+    @abc.abstractproperty
+    def kdc_database_file(self):
+        pass
+
+    @property
+    def unprivileged_principals(self):
+        return ['krb_user', 'irods/icat.example.org'] + self.module.params['additional_principals']
+
+    @property
+    def realm_definition(self):
+        return {
+            'realm_snapshot_version': 1,
+            'strategy': self.__class__.__name__,
+            'realm': 'EXAMPLE.ORG',
+            'kdc_database_master_key': self.kdc_database_master_key,
+            'unprivileged_principals': self.unprivileged_principals,
+            'unprivileged_principal_password': self.unprivileged_principal_password,
+        }
+
+    @property
+    def realm_snapshot_directory(self):
+        if not self.realm_snapshot_root_directory:
+            return None
+        fingerprint = hashlib.sha256(json.dumps(self.realm_definition, sort_keys=True)).hexdigest()
+        return os.path.join(self.realm_snapshot_root_directory, get_irods_platform_string(), fingerprint)
+
     def run_tests(self):
-        self.install_testing_dependencies()
-        self.install_plugin()
-        if get_irods_version() >= (4, 2):
-            self.module.run_command(['sudo', 'su', '-', 'irods', '-c', 'cd scripts; python run_tests.py --xml_output --run_specific_test {0}'.format(self.module.params['python_test_module_to_run'])], check_rc=True)
-        else:
-            self.module.run_command(['sudo', 'su', '-', 'irods', '-c', 'cd tests/pydevtest; python run_tests.py --xml_output --run_specific_test {0}'.format(self.module.params['python_test_module_to_run'])], check_rc=True)
+        with trace_span('install_testing_dependencies'):
+            self.install_testing_dependencies()
+        with trace_span('run_python_tests'):
+            run_python_tests(self.module, self.module.params['python_test_module_to_run'])
 
     def install_testing_dependencies(self):
-        add_shortname_to_etc_hosts()
-        self.install_kerberos_packages()
-        self.configure_realm_and_domain()
-        self.restart_kerberos()
-        self.create_privileged_principal()
-        self.enable_admin_privileges()
-        self.restart_kerberos()
-        import time; time.sleep(600) # On Ubuntu 14: 'kadmin: GSS-API (or Kerberos) error while initializing kadmin interface' seen without. possibly clock skew issue w/ VMs spawning from old template and updating clocks while krb system initializes
-        self.create_unprivileged_principal('krb_user')
-        self.create_unprivileged_principal('irods/icat.example.org')
-        self.create_keytab()
-        update_irods_server_config()
-        self.restart_irods()
-        self.create_ticket_granting_ticket()
-        self.create_json_config_file_for_unit_test()
+        run_step_graph(self.module, [
+            ('add_shortname_to_etc_hosts', [], lambda results: add_shortname_to_etc_hosts()),
+            # not recorded, since the plugin package changes between runs; the planner skips installed kerberos packages
+            ('install_packages', [], lambda results: self.install_packages()),
+            ('update_irods_server_config', [], lambda results: update_irods_server_config()),
+            ('set_up_realm', ['add_shortname_to_etc_hosts', 'install_packages'], lambda results: self.set_up_realm(), self.realm_definition),
+            ('restart_irods', ['update_irods_server_config', 'set_up_realm'], lambda results: restart_irods_if_needed(self.restart_irods)),
+            ('create_ticket_granting_ticket', ['set_up_realm'], lambda results: self.create_ticket_granting_ticket()),
+            ('create_json_config_file_for_unit_test', ['create_ticket_granting_ticket'], lambda results: self.create_json_config_file_for_unit_test()),
+        ], state_name='irods_test_auth_kerberos')
+
+    def set_up_realm(self):
+        if self.restore_realm_snapshot():
+            self.restart_kerberos()
+            self.wait_for_kadmin()
+        else:
+            self.configure_realm_and_domain()
+            self.restart_kerberos()
+            self.create_privileged_principal()
+            self.enable_admin_privileges()
+            self.restart_kerberos()
+            self.wait_for_kadmin() # On Ubuntu 14: 'kadmin: GSS-API (or Kerberos) error while initializing kadmin interface' seen until the kdc settles. possibly clock skew issue w/ VMs spawning from old template and updating clocks while krb system initializes
+            self.create_unprivileged_principals_and_keytab()
+            self.save_realm_snapshot()
+        request_irods_restart('kerberos realm set up')
+
+    def save_realm_snapshot(self):
+        snapshot_directory = self.realm_snapshot_directory
+        if snapshot_directory is None or os.path.isdir(snapshot_directory):
+            return
+        snapshot_parent = os.path.dirname(snapshot_directory)
+        if not os.path.isdir(snapshot_parent):
+            os.makedirs(snapshot_parent)
+        staging_directory = tempfile.mkdtemp(prefix='.staging_', dir=snapshot_parent)
+        try:
+            self.module.run_command(['kdb5_util', 'dump', os.path.join(staging_directory, 'kdc_database.dump')], check_rc=True)
+            for name, path in self.realm_snapshot_files.items():
+                shutil.copy2(path, os.path.join(staging_directory, name))
+            shutil.copy2('/var/lib/irods/irods.keytab', os.path.join(staging_directory, 'irods.keytab'))
+            os.rename(staging_directory, snapshot_directory)
+        except OSError:
+            shutil.rmtree(staging_directory, ignore_errors=True)
+            if not os.path.isdir(snapshot_directory):
+                raise
+
+    def restore_realm_snapshot(self):
+        snapshot_directory = self.realm_snapshot_directory
+        if snapshot_directory is None or not os.path.isdir(snapshot_directory):
+            return False
+        for name, path in self.realm_snapshot_files.items():
+            shutil.copy2(os.path.join(snapshot_directory, name), path)
+        self.prepare_restored_realm()
+        self.module.run_command(['kdb5_util', 'load', os.path.join(snapshot_directory, 'kdc_database.dump')], check_rc=True)
+        shutil.copy2(os.path.join(snapshot_directory, 'irods.keytab'), '/var/lib/irods/irods.keytab')
+        self.module.run_command(['chown', 'irods:irods', '/var/lib/irods/irods.keytab'], check_rc=True)
+        self.realm_snapshot_restored = True
+        return True
+
+    def prepare_restored_realm(self):
+        pass
+
+    def destroy_existing_realm(self):
+        # set_up_realm runs again when the realm definition changes, and kdb5_util create refuses an existing database
+        if os.path.exists(self.kdc_database_file):
+            self.module.run_command(['kdb5_util', '-r', 'EXAMPLE.ORG', 'destroy', '-f'], check_rc=True)
+
+    def wait_for_kadmin(self):
+        def kadmin_answers():
+            rc, _, _ = self.module.run_command(['kadmin', '-p', 'root/admin', '-q', 'listprincs'], data='{0}\n'.format(self.kdc_database_master_key))
+            return rc == 0
+        wait_for_readiness(self.module, 'kadmin', kadmin_answers, timeout=900)
 
     def create_privileged_principal(self):
-        stdin = '''addprinc root/admin
-krbtest
-krbtest
-'''
-        self.module.run_command(['kadmin.local'], data=stdin, check_rc=True)
-
-    def create_unprivileged_principal(self, principal):
-        stdin = '''{0}
-addprinc {1}
-{2}
-{2}
-'''.format(self.kdc_database_master_key, principal, self.unprivileged_principal_password)
-        self.module.run_command(['kadmin', '-p', 'root/admin'], data=stdin, check_rc=True)
-
-    def create_keytab(self):
-        stdin = '''krbtest
-ktadd -k /var/lib/irods/irods.keytab irods/icat.example.org@EXAMPLE.ORG
-'''
-        self.module.run_command(['kadmin', '-p', 'root/admin'], data=stdin, check_rc=True)
+        self.apply_kadmin_operations([addprinc_operation('root/admin', 'krbtest')], local=True)
+
+    def create_unprivileged_principals_and_keytab(self):
+        operations = [addprinc_operation(principal, self.unprivileged_principal_password) for principal in self.unprivileged_principals]
+        operations.append(ktadd_operation('/var/lib/irods/irods.keytab', 'irods/icat.example.org@EXAMPLE.ORG'))
+        self.apply_kadmin_operations(operations)
         self.module.run_command(['chown', 'irods:irods', '/var/lib/irods/irods.keytab'], check_rc=True)
 
+    def apply_kadmin_operations(self, operations, local=False):
+        # passwords go over stdin so that they never show up in a process listing
+        if local:
+            results = run_kadmin_batch(self.module, ['kadmin.local'], operations)
+        else:
+            results = run_kadmin_batch(self.module, ['kadmin', '-p', 'root/admin'], operations, self.kdc_database_master_key)
+        self.kadmin_operation_results.extend(results)
+        failed = [r for r in results if not r['succeeded']]
+        if failed:
+            self.module.fail_json(msg='kadmin operations failed: {0}'.format(', '.join(r['request'] for r in failed)), kadmin_operations=self.kadmin_operation_results)
+
     def restart_irods(self):
         if get_irods_version() >= (4, 2):
             self.module.run_command(['su', '-', 'irods', '-c', '/var/lib/irods/irodsctl restart'], check_rc=True)
         else:
             self.module.run_command(['su', '-', 'irods', '-c', '/var/lib/irods/iRODS/irodsctl restart'], check_rc=True)
+        wait_for_readiness(self.module, 'irods', irods_server_answers)
 
     def create_ticket_granting_ticket(self):
         self.module.run_command(['kinit', 'krb_user'], data='{0}\n'.format(self.unprivileged_principal_password), check_rc=True)
@@ -128,14 +218,30 @@ ktadd -k /var/lib/irods/irods.keytab irods/icat.example.org@EXAMPLE.ORG
         ticket_cache_file = ticket_cache.rpartition('FILE:')[2]
         self.module.run_command(['chmod', 'o+r', ticket_cache_file], check_rc=True)
 
-    def install_plugin(self):
+    def install_packages(self):
+        self.require_kerberos_packages()
         plugin_directory = os.path.join(self.module.params['plugin_package_root_directory'], get_irods_platform_string())
-        plugin_basename = filter(lambda x:self.module.params['plugin_package_prefix'] in x, os.listdir(plugin_directory))[0]
-        package_name = os.path.join(plugin_directory, plugin_basename)
-        install_os_packages_from_files([package_name])
+        require_os_packages_from_files([resolve_package(self.module, plugin_directory, self.module.params['plugin_package_prefix'])])
+        install_required_packages(self.module)
 
 class DebianStrategy(GenericStrategy):
-    def install_kerberos_packages(self):
+    @property
+    def realm_snapshot_files(self):
+        return {
+            'krb5.conf': '/etc/krb5.conf',
+            'kdc.conf': '/etc/krb5kdc/kdc.conf',
+            'kadm5.acl': '/etc/krb5kdc/kadm5.acl',
+            'stash': '/etc/krb5kdc/stash',
+        }
+
+    @property
+    def kdc_database_file(self):
+        return '/var/lib/krb5kdc/principal'
+
+    def prepare_restored_realm(self):
+        self.create_kerberos_log_directory()
+
+    def require_kerberos_packages(self):
         debconf_settings = '''
 krb5-config	krb5-config/read_conf	boolean	true
 krb5-admin-server	krb5-admin-server/newrealm	note
@@ -152,7 +258,7 @@ krb5-config	krb5-config/kerberos_servers	string	icat.example.org
             f.write(debconf_settings)
             f.flush()
             self.module.run_command(['debconf-set-selections', f.name], check_rc=True)
-        install_os_packages(['krb5-admin-server', 'krb5-kdc'])
+        require_os_packages(['krb5-admin-server', 'krb5-kdc'])
 
     def configure_realm_and_domain(self):
         self.create_kerberos_realm()
@@ -160,9 +266,13 @@ krb5-config	krb5-config/kerberos_servers	string	icat.example.org
         self.enable_kerberos_logging()
 
     def create_kerberos_realm(self):
+        self.destroy_existing_realm()
         self.module.run_command(['krb5_newrealm'], data='krbtest\nkrbtest\n', check_rc=True)
 
     def add_domain_to_krb5_conf(self):
+        with open('/etc/krb5.conf') as conf:
+            if '.example.org = EXAMPLE.ORG' in conf.read():
+                return
         with tempfile.NamedTemporaryFile() as conf_copy:
             with open('/etc/krb5.conf') as conf:
                 for l in conf:
@@ -180,9 +290,15 @@ krb5-config	krb5-config/kerberos_servers	string	icat.example.org
         admin_server = FILE:/var/log/kerberos/kadmin.log
         default = FILE:/var/log/kerberos/krb5lib.log
 '''
-        with open('/etc/krb5.conf', 'a') as conf:
-            conf.write(conf_section)
-        self.module.run_command(['mkdir', '/var/log/kerberos'], check_rc=True)
+        with open('/etc/krb5.conf') as conf:
+            logging_enabled = 'FILE:/var/log/kerberos/krb5kdc.log' in conf.read()
+        if not logging_enabled:
+            with open('/etc/krb5.conf', 'a') as conf:
+                conf.write(conf_section)
+        self.create_kerberos_log_directory()
+
+    def create_kerberos_log_directory(self):
+        self.module.run_command(['mkdir', '-p', '/var/log/kerberos'], check_rc=True)
         self.module.run_command(['touch', '/var/log/kerberos/krb5kdc.log'], check_rc=True)
         self.module.run_command(['touch', '/var/log/kerberos/kadmin.log'], check_rc=True)
         self.module.run_command(['touch', '/var/log/kerberos/krb5lib.log'], check_rc=True)
@@ -193,12 +309,29 @@ krb5-config	krb5-config/kerberos_servers	string	icat.example.org
         self.module.run_command(['invoke-rc.d', 'krb5-kdc', 'restart'], check_rc=True)
 
     def enable_admin_privileges(self):
+        if os.path.isfile('/etc/krb5kdc/kadm5.acl'):
+            with open('/etc/krb5kdc/kadm5.acl') as f:
+                if '*/admin *' in f.read().splitlines():
+                    return
         with open('/etc/krb5kdc/kadm5.acl', 'a') as f:
             f.write('*/admin *\n')
 
 class RedHatStrategy(GenericStrategy):
-    def install_kerberos_packages(self):
-        install_os_packages(['krb5-server', 'krb5-libs', 'krb5-auth-dialog', 'krb5-workstation'])
+    @property
+    def realm_snapshot_files(self):
+        return {
+            'krb5.conf': '/etc/krb5.conf',
+            'kdc.conf': '/var/kerberos/krb5kdc/kdc.conf',
+            'kadm5.acl': '/var/kerberos/krb5kdc/kadm5.acl',
+            'stash': '/var/kerberos/krb5kdc/.k5.EXAMPLE.ORG',
+        }
+
+    @property
+    def kdc_database_file(self):
+        return '/var/kerberos/krb5kdc/principal'
+
+    def require_kerberos_packages(self):
+        require_os_packages(['krb5-server', 'krb5-libs', 'krb5-auth-dialog', 'krb5-workstation'])
 
     def configure_realm_and_domain(self):
         krb5_conf_contents = '''\
@@ -245,6 +378,7 @@ class RedHatStrategy(GenericStrategy):
         with open('/var/kerberos/krb5kdc/kdc.conf', 'w') as f:
             f.write(kdc_conf_contents)
 
+        self.destroy_existing_realm()
         self.module.run_command(['kdb5_util', 'create', '-r', 'EXAMPLE.ORG', '-s', '-W'], data='{0}\n{0}\n'.format(self.kdc_database_master_key), check_rc=True)
 
     def restart_kerberos(self):
@@ -271,21 +405,81 @@ def add_shortname_to_etc_hosts():
     with tempfile.NamedTemporaryFile() as hosts_copy:
         with open('/etc/hosts') as hosts_file:
             for l in hosts_file:
-                if fullname in l:
+                if fullname in l and shortname not in l.split():
                     hosts_copy.write(l.strip() + ' ' + shortname + '\n')
                 else:
                     hosts_copy.write(l)
         hosts_copy.flush()
         shutil.copyfile(hosts_copy.name, '/etc/hosts')
 
+def addprinc_operation(principal, password):
+    return {'type': 'addprinc', 'principal': principal, 'password': password}
+
+def ktadd_operation(keytab, principal):
+    return {'type': 'ktadd', 'keytab': keytab, 'principal': principal}
+
+def format_kadmin_request(operation):
+    if operation['type'] == 'addprinc':
+        return 'addprinc {0}'.format(operation['principal'])
+    if operation['type'] == 'ktadd':
+        return 'ktadd -k {0} {1}'.format(operation['keytab'], operation['principal'])
+    raise ValueError('unknown kadmin operation type: {0}'.format(operation['type']))
+
+def format_kadmin_input(operation):
+    # addprinc prompts for the new principal's password twice
+    lines = [format_kadmin_request(operation)]
+    if operation['type'] == 'addprinc':
+        lines.extend([operation['password'], operation['password']])
+    return lines
+
+def kadmin_output_names_principal(name, principal):
+    # kadmin prints principals with their realm
+    return name == principal or ('@' not in principal and name.startswith(principal + '@'))
+
+def kadmin_operation_succeeded(operation, output_lines):
+    principal = operation['principal']
+    for l in output_lines:
+        if operation['type'] == 'addprinc':
+            match = re.match(r'Principal "([^"]+)" created', l)
+        else:
+            match = re.match(r'Entry for principal (\S+) .*added to keytab', l)
+        if match and kadmin_output_names_principal(match.group(1), principal):
+            return True
+    return False
+
+def run_kadmin_batch(module, command, operations, admin_password=None):
+    input_lines = [admin_password] if admin_password is not None else []
+    for operation in operations:
+        input_lines.extend(format_kadmin_input(operation))
+    rc, out, err = module.run_command(command, data='\n'.join(input_lines + ['quit']) + '\n')
+    output_lines = (out + '\n' + err).splitlines()
+    results = []
+    for operation in operations:
+        request = format_kadmin_request(operation)
+        result = {'request': request, 'succeeded': kadmin_operation_succeeded(operation, output_lines)}
+        if not result['succeeded']:
+            result['errors'] = [l for l in output_lines if operation['principal'].partition('@')[0] in l]
+        results.append(result)
+    if rc != 0 and all(r['succeeded'] for r in results):
+        results.append({'request': command[0], 'succeeded': False, 'errors': err.splitlines()})
+    return results
+
+trace_spans = []
+
+@contextlib.contextmanager
+def trace_span(name):
+    start = time.time()
+    try:
+        yield
+    finally:
+        trace_spans.append({'name': name, 'start': start, 'end': time.time()})
+
 def update_irods_server_config():
-    with open('/etc/irods/server_config.json') as f:
-        d = json.load(f)
-    d['KerberosServicePrincipal'] = 'irods/icat.example.org@EXAMPLE.ORG'
-    d['KerberosKeytab'] = '/var/lib/irods/irods.keytab' # Not actually used, read from the environment variable
-    d['environment_variables']['KRB5_KTNAME'] = '/var/lib/irods/irods.keytab'
-    with open('/etc/irods/server_config.json', 'w') as f:
-        json.dump(d, f, indent=4, sort_keys=True)
+    patch_server_config({
+        'KerberosServicePrincipal': 'irods/icat.example.org@EXAMPLE.ORG',
+        'KerberosKeytab': '/var/lib/irods/irods.keytab', # Not actually used, read from the environment variable
+        'environment_variables': {'KRB5_KTNAME': '/var/lib/irods/irods.keytab'},
+    })
 
 class CentOS6TestRunner(TestRunner):
     platform = 'Linux'
@@ -314,6 +508,8 @@ def main():
             plugin_package_prefix=dict(type='str', required=True),
             python_test_module_to_run=dict(type='str', required=True),
             output_directory=dict(type='str', required=True),
+            additional_principals=dict(type='list', required=False, default=[]),
+            kerberos_realm_cache_directory=dict(type='str', required=False, default=None),
         ),
         supports_check_mode=False,
     )
@@ -324,11 +520,18 @@ def main():
     result = {
         'changed': True,
         'complex_args': module.params,
+        'trace_spans': trace_spans,
+        'readiness_waits': readiness_waits,
+        'kadmin_operations': test_runner.strategy.kadmin_operation_results,
+        'kerberos_realm_snapshot_restored': test_runner.strategy.realm_snapshot_restored,
+        'irods_restarts': irods_restarts,
+        'package_transactions': package_transactions,
     }
 
     module.exit_json(**result)
 
 
+from ansible.module_utils.irods_plugin_testing_utils import *
 from ansible.module_utils.basic import *
 from ansible.module_utils.local_ansible_utils_extension import *
 main()
@@ -1,5 +1,6 @@
 #!/usr/bin/python
 
+import contextlib
 import glob
 import json
 import os
@@ -7,19 +8,29 @@ import pwd
 import shutil
 import socket
 import subprocess
+import time
+
+trace_spans = []
+
+@contextlib.contextmanager
+def trace_span(name):
+    start = time.time()
+    try:
+        yield
+    finally:
+        trace_spans.append({'name': name, 'start': start, 'end': time.time()})
 
 def run_tests(module):
-    install_plugin_package(module)
-    module.run_command(['sudo', '-E', 'pip2', 'install', '--upgrade', 'boto3'], check_rc=True) # antoine
-    if get_irods_version() >= (4, 2):
-        module.run_command(['sudo', 'su', '-', 'irods', '-c', 'cd scripts; python run_tests.py --xml_output --run_specific_test {0}'.format(module.params['python_test_module_to_run'])], check_rc=True)
-    else:
-        module.run_command(['sudo', 'su', '-', 'irods', '-c', 'cd tests/pydevtest; python run_tests.py --xml_output --run_specific_test {0} > /var/lib/irods/tests/pydevtest/test_output.txt'.format(module.params['python_test_module_to_run'])], check_rc=True)
+    with trace_span('install_plugin'):
+        install_plugin_package(module)
+    with trace_span('install_testing_dependencies'):
+        module.run_command(['sudo', '-E', 'pip2', 'install', '--upgrade', 'boto3'], check_rc=True) # antoine
+    with trace_span('run_python_tests'):
+        run_python_tests(module, module.params['python_test_module_to_run'], pydevtest_output_file='/var/lib/irods/tests/pydevtest/test_output.txt')
 
 def install_plugin_package(module):
     plugin_directory = os.path.join(module.params['plugin_package_root_directory'], get_irods_platform_string())
-    plugin_basename = filter(lambda x:module.params['plugin_package_prefix'] in x, os.listdir(plugin_directory))[0]
-    package_name = os.path.join(plugin_directory, plugin_basename)
+    package_name = resolve_package(module, plugin_directory, module.params['plugin_package_prefix'])
     install_os_packages_from_files([package_name])
 
 def main():
@@ -38,11 +49,13 @@ def main():
     result = {
         'changed': True,
         'complex_args': module.params,
+        'trace_spans': trace_spans,
     }
 
     module.exit_json(**result)
 
 
+from ansible.module_utils.irods_plugin_testing_utils import *
 from ansible.module_utils.basic import *
 from ansible.module_utils.local_ansible_utils_extension import *
 main()
@@ -1,50 +1,108 @@
 #!/usr/bin/python
 
+import contextlib
 import glob
 import json
 import os
 import pwd
+import re
 import shutil
 import socket
 import subprocess
+import time
+
+trace_spans = []
+
+@contextlib.contextmanager
+def trace_span(name):
+    start = time.time()
+    try:
+        yield
+    finally:
+        trace_spans.append({'name': name, 'start': start, 'end': time.time()})
 
 def run_tests(module):
     install_testing_dependencies(module)
-    if get_irods_version() >= (4, 2):
-        pass
-        module.run_command(['sudo', 'su', '-', 'irods', '-c', 'cd scripts; python run_tests.py --xml_output --run_specific_test {0}'.format(module.params['python_test_module_to_run'])], check_rc=True)
-    else:
-        module.run_command(['sudo', 'su', '-', 'irods', '-c', 'cd tests/pydevtest; python run_tests.py --xml_output --run_specific_test {0}'.format(module.params['python_test_module_to_run'])], check_rc=True)
+    with trace_span('run_python_tests'):
+        run_python_tests(module, module.params['python_test_module_to_run'])
 
 def install_testing_dependencies(module):
-    install_hpss_plugin(module)
-    configure_hpss(module)
+    with trace_span('install_plugin'):
+        install_hpss_plugin(module)
+    with trace_span('configure_hpss'):
+        configure_hpss(module)
 
 def install_hpss_plugin(module):
     plugin_directory = os.path.join(module.params['plugin_package_root_directory'],get_irods_platform_string())
-    plugin_basename = filter(lambda x:module.params['plugin_package_prefix'] in x, os.listdir(plugin_directory))[0]
-    package_name = os.path.join(plugin_directory, plugin_basename)
-    module.run_command(['sudo', 'rpm', '-i', '--nodeps', package_name], check_rc=True)
+    package_name = resolve_package(module, plugin_directory, module.params['plugin_package_prefix'])
+    # also succeeds when a reused host already has this or another version of the plugin installed
+    module.run_command(['sudo', 'rpm', '-U', '--replacepkgs', '--oldpackage', '--nodeps', package_name], check_rc=True)
     #install_os_packages_from_files(['--skip-broken', package_name])
 
 def add_LD_PRELOAD_to_server_config():
-    with open('/etc/irods/server_config.json') as f:
-        d = json.load(f)
-    d['environment_variables']['LD_PRELOAD'] = '/lib64/libtirpc.so'
-    with open('/etc/irods/server_config.json', 'w') as f:
-        json.dump(d, f, sort_keys=True, indent=4)
+    patch_server_config({'environment_variables': {'LD_PRELOAD': '/lib64/libtirpc.so'}})
+
+def rpcbind_answers(module):
+    rc, _, _ = module.run_command(['rpcinfo', '-p', 'localhost'])
+    return rc == 0
+
+def hpss_answers(module):
+    rc, _, _ = module.run_command(['/opt/hpss/bin/scrub', '-a', 'unix', '-k', '-t', '/var/hpss/etc/root.unix.keytab', '-p', 'root'], data='ls /\nquit\n')
+    return rc == 0
 
 def configure_hpss(module):
-    module.run_command(['passwd', 'irods'], data='notasecret\nnotasecret\n', check_rc=True)
-    module.run_command(['sed', '-i', '/hpss743.example.org/ s/$/ hpss743/', '/etc/hosts'], check_rc=True)
-    module.run_command(['ln', '-s', '/lib64/libtirpc.so.1', '/lib64/libtirpc.so'], check_rc=True)
-    add_LD_PRELOAD_to_server_config()
-    module.run_command(['sed', '-i', '/^ALL:.*DENY$/d', '/etc/hosts.allow'], check_rc=True)
+    run_step_graph(module, [
+        ('set_irods_password', [], lambda results: module.run_command(['passwd', 'irods'], data='notasecret\nnotasecret\n', check_rc=True), {}),
+        ('add_hpss_shortname_to_etc_hosts', [], lambda results: module.run_command(['sed', '-i', '/hpss743.example.org/ {/ hpss743$/! s/$/ hpss743/}', '/etc/hosts'], check_rc=True), {}),
+        ('link_libtirpc', [], lambda results: link_libtirpc(module), {}),
+        ('add_LD_PRELOAD_to_server_config', [], lambda results: add_LD_PRELOAD_to_server_config()),
+        # running daemons are not configuration, so these steps are never recorded and probe the services instead
+        ('allow_rpc_hosts', [], lambda results: allow_rpc_hosts()),
+        ('restart_rpcbind', ['allow_rpc_hosts'], lambda results: restart_rpcbind(module, results['allow_rpc_hosts'])),
+        ('start_hpss', ['restart_rpcbind', 'add_hpss_shortname_to_etc_hosts'], lambda results: start_hpss(module, results['restart_rpcbind'])),
+        ('add_hpss_irods_user', ['start_hpss', 'set_irods_password'], lambda results: add_hpss_irods_user(module), {}),
+        # the vault is recreated on every run so tests start from an empty one
+        ('prepare_irods_vault', ['add_hpss_irods_user'], lambda results: prepare_irods_vault(module)),
+        ('restart_irods', ['prepare_irods_vault', 'link_libtirpc', 'add_LD_PRELOAD_to_server_config'], lambda results: restart_irods_if_needed(lambda: restart_irods(module))),
+    ], state_name='irods_test_resource_hpss')
+
+def link_libtirpc(module):
+    module.run_command(['ln', '-sfn', '/lib64/libtirpc.so.1', '/lib64/libtirpc.so'], check_rc=True)
+    request_irods_restart('libtirpc linked')
+
+def allow_rpc_hosts():
+    with open('/etc/hosts.allow') as f:
+        lines = f.readlines()
+    allowed_lines = [l for l in lines if not re.match(r'^ALL:.*DENY$', l.rstrip('\n'))]
+    if allowed_lines == lines:
+        return False
+    with open('/etc/hosts.allow', 'w') as f:
+        f.writelines(allowed_lines)
+    return True
+
+def restart_rpcbind(module, hosts_allow_changed):
+    # restarting rpcbind drops the registrations of a running hpss
+    if not hosts_allow_changed and rpcbind_answers(module):
+        return False
     module.run_command(['/etc/init.d/rpcbind', 'restart'], check_rc=True)
+    wait_for_readiness(module, 'rpcbind', lambda: rpcbind_answers(module))
+    return True
+
+def start_hpss(module, rpcbind_restarted):
+    if not rpcbind_restarted and hpss_answers(module):
+        return False
     module.run_command(['/opt/hpss/bin/rc.hpss', 'start'], check_rc=True)
     module.run_command(['/opt/hpss/bin/hpssadm.pl', '-U', 'hpssssm', '-A', 'unix', '-a', '/var/hpss/etc/hpss.unix.keytab'], data='server start -all\nquit\n', check_rc=True)
+    wait_for_readiness(module, 'hpss', lambda: hpss_answers(module), timeout=600)
+    request_irods_restart('hpss started')
+    return True
+
+def add_hpss_irods_user(module):
     pwnam = pwd.getpwnam('irods')
     module.run_command(['/opt/hpss/bin/hpssuser', '-add', 'irods', '-unix', '-gid', str(pwnam.pw_gid), '-uid', str(pwnam.pw_uid), '-group', 'irods', '-fullname', '"irods"', '-home', '/var/lib/irods', '-unixkeytab', '/var/hpss/etc/irods.keytab', '-shell', '/bin/bash', '-hpsshome', '/opt/hpss', '-password', 'notasecret'], check_rc=True)
+
+def prepare_irods_vault(module):
+    pwnam = pwd.getpwnam('irods')
     prepare_hpss_string = '''
 unlink /irodsVault recurse top
 mkdir /irodsVault
@@ -53,7 +111,10 @@ chgrp /irodsVault {1}
 quit
 '''.format(pwnam.pw_uid, pwnam.pw_gid)
     module.run_command(['/opt/hpss/bin/scrub', '-a', 'unix', '-k', '-t', '/var/hpss/etc/root.unix.keytab', '-p', 'root'], data=prepare_hpss_string, check_rc=True)
+
+def restart_irods(module):
     module.run_command(['service', 'irods', 'restart'])
+    wait_for_readiness(module, 'irods', irods_server_answers)
 
 def main():
     module = AnsibleModule(
@@ -71,11 +132,15 @@ def main():
     result = {
         'changed': True,
         'complex_args': module.params,
+        'trace_spans': trace_spans,
+        'readiness_waits': readiness_waits,
+        'irods_restarts': irods_restarts,
     }
 
     module.exit_json(**result)
 
 
+from ansible.module_utils.irods_plugin_testing_utils import *
 from ansible.module_utils.basic import *
 from ansible.module_utils.local_ansible_utils_extension import *
 main()
@@ -1,5 +1,6 @@
 #!/usr/bin/python
 
+import contextlib
 import glob
 import json
 import os
@@ -7,10 +8,23 @@ import pwd
 import shutil
 import socket
 import subprocess
+import time
+
+trace_spans = []
+
+@contextlib.contextmanager
+def trace_span(name):
+    start = time.time()
+    try:
+        yield
+    finally:
+        trace_spans.append({'name': name, 'start': start, 'end': time.time()})
 
 def run_tests(module, result):
-    install_testing_dependencies(module)
-    module.run_command(['sudo', 'su', '-', 'irods', '-c', 'cd tests/pydevtest; python run_tests.py --xml_output --run_specific_test test_irods_resource_plugin_wos'], check_rc=True)
+    with trace_span('install_testing_dependencies'):
+        install_testing_dependencies(module)
+    with trace_span('run_python_tests'):
+        run_python_tests(module, module.params['python_test_module_to_run'])
 
 def install_testing_dependencies(module):
     module.run_command('sudo apt-get update', check_rc=True)
@@ -20,8 +34,7 @@ def install_testing_dependencies(module):
     module.run_command(install_command, check_rc=True)
     # plugin package
     plugin_directory = os.path.join(module.params['plugin_root_directory'],get_irods_platform_string())
-    plugin_basename = filter(lambda x:module.params['package_prefix']+'-' in x, os.listdir(plugin_directory))[0]
-    package_name = os.path.join(plugin_directory, plugin_basename)
+    package_name = resolve_package(module, plugin_directory, module.params['package_prefix']+'-')
     install_command = ['sudo', 'dpkg', '-i'] + [package_name]
     module.run_command(install_command, check_rc=True)
 
@@ -31,6 +44,7 @@ def main():
             plugin_root_directory=dict(type='str', required=True),
             package_prefix=dict(type='str', required=True),
             output_directory=dict(type='str', required=True),
+            python_test_module_to_run=dict(type='str', default='test_irods_resource_plugin_wos'),
         ),
         supports_check_mode=False,
     )
@@ -40,10 +54,12 @@ def main():
 
     result['changed'] = True
     result['complex_args'] = module.params
+    result['trace_spans'] = trace_spans
 
     module.exit_json(**result)
 
 
+from ansible.module_utils.irods_plugin_testing_utils import *
 from ansible.module_utils.basic import *
 from ansible.module_utils.local_ansible_utils_extension import *
 main()
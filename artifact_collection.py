@@ -0,0 +1,27 @@
+import library
+import tracing
+
+
+def get_zone_server_ip_addresses(deployed_zone_bundle):
+    ip_addresses = []
+    for zone in deployed_zone_bundle['zones']:
+        for server in [zone['icat_server']] + zone.get('resource_servers', []):
+            ip_addresses.append(server['deployment_information']['ip_address'])
+    return ip_addresses
+
+@tracing.traced('collect_artifacts')
+def collect_from_zone(deployed_zone_bundle, output_directory, collection_rules):
+    complex_args = {
+        'output_directory': output_directory,
+        'collection_rules': collection_rules,
+    }
+    # one ansible run against every server, so the hosts copy their artifacts in parallel
+    ansible_results = library.run_ansible(module_name='irods_collect_artifacts', complex_args=complex_args, host_list=get_zone_server_ip_addresses(deployed_zone_bundle), sudo=True)
+    tracing.add_remote_spans(ansible_results)
+    return ansible_results
+
+def gather(deployed_zone_bundle, output_directory, collection_rules=None):
+    if collection_rules:
+        return collect_from_zone(deployed_zone_bundle, output_directory, collection_rules)
+    with tracing.span('gather'):
+        return library.gather(deployed_zone_bundle, output_directory)
@@ -0,0 +1,154 @@
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+
+import fake_library
+
+
+def get_platform_targets(count):
+    return [('Fake', str(i)) for i in range(count)]
+
+def make_irods_packages_root_directory(root_directory, platform_targets):
+    irods_packages_root_directory = os.path.join(root_directory, 'irods_packages')
+    for os_name, os_version in platform_targets:
+        irods_packages_directory = os.path.join(irods_packages_root_directory, '{0}_{1}'.format(os_name, os_version))
+        os.makedirs(irods_packages_directory)
+        for basename in ['irods-dev-4.2.0.deb', 'irods-runtime-4.2.0.deb']:
+            with open(os.path.join(irods_packages_directory, basename), 'w') as f:
+                f.write(basename)
+    return irods_packages_root_directory
+
+def make_zone_bundle(resource_server_count=0):
+    return {'zones': [{'icat_server': {}, 'resource_servers': [{} for _ in range(resource_server_count)]}]}
+
+def run_build(root_directory, size, **build_options):
+    import build
+    platform_targets = get_platform_targets(size)
+    irods_packages_root_directory = make_irods_packages_root_directory(root_directory, platform_targets)
+    build.build('benchmark', os.path.join(root_directory, 'build_output'), irods_packages_root_directory, 'https://example.invalid/plugin.git', '0' * 40,
+                repr(platform_targets), False, **build_options)
+
+def run_build_cached(root_directory, size):
+    import build
+    platform_targets = get_platform_targets(size)
+    irods_packages_root_directory = make_irods_packages_root_directory(root_directory, platform_targets)
+    artifact_cache_directory = os.path.join(root_directory, 'artifact_cache')
+    build.build('benchmark', os.path.join(root_directory, 'cold_build_output'), irods_packages_root_directory, 'https://example.invalid/plugin.git', '0' * 40,
+                repr(platform_targets), False, artifact_cache_directory=artifact_cache_directory)
+    start = time.time()
+    build.build('benchmark', os.path.join(root_directory, 'warm_build_output'), irods_packages_root_directory, 'https://example.invalid/plugin.git', '0' * 40,
+                repr(platform_targets), False, artifact_cache_directory=artifact_cache_directory)
+    return {'warm_wall_seconds': time.time() - start}
+
+def run_build_pooled(root_directory, size):
+    import build
+    import configuration
+    import vm_pool
+    platform_targets = get_platform_targets(size)
+    configuration.vm_pool_sizes = dict((platform_target, 1) for platform_target in platform_targets)
+    pool_directory = os.path.join(root_directory, 'vm_pool')
+    vm_pool.get_configured_pool(pool_directory).refill()
+    start = time.time()
+    irods_packages_root_directory = make_irods_packages_root_directory(root_directory, platform_targets)
+    build.build('benchmark', os.path.join(root_directory, 'build_output'), irods_packages_root_directory, 'https://example.invalid/plugin.git', '0' * 40,
+                repr(platform_targets), False, vm_pool_directory=pool_directory)
+    result = {'warm_wall_seconds': time.time() - start}
+    vm_pool.get_configured_pool(pool_directory).drain()
+    return result
+
+def run_test_sharded(root_directory, size):
+    import test
+    test_names = ['test_plugin.Test_{0}'.format(i) for i in range(size * 4)]
+    test.main_sharded(make_zone_bundle(), 'benchmark', os.path.join(root_directory, 'irods_packages'), os.path.join(root_directory, 'plugin_packages'), 'irods-resource-plugin-fake',
+                      None, 'irods_test_plugin', test_names, size, root_directory)
+
+def run_test_plan(root_directory, size):
+    import test
+    import zone_snapshot
+    test_plan = [{'ansible_module': 'irods_test_plugin', 'python_test_module': 'test_plugin_{0}'.format(i), 'plugin_package_prefix': 'irods-resource-plugin-fake-{0}'.format(i), 'reset_before': True}
+                 for i in range(size)]
+    snapshot_provider = zone_snapshot.FakeSnapshotProvider(fake_library)
+    entry_results = test.main_test_plan(make_zone_bundle(), 'benchmark', os.path.join(root_directory, 'irods_packages'), os.path.join(root_directory, 'plugin_packages'), None,
+                                        test_plan, root_directory, snapshot_provider)
+    # every entry after the first reverts the zone, so only the last entry's plugin is left installed
+    icat_ip = json.load(open(os.path.join(root_directory, 'deployed_zone.json')))['zones'][0]['icat_server']['deployment_information']['ip_address']
+    installed = fake_library.get_host(icat_ip)['state']['installed_plugin_package_prefixes']
+    if installed != [test_plan[-1]['plugin_package_prefix']]:
+        raise RuntimeError('zone reverts did not restore the fake hosts: {0} left installed'.format(installed))
+    return {'entries': len(entry_results), 'reverts': sum(1 for call in snapshot_provider.calls if call[0] == 'revert')}
+
+def run_reset_plugin_module(root_directory, size):
+    module = fake_library.FakeAnsibleModule({'plugin_package_prefixes': ['irods-resource-plugin-fake-{0}'.format(i) for i in range(size)]},
+                                            command_latency=fake_library.settings['ansible_latency'] / 10.0,
+                                            command_results={'-qa': (0, '\n'.join('irods-resource-plugin-fake-{0}'.format(i) for i in range(size)), '')})
+    fake_library.load_ansible_module('irods_reset_plugin', module)['main']()
+    return {'commands_run': len(module.commands)}
+
+scenarios = {
+    'build': run_build,
+    'build_per_host': lambda root_directory, size: run_build(root_directory, size, per_host=True),
+    'build_cached': run_build_cached,
+    'build_pooled': run_build_pooled,
+    'test_sharded': run_test_sharded,
+    'test_plan': run_test_plan,
+    'reset_plugin_module': run_reset_plugin_module,
+}
+
+def run_benchmark(scenario, size, latencies, keep_directories=False):
+    root_directory = tempfile.mkdtemp(prefix='benchmark_{0}_{1}_'.format(scenario, size))
+    fake_library.configure(os.path.join(root_directory, 'fake_library_state'), **latencies)
+    result = {'scenario': scenario, 'size': size}
+    start = time.time()
+    try:
+        result.update(scenarios[scenario](root_directory, size) or {})
+        result['succeeded'] = True
+    except Exception as e:
+        result['succeeded'] = False
+        result['error'] = str(e)
+    end = time.time()
+    result['wall_seconds'] = end - start
+    result.update(fake_library.summarize_events(fake_library.read_events(), end))
+    if not keep_directories:
+        shutil.rmtree(root_directory, ignore_errors=True)
+    return result
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure orchestration overhead of builds and test plans against in-process fake VM and ansible backends')
+    parser.add_argument('--scenarios', type=str, default=','.join(sorted(scenarios)))
+    parser.add_argument('--sizes', type=str, default='1,5,10', help='comma separated platform, shard or test plan entry counts')
+    parser.add_argument('--deploy_latency', type=float, default=0.5)
+    parser.add_argument('--destroy_latency', type=float, default=0.1)
+    parser.add_argument('--ansible_latency', type=float, default=1.0)
+    parser.add_argument('--ansible_latencies', type=json.loads, default={}, help='JSON object mapping ansible module names to latencies')
+    parser.add_argument('--zone_deploy_latency', type=float, default=0.5)
+    parser.add_argument('--gather_latency', type=float, default=0.1)
+    parser.add_argument('--failure_rate', type=float, default=0)
+    parser.add_argument('--failing_modules', type=str, default='')
+    parser.add_argument('--keep_directories', action='store_true', default=False)
+    parser.add_argument('--output_file', type=str, default=None)
+    args = parser.parse_args()
+
+    latencies = {
+        'deploy_latency': args.deploy_latency,
+        'destroy_latency': args.destroy_latency,
+        'ansible_latency': args.ansible_latency,
+        'ansible_latencies': args.ansible_latencies,
+        'zone_deploy_latency': args.zone_deploy_latency,
+        'gather_latency': args.gather_latency,
+        'failure_rate': args.failure_rate,
+        'failing_modules': [m for m in args.failing_modules.split(',') if m],
+    }
+    fake_library.install(tempfile.mkdtemp(prefix='benchmark_'), {'vm_pool_sizes': {}}, **latencies)
+
+    results = []
+    for scenario in args.scenarios.split(','):
+        for size in [int(s) for s in args.sizes.split(',')]:
+            result = run_benchmark(scenario, size, latencies, args.keep_directories)
+            print(json.dumps(result, sort_keys=True))
+            results.append(result)
+    if args.output_file:
+        with open(args.output_file, 'w') as f:
+            json.dump(results, f, indent=4, sort_keys=True)
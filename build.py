@@ -2,11 +2,19 @@ import argparse
 import contextlib
 import copy
 import json
+import logging
 import multiprocessing
 import os
+import threading
+import time
 
+import build_artifact_cache
 import configuration
+import git_mirror
+import job_scheduler
 import library
+import tracing
+import vm_pool
 
 
 @contextlib.contextmanager
@@ -16,45 +24,209 @@ def vm_manager(vm_names):
     finally:
         destroy_build_vms(vm_names)
 
-def build(build_name, output_root_directory, irods_packages_root_directory, git_repository, git_commitish, platform_targets, debug_build):
+def build(build_name, output_root_directory, irods_packages_root_directory, git_repository, git_commitish, platform_targets, debug_build, artifact_cache_directory=None, vm_pool_directory=None, git_mirror_cache_directory=None, compiler_cache_root_directory=None, build_jobs=0, per_host=False, fail_fast=False, platform_built_callback=None, build_output_collection_rules=None):
     os.makedirs(output_root_directory)
-    vm_names, ip_addresses = deploy_build_vms_return_names_and_ips(build_name, platform_targets, output_root_directory)
-    with vm_manager(vm_names):
-        build_plugin_on_vms(ip_addresses, output_root_directory, irods_packages_root_directory, git_repository, git_commitish, platform_targets, debug_build)
+#    platform_targets = [('CentOS', '6'), ('Ubuntu', '12'), ('Ubuntu', '14'), ('openSUSE ', '13')]
+    platform_targets = [tuple(platform_target) for platform_target in eval(platform_targets)]
+
+    git_checkout_plan = None
+    if git_mirror_cache_directory:
+        with tracing.span('prepare_git_mirror'):
+            git_checkout_plan = git_mirror.prepare_checkout_plan(git_mirror_cache_directory, git_repository, git_commitish)
+        git_commitish = git_checkout_plan['commit']
+
+    cache = None
+    cache_keys = dict((platform_target, None) for platform_target in platform_targets)
+    if artifact_cache_directory:
+        cache = build_artifact_cache.BuildArtifactCache(artifact_cache_directory)
+        with tracing.span('compute_artifact_cache_keys'):
+            commit_sha, cache_keys = build_artifact_cache.get_cache_keys(irods_packages_root_directory, git_repository, git_commitish, platform_targets, debug_build, build_output_collection_rules)
+        if commit_sha is not None:
+            git_commitish = commit_sha
+
+    platform_targets_to_build = []
+    for platform_target in platform_targets:
+        cache_key = cache_keys[platform_target]
+        output_directory = os.path.join(output_root_directory, build_artifact_cache.get_irods_platform_string(*platform_target))
+        with tracing.span('restore_from_artifact_cache', platform=list(platform_target)):
+            restored = cache_key is not None and cache.restore(cache_key, output_directory)
+        if restored:
+            logging.getLogger(__name__).info('build artifact cache hit for %s: %s', platform_target, cache_key)
+            if platform_built_callback is not None:
+                platform_built_callback(platform_target)
+        else:
+            platform_targets_to_build.append(platform_target)
+
+    if not platform_targets_to_build:
+        return
+
+    if per_host:
+        def on_platform_built(platform_target):
+            if cache is not None:
+                store_build_output_in_cache(cache, cache_keys, output_root_directory, git_repository, git_commitish, [platform_target], debug_build)
+            if platform_built_callback is not None:
+                platform_built_callback(platform_target)
+        complex_args = get_build_complex_args(output_root_directory, irods_packages_root_directory, git_repository, git_commitish, debug_build, git_checkout_plan, compiler_cache_root_directory, build_jobs, build_output_collection_rules)
+        if vm_pool_directory:
+            pool = vm_pool.get_configured_pool(vm_pool_directory)
+            with tracing.span('lease_build_vms'):
+                leases = pool.lease_many(platform_targets_to_build, build_name)
+            vms = [(platform_target, lease, lease['ip_address']) for platform_target, lease in zip(platform_targets_to_build, leases)]
+            build_plugin_on_vms_per_host(vms, lambda lease: pool.release(lease, reusable=True), complex_args, fail_fast, on_platform_built)
+        else:
+            vm_names, ip_addresses = deploy_build_vms_return_names_and_ips(build_name, platform_targets_to_build, output_root_directory)
+            vms = list(zip(platform_targets_to_build, vm_names, ip_addresses))
+            build_plugin_on_vms_per_host(vms, library.destroy_vm, complex_args, fail_fast, on_platform_built)
+        return
+
+    if vm_pool_directory:
+        pool = vm_pool.get_configured_pool(vm_pool_directory)
+        with tracing.span('lease_build_vms'):
+            leases = pool.lease_many(platform_targets_to_build, build_name)
+        with vm_pool.lease_manager(pool, leases, reusable=True):
+            ip_addresses = [lease['ip_address'] for lease in leases]
+            build_plugin_on_vms(ip_addresses, output_root_directory, irods_packages_root_directory, git_repository, git_commitish, platform_targets_to_build, debug_build, git_checkout_plan, compiler_cache_root_directory, build_jobs, build_output_collection_rules)
+    else:
+        vm_names, ip_addresses = deploy_build_vms_return_names_and_ips(build_name, platform_targets_to_build, output_root_directory)
+        with vm_manager(vm_names):
+            build_plugin_on_vms(ip_addresses, output_root_directory, irods_packages_root_directory, git_repository, git_commitish, platform_targets_to_build, debug_build, git_checkout_plan, compiler_cache_root_directory, build_jobs, build_output_collection_rules)
 
+    if cache is not None:
+        store_build_output_in_cache(cache, cache_keys, output_root_directory, git_repository, git_commitish, platform_targets_to_build, debug_build)
+    if platform_built_callback is not None:
+        for platform_target in platform_targets_to_build:
+            platform_built_callback(platform_target)
+
+@tracing.traced('store_in_artifact_cache')
+def store_build_output_in_cache(cache, cache_keys, output_root_directory, git_repository, commit_sha, platform_targets, debug_build):
+    for platform_target in platform_targets:
+        cache_key = cache_keys[platform_target]
+        if cache_key is None:
+            continue
+        metadata = {
+            'git_repository': git_repository,
+            'commit_sha': commit_sha,
+            'platform_target': list(platform_target),
+            'debug_build': debug_build,
+        }
+        output_directory = os.path.join(output_root_directory, build_artifact_cache.get_irods_platform_string(*platform_target))
+        cache.store(cache_key, output_directory, metadata)
+
+@tracing.traced('deploy_build_vms')
 def deploy_build_vms_return_names_and_ips(build_name, platform_targets, output_root_directory):
     def generate_vm_name(build_name, os_name, os_version):
         return '{0} :: {1}_{2}'.format(build_name, os_name, os_version)
 
-#    platform_targets = [('CentOS', '6'), ('Ubuntu', '12'), ('Ubuntu', '14'), ('openSUSE ', '13')]
-    platform_targets = eval(platform_targets)
     vm_names = [generate_vm_name(build_name, os_name, os_version) for os_name, os_version in platform_targets]
 
-    proc_pool = multiprocessing.Pool(len(platform_targets))
-    proc_pool_results = [proc_pool.apply_async(library.deploy_vm_return_ip,
-                                               (vm_name, (os_name, os_version)))
-                      for (os_name, os_version), vm_name in zip(platform_targets, vm_names)]
+    proc_pool = get_vm_operation_pool(len(platform_targets))
+    try:
+        proc_pool_results = [proc_pool.apply_async(library.deploy_vm_return_ip,
+                                                   (vm_name, (os_name, os_version)))
+                          for (os_name, os_version), vm_name in zip(platform_targets, vm_names)]
 
-    ip_addresses = [result.get() for result in proc_pool_results]
+        ip_addresses = [result.get() for result in proc_pool_results]
+    finally:
+        proc_pool.close()
+        proc_pool.join()
     return vm_names, ip_addresses
 
-def build_plugin_on_vms(ip_addresses, output_root_directory, irods_packages_root_directory, git_repository, git_commitish, platform_targets, debug_build):
-    complex_args = {
+def get_vm_operation_pool(vm_count):
+    return multiprocessing.Pool(max(1, min(vm_count, job_scheduler.get_max_parallel_vm_operations())))
+
+def get_build_complex_args(output_root_directory, irods_packages_root_directory, git_repository, git_commitish, debug_build, git_checkout_plan=None, compiler_cache_root_directory=None, build_jobs=0, build_output_collection_rules=None):
+    return {
         'output_root_directory': output_root_directory,
         'irods_packages_root_directory': irods_packages_root_directory,
         'git_repository': git_repository,
         'git_commitish': git_commitish,
         'debug_build': debug_build,
+        'git_checkout_plan': git_checkout_plan,
+        'compiler_cache_root_directory': compiler_cache_root_directory,
+        'build_jobs': build_jobs,
+        'build_output_collection_rules': build_output_collection_rules,
     }
 
-    library.run_ansible(module_name='irods_build_plugin', complex_args=complex_args, host_list=ip_addresses)
+@tracing.traced('build_plugin_on_vms')
+def build_plugin_on_vms(ip_addresses, output_root_directory, irods_packages_root_directory, git_repository, git_commitish, platform_targets, debug_build, git_checkout_plan=None, compiler_cache_root_directory=None, build_jobs=0, build_output_collection_rules=None):
+    complex_args = get_build_complex_args(output_root_directory, irods_packages_root_directory, git_repository, git_commitish, debug_build, git_checkout_plan, compiler_cache_root_directory, build_jobs, build_output_collection_rules)
+    ansible_results = library.run_ansible(module_name='irods_build_plugin', complex_args=complex_args, host_list=ip_addresses)
+    tracing.add_remote_spans(ansible_results)
 
+def build_plugin_on_host(complex_args, ip_address):
+    start = time.time()
+    try:
+        ansible_results = library.run_ansible(module_name='irods_build_plugin', complex_args=complex_args, host_list=[ip_address])
+    except Exception as e:
+        return start, time.time(), None, str(e)
+    return start, time.time(), ansible_results, None
+
+def build_plugin_on_vms_per_host(vms, release_vm, complex_args, fail_fast=False, on_platform_built=None):
+    # the VMs are already up, so every build gets a worker of its own; each VM is released as soon as its build finishes
+    proc_pool = multiprocessing.Pool(max(1, len(vms)))
+    finished_condition = threading.Condition()
+    def on_build_finished(_):
+        with finished_condition:
+            finished_condition.notify()
+
+    pending = {}
+    for platform_target, vm, ip_address in vms:
+        pending[platform_target] = (vm, proc_pool.apply_async(build_plugin_on_host, (complex_args, ip_address), callback=on_build_finished))
+    proc_pool.close()
+
+    timeout = getattr(configuration, 'per_host_build_timeout_seconds', None) or 6 * 3600
+    deadline = time.time() + timeout
+    failures = {}
+    try:
+        while pending and not (fail_fast and failures):
+            ready = [platform_target for platform_target, (_, result) in pending.items() if result.ready()]
+            if not ready:
+                if time.time() > deadline:
+                    raise RuntimeError('plugin builds did not finish within {0} seconds for platforms: {1}'.format(timeout, sorted(pending)))
+                with finished_condition:
+                    # the callback only wakes this loop early; builds whose result cannot be delivered are found by polling
+                    finished_condition.wait(1)
+                continue
+            for platform_target in ready:
+                vm, result = pending.pop(platform_target)
+                try:
+                    start, end, ansible_results, error = result.get()
+                    tracing.tracer.add_span('build_plugin', start, end, args={'platform': list(platform_target)})
+                    if error is not None:
+                        raise RuntimeError(error)
+                    tracing.add_remote_spans(ansible_results)
+                except Exception as e:
+                    logging.getLogger(__name__).error('build failed for %s: %s', platform_target, e)
+                    failures[platform_target] = e
+                else:
+                    logging.getLogger(__name__).info('build finished for %s', platform_target)
+                    if on_platform_built is not None:
+                        on_platform_built(platform_target)
+                finally:
+                    with tracing.span('release_build_vm', platform=list(platform_target)):
+                        release_vm(vm)
+    finally:
+        if pending:
+            proc_pool.terminate()
+            for platform_target, (vm, _) in pending.items():
+                logging.getLogger(__name__).info('cancelled build for %s', platform_target)
+                release_vm(vm)
+        proc_pool.join()
+
+    if failures:
+        raise RuntimeError('plugin build failed for platforms: {0}'.format(sorted(failures)))
+
+@tracing.traced('destroy_build_vms')
 def destroy_build_vms(vm_names):
-    proc_pool = multiprocessing.Pool(len(vm_names))
-    proc_pool_results = [proc_pool.apply_async(library.destroy_vm, (vm_name,))
-                         for vm_name in vm_names]
-    for result in proc_pool_results:
-        result.get()
+    proc_pool = get_vm_operation_pool(len(vm_names))
+    try:
+        proc_pool_results = [proc_pool.apply_async(library.destroy_vm, (vm_name,))
+                             for vm_name in vm_names]
+        for result in proc_pool_results:
+            result.get()
+    finally:
+        proc_pool.close()
+        proc_pool.join()
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Build plugin packages')
@@ -65,10 +237,28 @@ if __name__ == '__main__':
     parser.add_argument('--git_commitish', type=str, required=True)
     parser.add_argument('--platform_targets', type=str, required=True)
     parser.add_argument('--debug_build', dest='debug_build', action='store_true', default=False)
+    parser.add_argument('--artifact_cache_directory', type=str, required=False, default=getattr(configuration, 'build_artifact_cache_directory', None))
+    parser.add_argument('--no_artifact_cache', dest='artifact_cache_directory', action='store_const', const=None)
+    parser.add_argument('--git_mirror_cache_directory', type=str, required=False, default=getattr(configuration, 'git_mirror_cache_directory', None))
+    parser.add_argument('--compiler_cache_root_directory', type=str, required=False, default=getattr(configuration, 'compiler_cache_root_directory', None))
+    parser.add_argument('--build_jobs', type=int, required=False, default=0)
+    parser.add_argument('--per_host', dest='per_host', action='store_true', default=False)
+    parser.add_argument('--fail_fast', dest='fail_fast', action='store_true', default=False)
+    parser.add_argument('--vm_pool_directory', type=str, required=False, default=getattr(configuration, 'vm_pool_state_directory', None))
+    parser.add_argument('--build_output_collection_rules', type=json.loads, required=False, default=getattr(configuration, 'build_output_collection_rules', None), help='JSON object with include, exclude, max_file_size, compress and uncompressed rules for copying the build tree')
+    parser.add_argument('--job_scheduler_directory', type=str, required=False, default=getattr(configuration, 'job_scheduler_state_directory', None))
+    parser.add_argument('--job_priority', type=int, required=False, default=0, help='jobs with a higher priority are admitted first, e.g. release branches ahead of pull requests')
 
     args = parser.parse_args()
 
     library.register_log_handlers()
     library.convert_sigterm_to_exception()
 
-    build(args.build_name, args.output_root_directory, args.irods_packages_root_directory, args.git_repository, args.git_commitish, args.platform_targets, args.debug_build)
+    scheduler = job_scheduler.get_configured_scheduler(args.job_scheduler_directory)
+    demand = job_scheduler.get_configured_vm_demand(len(eval(args.platform_targets)))
+    try:
+        with job_scheduler.admitted_job(scheduler, args.build_name, 'build', demand, args.job_priority):
+            with tracing.span('build'):
+                build(args.build_name, args.output_root_directory, args.irods_packages_root_directory, args.git_repository, args.git_commitish, args.platform_targets, args.debug_build, args.artifact_cache_directory, args.vm_pool_directory, args.git_mirror_cache_directory, args.compiler_cache_root_directory, args.build_jobs, args.per_host, args.fail_fast, build_output_collection_rules=args.build_output_collection_rules)
+    finally:
+        tracing.write_trace(args.output_root_directory, 'build_trace.json')
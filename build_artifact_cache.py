@@ -0,0 +1,119 @@
+import hashlib
+import json
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+
+
+def get_irods_platform_string(os_name, os_version):
+    return '{0}_{1}'.format(os_name.strip(), os_version)
+
+def resolve_commit_sha(git_repository, git_commitish):
+    if re.match('^[0-9a-f]{40}$', git_commitish):
+        return git_commitish
+    if git_commitish.startswith('refs/'):
+        candidate_refs = [git_commitish]
+    else:
+        candidate_refs = ['refs/heads/' + git_commitish, 'refs/tags/' + git_commitish]
+    try:
+        out = subprocess.check_output(['git', 'ls-remote', git_repository] + [pattern for ref in candidate_refs for pattern in [ref, ref + '^{}']])
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    # ls-remote matches patterns by their tail, so only refs named exactly like a candidate count
+    ref_shas = {}
+    for line in out.decode('utf-8').splitlines():
+        sha, _, ref = line.partition('\t')
+        ref_shas[ref] = sha
+    shas = set()
+    for ref in candidate_refs:
+        sha = ref_shas.get(ref + '^{}', ref_shas.get(ref))
+        if sha is not None:
+            shas.add(sha)
+    if len(shas) != 1:
+        return None
+    return shas.pop()
+
+def hash_file(filename):
+    h = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def hash_irods_packages(irods_packages_directory):
+    if not os.path.isdir(irods_packages_directory):
+        return None
+    package_hashes = {}
+    for prefix in ['irods-dev-', 'irods-runtime-']:
+        basenames = sorted(filter(lambda x:prefix in x, os.listdir(irods_packages_directory)))
+        if not basenames:
+            return None
+        for basename in basenames:
+            package_hashes[basename] = hash_file(os.path.join(irods_packages_directory, basename))
+    return package_hashes
+
+def compute_cache_key(commit_sha, platform_target, debug_build, irods_package_hashes, build_output_collection_rules=None):
+    key_material = {
+        'commit_sha': commit_sha,
+        'platform_target': [platform_target[0].strip(), platform_target[1]],
+        'debug_build': bool(debug_build),
+        'irods_package_hashes': irods_package_hashes,
+        'build_output_collection_rules': build_output_collection_rules,
+    }
+    return hashlib.sha256(json.dumps(key_material, sort_keys=True).encode('utf-8')).hexdigest()
+
+class BuildArtifactCache(object):
+    metadata_filename = 'cache_entry.json'
+    artifacts_dirname = 'artifacts'
+
+    def __init__(self, cache_root_directory):
+        self.cache_root_directory = cache_root_directory
+
+    def entry_directory(self, cache_key):
+        return os.path.join(self.cache_root_directory, cache_key[:2], cache_key)
+
+    def has(self, cache_key):
+        return os.path.isfile(os.path.join(self.entry_directory(cache_key), self.metadata_filename))
+
+    def restore(self, cache_key, output_directory):
+        if not self.has(cache_key):
+            return False
+        shutil.copytree(os.path.join(self.entry_directory(cache_key), self.artifacts_dirname), output_directory)
+        return True
+
+    def store(self, cache_key, output_directory, metadata):
+        if self.has(cache_key) or not os.path.isdir(output_directory):
+            return False
+        entry_directory = self.entry_directory(cache_key)
+        entry_parent = os.path.dirname(entry_directory)
+        if not os.path.isdir(entry_parent):
+            os.makedirs(entry_parent)
+        staging_directory = tempfile.mkdtemp(prefix='.staging_', dir=entry_parent)
+        try:
+            shutil.copytree(output_directory, os.path.join(staging_directory, self.artifacts_dirname))
+            with open(os.path.join(staging_directory, self.metadata_filename), 'w') as f:
+                json.dump(metadata, f, indent=4, sort_keys=True)
+            os.rename(staging_directory, entry_directory)
+        except OSError:
+            shutil.rmtree(staging_directory, ignore_errors=True)
+            if self.has(cache_key):
+                return False
+            raise
+        return True
+
+def get_cache_keys(irods_packages_root_directory, git_repository, git_commitish, platform_targets, debug_build, build_output_collection_rules=None):
+    commit_sha = resolve_commit_sha(git_repository, git_commitish)
+    cache_keys = {}
+    for platform_target in platform_targets:
+        if commit_sha is None:
+            cache_keys[platform_target] = None
+            continue
+        irods_packages_directory = os.path.join(irods_packages_root_directory, get_irods_platform_string(*platform_target))
+        irods_package_hashes = hash_irods_packages(irods_packages_directory)
+        if irods_package_hashes is None:
+            cache_keys[platform_target] = None
+        else:
+            cache_keys[platform_target] = compute_cache_key(commit_sha, platform_target, debug_build, irods_package_hashes, build_output_collection_rules)
+    return commit_sha, cache_keys
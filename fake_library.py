@@ -0,0 +1,312 @@
+import contextlib
+import copy
+import glob
+import json
+import multiprocessing.pool
+import os
+import random
+import sys
+import threading
+import time
+import types
+import uuid
+
+
+# settings are module globals so that functions handed to multiprocessing pools pickle by name
+# and forked workers inherit them; events go to an append-only file shared by all workers
+settings = {
+    'state_directory': None,
+    'deploy_latency': 0,
+    'destroy_latency': 0,
+    'ansible_latency': 0,
+    'ansible_latencies': {},
+    'zone_deploy_latency': 0,
+    'gather_latency': 0,
+    'failure_rate': 0,
+    'failing_modules': [],
+    'failing_vm_names': [],
+}
+
+def configure(state_directory, **kwargs):
+    unknown = set(kwargs) - set(settings)
+    if unknown:
+        raise ValueError('unknown fake library settings: {0}'.format(sorted(unknown)))
+    if not os.path.isdir(state_directory):
+        os.makedirs(state_directory)
+    settings.update(kwargs)
+    settings['state_directory'] = state_directory
+
+def install(state_directory, configuration_attributes=None, **kwargs):
+    configure(state_directory, **kwargs)
+    configuration = types.ModuleType('configuration')
+    configuration.irods_testing_zone_bundle_module_path = None
+    for name, value in (configuration_attributes or {}).items():
+        setattr(configuration, name, value)
+    sys.modules['configuration'] = configuration
+    sys.modules['library'] = sys.modules[__name__]
+
+def record_event(event, **fields):
+    fields.update({'event': event, 'time': time.time(), 'pid': os.getpid()})
+    line = json.dumps(fields, sort_keys=True) + '\n'
+    fd = os.open(os.path.join(settings['state_directory'], 'events.jsonl'), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line.encode('utf-8'))
+    finally:
+        os.close(fd)
+
+def read_events():
+    events_file = os.path.join(settings['state_directory'], 'events.jsonl')
+    if not os.path.isfile(events_file):
+        return []
+    with open(events_file) as f:
+        return [json.loads(l) for l in f if l.strip()]
+
+def host_file(ip_address):
+    return os.path.join(settings['state_directory'], 'hosts', ip_address + '.json')
+
+host_state_lock = threading.Lock()
+
+def maybe_fail(description, injected):
+    if injected or random.Random(uuid.uuid4().int).random() < settings['failure_rate']:
+        record_event('injected_failure', description=description)
+        raise RuntimeError('injected failure: {0}'.format(description))
+
+def deploy_vm_return_ip(vm_name, platform_target):
+    record_event('deploy_start', vm_name=vm_name)
+    time.sleep(settings['deploy_latency'])
+    maybe_fail('deploy {0}'.format(vm_name), any(s in vm_name for s in settings['failing_vm_names']))
+    ip_address = '10.{0}.{1}.{2}'.format(*[random.Random(uuid.uuid4().int).randint(1, 254) for _ in range(3)])
+    if not os.path.isdir(os.path.dirname(host_file(ip_address))):
+        try:
+            os.makedirs(os.path.dirname(host_file(ip_address)))
+        except OSError:
+            pass
+    with host_state_lock:
+        with open(host_file(ip_address), 'w') as f:
+            json.dump({'vm_name': vm_name, 'platform_target': list(platform_target)}, f)
+    record_event('vm_up', vm_name=vm_name, ip_address=ip_address)
+    return ip_address
+
+def destroy_vm(vm_name):
+    time.sleep(settings['destroy_latency'])
+    record_event('vm_down', vm_name=vm_name)
+
+def get_host(ip_address):
+    with open(host_file(ip_address)) as f:
+        return json.load(f)
+
+def update_host_state(ip_address, function):
+    with host_state_lock:
+        host = get_host(ip_address)
+        function(host.setdefault('state', {}))
+        with open(host_file(ip_address), 'w') as f:
+            json.dump(host, f)
+
+def get_vm_ip_address(vm_name):
+    hosts_directory = os.path.dirname(host_file('0.0.0.0'))
+    for basename in os.listdir(hosts_directory):
+        ip_address = basename[:-len('.json')]
+        if get_host(ip_address)['vm_name'] == vm_name:
+            return ip_address
+    raise KeyError('no fake host for vm [{0}]'.format(vm_name))
+
+def get_vm_state(vm_name):
+    with host_state_lock:
+        return get_host(get_vm_ip_address(vm_name)).get('state', {})
+
+def set_vm_state(vm_name, state):
+    with host_state_lock:
+        ip_address = get_vm_ip_address(vm_name)
+        host = get_host(ip_address)
+        host['state'] = state
+        with open(host_file(ip_address), 'w') as f:
+            json.dump(host, f)
+    record_event('vm_state_set', vm_name=vm_name)
+
+def apply_module_to_host_state(module_name, complex_args, ip_address):
+    # the only state the fake hosts track is which plugin packages the test modules left installed
+    def apply_module(host_state):
+        installed = host_state.setdefault('installed_plugin_package_prefixes', [])
+        if module_name == 'irods_reset_plugin':
+            installed[:] = [prefix for prefix in installed if prefix not in complex_args['plugin_package_prefixes']]
+        elif 'plugin_package_prefix' in complex_args and complex_args['plugin_package_prefix'] not in installed:
+            installed.append(complex_args['plugin_package_prefix'])
+    update_host_state(ip_address, apply_module)
+
+def run_ansible(module_name, complex_args, host_list, sudo=False, **kwargs):
+    def run_on_host(ip_address):
+        start = time.time()
+        record_event('ansible_start', module_name=module_name, ip_address=ip_address)
+        try:
+            time.sleep(settings['ansible_latencies'].get(module_name, settings['ansible_latency']))
+            maybe_fail('{0} on {1}'.format(module_name, ip_address), module_name in settings['failing_modules'])
+            if module_name == 'irods_build_plugin':
+                write_fake_build_output(complex_args, get_host(ip_address)['platform_target'])
+            apply_module_to_host_state(module_name, complex_args, ip_address)
+        finally:
+            record_event('ansible_end', module_name=module_name, ip_address=ip_address)
+        return {'changed': True, 'complex_args': complex_args, 'trace_spans': [{'name': module_name, 'start': start, 'end': time.time()}]}
+
+    thread_pool = multiprocessing.pool.ThreadPool(max(1, len(host_list)))
+    try:
+        results = [thread_pool.apply_async(run_on_host, (ip_address,)) for ip_address in host_list]
+        contacted = dict((ip_address, result.get()) for ip_address, result in zip(host_list, results))
+    finally:
+        thread_pool.close()
+        thread_pool.join()
+    return {'contacted': contacted, 'dark': {}}
+
+def write_fake_build_output(complex_args, platform_target):
+    output_directory = os.path.join(complex_args['output_root_directory'], '{0}_{1}'.format(platform_target[0].strip(), platform_target[1]))
+    if not os.path.isdir(output_directory):
+        os.makedirs(output_directory)
+    with open(os.path.join(output_directory, 'irods-resource-plugin-fake-1.0.deb'), 'wb') as f:
+        f.write(os.urandom(1024))
+
+def get_zone_servers(zone_bundle):
+    servers = []
+    for zone in zone_bundle['zones']:
+        servers.extend([zone['icat_server']] + zone.get('resource_servers', []))
+    return servers
+
+def deploy(zone_bundle, deployment_name, version_to_packages_map, mungefs_packages_root_dir, zone_bundle_output_file):
+    deployed_zone_bundle = copy.deepcopy(zone_bundle)
+    servers = get_zone_servers(deployed_zone_bundle)
+    def deploy_server(i):
+        server = servers[i]
+        vm_name = '{0} :: server_{1}'.format(deployment_name, i)
+        ip_address = deploy_vm_return_ip(vm_name, server.get('host_system_information', {}).get('os_distribution', ('Fake', '1')))
+        time.sleep(settings['zone_deploy_latency'])
+        server['deployment_information'] = {'vm_name': vm_name, 'ip_address': ip_address}
+    thread_pool = multiprocessing.pool.ThreadPool(max(1, len(servers)))
+    try:
+        thread_pool.map(deploy_server, range(len(servers)))
+    finally:
+        thread_pool.close()
+        thread_pool.join()
+    with open(zone_bundle_output_file, 'w') as f:
+        json.dump(deployed_zone_bundle, f, indent=4, sort_keys=True)
+    return deployed_zone_bundle
+
+@contextlib.contextmanager
+def deployed_zone_bundle_manager(deployed_zone_bundle):
+    try:
+        yield
+    finally:
+        for server in get_zone_servers(deployed_zone_bundle):
+            if 'deployment_information' in server:
+                destroy_vm(server['deployment_information']['vm_name'])
+
+def gather(deployed_zone_bundle, output_directory):
+    record_event('gather_start')
+    time.sleep(settings['gather_latency'])
+    record_event('gather_end')
+
+def get_ansible_modules_directory():
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ansible_modules')
+
+def register_log_handlers():
+    pass
+
+def convert_sigterm_to_exception():
+    pass
+
+def format_ansible_output(ansible_results):
+    return json.dumps(ansible_results, indent=4, sort_keys=True)
+
+def summarize_events(events, end_time=None):
+    end_time = end_time or time.time()
+    vm_up = {}
+    vm_seconds = 0.0
+    vms_deployed = 0
+    peak_vms = 0
+    for event in sorted(events, key=lambda e: e['time']):
+        if event['event'] == 'vm_up':
+            vm_up[event['vm_name']] = event['time']
+            vms_deployed += 1
+            peak_vms = max(peak_vms, len(vm_up))
+        elif event['event'] == 'vm_down' and event['vm_name'] in vm_up:
+            vm_seconds += event['time'] - vm_up.pop(event['vm_name'])
+    vm_seconds += sum(end_time - t for t in vm_up.values())
+
+    running = 0
+    peak_concurrency = 0
+    boundaries = [(e['time'], 1 if e['event'] == 'ansible_start' else -1) for e in events if e['event'] in ['ansible_start', 'ansible_end']]
+    for _, delta in sorted(boundaries, key=lambda b: (b[0], b[1])):
+        running += delta
+        peak_concurrency = max(peak_concurrency, running)
+    return {
+        'vms_deployed': vms_deployed,
+        'vms_left_running': len(vm_up),
+        'peak_vms': peak_vms,
+        'vm_seconds': vm_seconds,
+        'ansible_runs': sum(1 for e in events if e['event'] == 'ansible_start'),
+        'peak_ansible_concurrency': peak_concurrency,
+        'injected_failures': sum(1 for e in events if e['event'] == 'injected_failure'),
+    }
+
+class FakeAnsibleModule(object):
+    # stands in for AnsibleModule when running a module's strategy code in-process
+    def __init__(self, params, command_latency=0, command_results=None, failing_commands=None):
+        self.params = params
+        self.command_latency = command_latency
+        self.command_results = command_results or {}
+        self.failing_commands = failing_commands or []
+        self.lock = threading.Lock()
+        self.commands = []
+        self.result = None
+
+    def run_command(self, args, check_rc=False, **kwargs):
+        command = ' '.join(args) if isinstance(args, list) else args
+        with self.lock:
+            self.commands.append(command)
+        time.sleep(self.command_latency)
+        rc, out, err = 0, '', ''
+        for pattern, command_result in self.command_results.items():
+            if pattern in command:
+                rc, out, err = command_result
+        if any(pattern in command for pattern in self.failing_commands):
+            rc, err = 1, 'injected failure'
+        if rc != 0 and check_rc:
+            self.fail_json(msg=err, cmd=command, rc=rc)
+        return rc, out, err
+
+    def bind(self, argument_spec, **kwargs):
+        for name, spec in argument_spec.items():
+            if name not in self.params:
+                if spec.get('required', False):
+                    self.fail_json(msg='missing required argument: {0}'.format(name))
+                self.params[name] = spec.get('default')
+        return self
+
+    def fail_json(self, **kwargs):
+        raise RuntimeError('module failed: {0}'.format(kwargs))
+
+    def exit_json(self, **kwargs):
+        self.result = kwargs
+
+def load_ansible_module(module_name, module, **helpers):
+    # runs a module's code in-process against a FakeAnsibleModule; only safe for modules
+    # whose side effects all go through module.run_command
+    module_file = os.path.join(get_ansible_modules_directory(), module_name + '.py')
+    with open(module_file) as f:
+        source = f.read()
+    source = source[:source.index('from ansible.module_utils.basic import *')]
+    # our own module_utils are inlined where they are imported, the way ansible does it
+    module_utils_directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ansible_module_utils')
+    for module_utils_file in glob.glob(os.path.join(module_utils_directory, '*.py')):
+        import_line = 'from ansible.module_utils.{0} import *\n'.format(os.path.basename(module_utils_file)[:-len('.py')])
+        if import_line in source:
+            with open(module_utils_file) as f:
+                source = source.replace(import_line, f.read() + '\n')
+    namespace = {
+        '__name__': module_name,
+        'AnsibleModule': module.bind,
+        'get_irods_version': lambda: (4, 2),
+        'get_irods_platform_string': lambda: 'Fake_1',
+        'install_os_packages': lambda packages: module.run_command(['install_os_packages'] + list(packages), check_rc=True),
+        'install_os_packages_from_files': lambda files: module.run_command(['install_os_packages_from_files'] + list(files), check_rc=True),
+    }
+    namespace.update(helpers)
+    exec(compile(source, module_file, 'exec'), namespace)
+    return namespace
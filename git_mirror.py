@@ -0,0 +1,97 @@
+import contextlib
+import fcntl
+import hashlib
+import logging
+import os
+import posixpath
+import re
+import subprocess
+
+
+def run_git(args, cwd=None):
+    return subprocess.check_output(['git'] + args, cwd=cwd, stderr=subprocess.STDOUT).decode('utf-8')
+
+def get_mirror_directory(cache_root_directory, git_repository):
+    basename = re.sub('[^A-Za-z0-9._-]', '_', git_repository.rstrip('/').rpartition('/')[2])
+    if not basename.endswith('.git'):
+        basename += '.git'
+    return os.path.join(cache_root_directory, '{0}_{1}'.format(hashlib.sha1(git_repository.encode('utf-8')).hexdigest()[:16], basename))
+
+@contextlib.contextmanager
+def mirror_lock(mirror_directory):
+    with open(mirror_directory + '.lock', 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def update_mirror(cache_root_directory, git_repository):
+    if not os.path.isdir(cache_root_directory):
+        os.makedirs(cache_root_directory)
+    mirror_directory = get_mirror_directory(cache_root_directory, git_repository)
+    with mirror_lock(mirror_directory):
+        if not os.path.isdir(mirror_directory):
+            run_git(['clone', '--mirror', git_repository, mirror_directory])
+            # allow build hosts to fetch a single commit by sha, and keep objects stable while they do
+            run_git(['config', 'uploadpack.allowAnySHA1InWant', 'true'], cwd=mirror_directory)
+            run_git(['config', 'uploadpack.allowReachableSHA1InWant', 'true'], cwd=mirror_directory)
+            run_git(['config', 'gc.auto', '0'], cwd=mirror_directory)
+        else:
+            try:
+                run_git(['fetch', '--prune', 'origin'], cwd=mirror_directory)
+            except subprocess.CalledProcessError as e:
+                logging.getLogger(__name__).warning('could not update git mirror of %s, using cached copy: %s', git_repository, e.output)
+    return mirror_directory
+
+def resolve_commit(mirror_directory, git_commitish):
+    for candidate in [git_commitish, 'origin/' + git_commitish]:
+        try:
+            return run_git(['rev-parse', '--verify', '{0}^{{commit}}'.format(candidate)], cwd=mirror_directory).strip()
+        except subprocess.CalledProcessError:
+            pass
+    raise RuntimeError('git commitish [{0}] not found in mirror [{1}]'.format(git_commitish, mirror_directory))
+
+def resolve_submodule_url(git_repository, submodule_url):
+    if not (submodule_url.startswith('./') or submodule_url.startswith('../')):
+        return submodule_url
+    scheme, separator, path = git_repository.rstrip('/').partition('://')
+    if not separator:
+        scheme, separator, path = '', '', scheme
+    return scheme + separator + posixpath.normpath(posixpath.join(path, submodule_url))
+
+def get_submodules(mirror_directory, commit):
+    try:
+        out = run_git(['config', '--blob', '{0}:.gitmodules'.format(commit), '--get-regexp', r'^submodule\..*\.(path|url)$'], cwd=mirror_directory)
+    except subprocess.CalledProcessError:
+        return []
+    submodules = {}
+    for line in out.splitlines():
+        key, _, value = line.partition(' ')
+        name, _, attribute = key[len('submodule.'):].rpartition('.')
+        submodules.setdefault(name, {})[attribute] = value
+    result = []
+    for name, submodule in sorted(submodules.items()):
+        if 'path' not in submodule or 'url' not in submodule:
+            continue
+        out = run_git(['ls-tree', commit, submodule['path']], cwd=mirror_directory).split()
+        if len(out) < 3 or out[1] != 'commit':
+            continue
+        result.append({'name': name, 'path': submodule['path'], 'url': submodule['url'], 'commit': out[2]})
+    return result
+
+def prepare_checkout_plan(cache_root_directory, git_repository, git_commitish):
+    mirror_directory = update_mirror(cache_root_directory, git_repository)
+    commit = resolve_commit(mirror_directory, git_commitish)
+    plan = {
+        'git_repository': git_repository,
+        'mirror_url': 'file://' + os.path.abspath(mirror_directory),
+        'commit': commit,
+        'submodules': [],
+    }
+    for submodule in get_submodules(mirror_directory, commit):
+        submodule_repository = resolve_submodule_url(git_repository, submodule['url'])
+        submodule_plan = prepare_checkout_plan(cache_root_directory, submodule_repository, submodule['commit'])
+        submodule_plan['path'] = submodule['path']
+        plan['submodules'].append(submodule_plan)
+    return plan
@@ -0,0 +1,200 @@
+import argparse
+import contextlib
+import errno
+import fcntl
+import json
+import logging
+import multiprocessing.pool
+import os
+import signal
+import socket
+import threading
+import time
+import uuid
+
+import tracing
+
+
+default_vm_resources = {'vms': 1, 'vcpus': 2, 'ram_mb': 4096}
+
+def get_vm_demand(vm_count, vm_resources=None):
+    vm_resources = dict(default_vm_resources, **(vm_resources or {}))
+    return dict((resource, amount * vm_count) for resource, amount in vm_resources.items())
+
+def process_is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+class JobScheduler(object):
+    def __init__(self, state_directory, capacity=None):
+        self.state_directory = state_directory
+        self.capacity = capacity or {}
+        self.state_lock = threading.Lock()
+        if not os.path.isdir(state_directory):
+            os.makedirs(state_directory)
+
+    @property
+    def state_file(self):
+        return os.path.join(self.state_directory, 'job_scheduler_state.json')
+
+    @contextlib.contextmanager
+    def locked_state(self):
+        with self.state_lock:
+            with open(os.path.join(self.state_directory, 'job_scheduler.lock'), 'a') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    if os.path.isfile(self.state_file):
+                        with open(self.state_file) as f:
+                            state = json.load(f)
+                    else:
+                        state = {'jobs': []}
+                    self.advance(state)
+                    yield state
+                    temporary_state_file = self.state_file + '.tmp'
+                    with open(temporary_state_file, 'w') as f:
+                        json.dump(state, f, indent=4, sort_keys=True)
+                    os.rename(temporary_state_file, self.state_file)
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def fits(self, used, demand):
+        for resource, limit in self.capacity.items():
+            if used.get(resource, 0) + demand.get(resource, 0) > limit:
+                return False
+        return True
+
+    def advance(self, state):
+        hostname = socket.gethostname()
+        live_jobs = []
+        for job in state['jobs']:
+            if job['hostname'] == hostname and not process_is_alive(job['pid']):
+                logging.getLogger(__name__).warning('removing job %s (%s), its process %s is gone', job['job_id'], job['name'], job['pid'])
+                continue
+            live_jobs.append(job)
+        state['jobs'] = live_jobs
+
+        used = {}
+        running_jobs = [job for job in state['jobs'] if job['state'] in ['running', 'cancelling']]
+        for job in running_jobs:
+            for resource, amount in job['demand'].items():
+                used[resource] = used.get(resource, 0) + amount
+        queued_jobs = sorted([job for job in state['jobs'] if job['state'] == 'queued'], key=lambda j: (-j['priority'], j['submitted_at']))
+        for job in queued_jobs:
+            # admit strictly in priority order so a large job is not starved by smaller ones behind it;
+            # a job larger than the whole capacity is admitted once nothing else is running
+            if not self.fits(used, job['demand']) and running_jobs:
+                break
+            job['state'] = 'running'
+            job['admitted_at'] = time.time()
+            running_jobs.append(job)
+            for resource, amount in job['demand'].items():
+                used[resource] = used.get(resource, 0) + amount
+
+    def submit(self, name, kind, demand, priority=0):
+        job = {
+            'job_id': uuid.uuid4().hex[:12],
+            'name': name,
+            'kind': kind,
+            'demand': demand,
+            'priority': priority,
+            'state': 'queued',
+            'hostname': socket.gethostname(),
+            'pid': os.getpid(),
+            'submitted_at': time.time(),
+        }
+        with self.locked_state() as state:
+            state['jobs'].append(job)
+            self.advance(state)
+        logging.getLogger(__name__).info('submitted %s job %s (%s) with priority %s and demand %s', kind, job['job_id'], name, priority, demand)
+        return job['job_id']
+
+    def get_job_state(self, job_id):
+        with self.locked_state() as state:
+            for job in state['jobs']:
+                if job['job_id'] == job_id:
+                    return job['state']
+        return None
+
+    def wait_for_admission(self, job_id, poll_interval=5):
+        start = time.time()
+        while True:
+            job_state = self.get_job_state(job_id)
+            if job_state == 'running':
+                logging.getLogger(__name__).info('job %s admitted after %.1f seconds', job_id, time.time() - start)
+                return
+            if job_state != 'queued':
+                self.finish(job_id)
+                raise RuntimeError('job {0} was cancelled before it was admitted'.format(job_id))
+            time.sleep(poll_interval)
+
+    def finish(self, job_id):
+        with self.locked_state() as state:
+            state['jobs'] = [job for job in state['jobs'] if job['job_id'] != job_id]
+            self.advance(state)
+
+    def cancel(self, job_id):
+        with self.locked_state() as state:
+            for job in state['jobs']:
+                if job['job_id'] != job_id:
+                    continue
+                if job['state'] == 'queued':
+                    job['state'] = 'cancelled'
+                elif job['state'] == 'running':
+                    job['state'] = 'cancelling'
+                    if job['hostname'] == socket.gethostname():
+                        # the CLIs convert SIGTERM into an exception, so the job releases its VMs on the way out
+                        os.kill(job['pid'], signal.SIGTERM)
+                return job['state']
+        raise KeyError('no such job: {0}'.format(job_id))
+
+    def status(self):
+        with self.locked_state() as state:
+            return {'capacity': self.capacity, 'jobs': sorted(state['jobs'], key=lambda j: (j['state'] != 'running', -j['priority'], j['submitted_at']))}
+
+@contextlib.contextmanager
+def admitted_job(scheduler, name, kind, demand, priority=0, poll_interval=5):
+    if scheduler is None:
+        yield None
+        return
+    job_id = scheduler.submit(name, kind, demand, priority)
+    try:
+        with tracing.span('wait_for_job_admission', job_id=job_id):
+            scheduler.wait_for_admission(job_id, poll_interval)
+        yield job_id
+    finally:
+        scheduler.finish(job_id)
+
+def get_configured_scheduler(state_directory):
+    if not state_directory:
+        return None
+    import configuration
+    return JobScheduler(state_directory, getattr(configuration, 'job_scheduler_capacity', {}))
+
+def get_configured_vm_demand(vm_count):
+    import configuration
+    return get_vm_demand(vm_count, getattr(configuration, 'job_scheduler_vm_resources', {}))
+
+def get_max_parallel_vm_operations():
+    import configuration
+    return getattr(configuration, 'max_parallel_vm_operations', None) or 8
+
+def get_vm_operation_thread_pool(operation_count):
+    return multiprocessing.pool.ThreadPool(max(1, min(operation_count, get_max_parallel_vm_operations())))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Inspect and cancel queued and running build and test jobs')
+    parser.add_argument('--state_directory', type=str, required=True)
+    parser.add_argument('--action', type=str, choices=['status', 'cancel'], default='status')
+    parser.add_argument('--job_id', type=str, required=False, default=None)
+    args = parser.parse_args()
+    if args.action == 'cancel' and not args.job_id:
+        parser.error('--job_id is required to cancel a job')
+
+    scheduler = get_configured_scheduler(args.state_directory)
+    if args.action == 'status':
+        print(json.dumps(scheduler.status(), indent=4, sort_keys=True))
+    elif args.action == 'cancel':
+        print(scheduler.cancel(args.job_id))
@@ -1,29 +1,152 @@
-import imp
+import atexit
+import importlib
+import json
 import os
-import yaml
-
-import ansible.constants
-ansible.constants.HOST_KEY_CHECKING = False
-import ansible.inventory
-import ansible.runner
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 
 import configuration
 
 
-module_tuple = imp.find_module('irods_testing_zone_bundle', [configuration.irods_testing_zone_bundle_module_path])
-imp.load_module('irods_testing_zone_bundle', *module_tuple)
-import irods_testing_zone_bundle
-from irods_testing_zone_bundle.gather import gather
-from irods_testing_zone_bundle.deploy import deploy
-from irods_testing_zone_bundle.destroy import deployed_zone_bundle_manager
-from irods_testing_zone_bundle.library import deploy_vm_return_ip
-from irods_testing_zone_bundle.library import destroy_vm
-from irods_testing_zone_bundle.library import format_ansible_output
-from irods_testing_zone_bundle.library import register_log_handlers
-from irods_testing_zone_bundle.library import convert_sigterm_to_exception
+# irods_testing_zone_bundle, ansible and yaml are only loaded on first use, so argument errors
+# and quick commands do not pay for them
+import_times = {}
+
+def timed_import(module_name, loader=None):
+    if module_name in sys.modules:
+        return sys.modules[module_name]
+    start = time.time()
+    module = loader() if loader is not None else importlib.import_module(module_name)
+    import_times[module_name] = time.time() - start
+    return module
+
+def load_irods_testing_zone_bundle():
+    import imp
+    module_tuple = imp.find_module('irods_testing_zone_bundle', [configuration.irods_testing_zone_bundle_module_path])
+    return imp.load_module('irods_testing_zone_bundle', *module_tuple)
+
+def get_zone_bundle_module(submodule_name=None):
+    if 'irods_testing_zone_bundle' not in sys.modules:
+        ansible_constants = timed_import('ansible.constants')
+        ansible_constants.HOST_KEY_CHECKING = False
+        configure_ansible_connections(ansible_constants)
+        timed_import('ansible.inventory')
+        timed_import('ansible.runner')
+        timed_import('yaml')
+        timed_import('irods_testing_zone_bundle', load_irods_testing_zone_bundle)
+    if submodule_name is None:
+        return sys.modules['irods_testing_zone_bundle']
+    return timed_import('irods_testing_zone_bundle.' + submodule_name)
+
+ssh_control_directory = None
+
+def configure_ansible_connections(ansible_constants):
+    # every ansible call of this run shares one OpenSSH master connection per host through
+    # ControlPersist; pipelining sends the module over that connection instead of copying it
+    global ssh_control_directory
+    control_persist = getattr(configuration, 'ansible_ssh_control_persist', None)
+    if control_persist is None:
+        control_persist = 600
+    if control_persist and not os.environ.get('ANSIBLE_SSH_ARGS'):
+        ssh_control_directory = tempfile.mkdtemp(prefix='ipt-ssh-')
+        atexit.register(close_ssh_connections)
+        ansible_constants.DEFAULT_TRANSPORT = 'ssh'
+        ansible_constants.ANSIBLE_SSH_ARGS = '-o ControlMaster=auto -o ControlPersist={0}s'.format(control_persist)
+        ansible_constants.ANSIBLE_SSH_CONTROL_PATH = os.path.join(ssh_control_directory, '%%h-%%p-%%r')
+    # pipelining needs sudo without requiretty on the hosts, so it is opt-in
+    if getattr(configuration, 'ansible_ssh_pipelining', None):
+        ansible_constants.ANSIBLE_SSH_PIPELINING = True
+
+def close_ssh_connections():
+    if ssh_control_directory is None or not os.path.isdir(ssh_control_directory):
+        return
+    with open(os.devnull, 'w') as devnull:
+        for control_socket in os.listdir(ssh_control_directory):
+            subprocess.call(['ssh', '-o', 'ControlPath={0}'.format(os.path.join(ssh_control_directory, control_socket)), '-O', 'exit', 'controlled-host'], stdout=devnull, stderr=devnull)
+    shutil.rmtree(ssh_control_directory, ignore_errors=True)
+
+def gather(*args, **kwargs):
+    return get_zone_bundle_module('gather').gather(*args, **kwargs)
+
+def deploy(*args, **kwargs):
+    return get_zone_bundle_module('deploy').deploy(*args, **kwargs)
+
+def deployed_zone_bundle_manager(*args, **kwargs):
+    return get_zone_bundle_module('destroy').deployed_zone_bundle_manager(*args, **kwargs)
+
+def deploy_vm_return_ip(*args, **kwargs):
+    return get_zone_bundle_module('library').deploy_vm_return_ip(*args, **kwargs)
+
+def destroy_vm(*args, **kwargs):
+    return get_zone_bundle_module('library').destroy_vm(*args, **kwargs)
+
+def format_ansible_output(*args, **kwargs):
+    return get_zone_bundle_module('library').format_ansible_output(*args, **kwargs)
+
+def register_log_handlers(*args, **kwargs):
+    return get_zone_bundle_module('library').register_log_handlers(*args, **kwargs)
+
+def convert_sigterm_to_exception(*args, **kwargs):
+    return get_zone_bundle_module('library').convert_sigterm_to_exception(*args, **kwargs)
 
 def get_ansible_modules_directory():
     return os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ansible_modules')
 
+def get_ansible_module_utils_directory():
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ansible_module_utils')
+
+ansible_module_utils_lock = threading.Lock()
+ansible_module_utils_installed = []
+
+def install_ansible_module_utils():
+    # ansible inlines `from ansible.module_utils.X import *` from its own module_utils directory, so the helpers
+    # shared by our modules are copied there, next to local_ansible_utils_extension
+    with ansible_module_utils_lock:
+        if ansible_module_utils_installed:
+            return
+        get_zone_bundle_module()
+        target_directory = os.path.dirname(timed_import('ansible.module_utils').__file__)
+        source_directory = get_ansible_module_utils_directory()
+        for basename in sorted(os.listdir(source_directory)):
+            if not basename.endswith('.py'):
+                continue
+            with open(os.path.join(source_directory, basename)) as f:
+                contents = f.read()
+            target_file = os.path.join(target_directory, basename)
+            if os.path.isfile(target_file):
+                with open(target_file) as f:
+                    if f.read() == contents:
+                        continue
+            fd, temporary_file = tempfile.mkstemp(prefix='.' + basename, dir=target_directory)
+            with os.fdopen(fd, 'w') as f:
+                f.write(contents)
+            os.chmod(temporary_file, 0o644)
+            os.rename(temporary_file, target_file)
+        ansible_module_utils_installed.append(target_directory)
+
 def run_ansible(*args, **kwargs):
-    return irods_testing_zone_bundle.library.run_ansible(*args, additional_modules_directories=[get_ansible_modules_directory()], **kwargs)
+    install_ansible_module_utils()
+    return get_zone_bundle_module('library').run_ansible(*args, additional_modules_directories=[get_ansible_modules_directory()], **kwargs)
+
+def measure_imports():
+    get_zone_bundle_module()
+    for submodule_name in ['library', 'gather', 'deploy', 'destroy']:
+        get_zone_bundle_module(submodule_name)
+    return dict(import_times)
+
+def report_import_times():
+    if import_times:
+        sys.stderr.write('library import times (seconds): {0}\n'.format(json.dumps(import_times, sort_keys=True)))
+
+if os.environ.get('IRODS_PLUGIN_TESTING_REPORT_IMPORT_TIMES'):
+    atexit.register(report_import_times)
+
+if __name__ == '__main__':
+    start = time.time()
+    measured_import_times = measure_imports()
+    measured_import_times['total'] = time.time() - start
+    print(json.dumps(measured_import_times, indent=4, sort_keys=True))
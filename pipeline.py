@@ -0,0 +1,123 @@
+import argparse
+import json
+import logging
+import os
+import threading
+import time
+
+import build
+import build_artifact_cache
+import configuration
+import job_scheduler
+import library
+import test
+import tracing
+import zone_snapshot
+
+
+class PipelineResults(object):
+    def __init__(self, results_file):
+        self.results_file = results_file
+        self.lock = threading.Lock()
+        self.results = {}
+
+    def record(self, platform_string, result):
+        with self.lock:
+            self.results[platform_string] = result
+            with open(self.results_file, 'w') as f:
+                json.dump(self.results, f, indent=4, sort_keys=True)
+        logging.getLogger(__name__).info('pipeline result for %s: %s', platform_string, 'succeeded' if result['succeeded'] else 'failed')
+
+def test_platform(platform_string, zone_bundle_file, deployment_name, irods_core_packages_root_directory, plugin_package_root_directory, mungefs_packages_root_dir, test_plan, test_output_directory, zone_snapshot_provider, pipeline_results, collection_rules=None):
+    start = time.time()
+    result = {'test_output_directory': test_output_directory}
+    try:
+        os.makedirs(test_output_directory)
+        with open(zone_bundle_file) as f:
+            zone_bundle = json.load(f)
+        with tracing.span('test_platform', platform=platform_string):
+            test.main_test_plan(zone_bundle, deployment_name, irods_core_packages_root_directory, plugin_package_root_directory, mungefs_packages_root_dir, test_plan, test_output_directory, zone_snapshot_provider, collection_rules)
+        result['succeeded'] = True
+    except Exception as e:
+        logging.getLogger(__name__).exception('testing failed for %s', platform_string)
+        result['succeeded'] = False
+        result['error'] = str(e)
+    result['seconds'] = time.time() - start
+    pipeline_results.record(platform_string, result)
+    return result['succeeded']
+
+def pipeline(build_name, output_root_directory, irods_packages_root_directory, git_repository, git_commitish, platform_targets, debug_build, zone_bundles, test_plan, test_output_root_directory, mungefs_packages_root_dir=None, fail_fast=False, zone_snapshot_provider=None, build_options=None, irods_core_packages_root_directory=None, collection_rules=None):
+    if not os.path.isdir(test_output_root_directory):
+        os.makedirs(test_output_root_directory)
+    pipeline_results = PipelineResults(os.path.join(test_output_root_directory, 'pipeline_results.json'))
+    test_threads = job_scheduler.get_vm_operation_thread_pool(len(zone_bundles))
+
+    def platform_built(platform_target):
+        platform_string = build_artifact_cache.get_irods_platform_string(*platform_target)
+        if platform_string not in zone_bundles:
+            logging.getLogger(__name__).warning('no zone bundle configured for %s, not testing it', platform_string)
+            return
+        test_threads.apply_async(test_platform, (platform_string, zone_bundles[platform_string], '{0}_{1}'.format(build_name, platform_string),
+                                                                    irods_core_packages_root_directory or irods_packages_root_directory, output_root_directory, mungefs_packages_root_dir, test_plan,
+                                                                    os.path.join(test_output_root_directory, platform_string), zone_snapshot_provider, pipeline_results, collection_rules))
+
+    try:
+        build.build(build_name, output_root_directory, irods_packages_root_directory, git_repository, git_commitish, platform_targets, debug_build,
+                    per_host=True, fail_fast=fail_fast, platform_built_callback=platform_built, **(build_options or {}))
+    finally:
+        test_threads.close()
+        test_threads.join()
+
+    failed_platforms = sorted(k for k, v in pipeline_results.results.items() if not v['succeeded'])
+    if failed_platforms:
+        raise RuntimeError('plugin tests failed for platforms: {0}'.format(failed_platforms))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build plugin packages and test each platform as soon as it is built')
+    parser.add_argument('--build_name', type=str, required=True)
+    parser.add_argument('--output_root_directory', type=str, required=True)
+    parser.add_argument('--irods_packages_root_directory', type=str, required=True)
+    parser.add_argument('--git_repository', type=str, required=True)
+    parser.add_argument('--git_commitish', type=str, required=True)
+    parser.add_argument('--platform_targets', type=str, required=True)
+    parser.add_argument('--debug_build', dest='debug_build', action='store_true', default=False)
+    parser.add_argument('--irods_core_packages_root_directory', type=str, required=False, default=None)
+    parser.add_argument('--zone_bundles', type=json.loads, required=True, help='JSON object mapping irods platform strings to zone bundle files')
+    parser.add_argument('--test_plan', type=str, required=True)
+    parser.add_argument('--test_output_root_directory', type=str, required=True)
+    parser.add_argument('--mungefs_packages_root_dir', type=str, required=False, default=None)
+    parser.add_argument('--fail_fast', dest='fail_fast', action='store_true', default=False)
+    parser.add_argument('--zone_snapshot_provider', type=str, required=False, choices=['govc', 'fake'], default=getattr(configuration, 'zone_snapshot_provider', None))
+    parser.add_argument('--artifact_cache_directory', type=str, required=False, default=getattr(configuration, 'build_artifact_cache_directory', None))
+    parser.add_argument('--git_mirror_cache_directory', type=str, required=False, default=getattr(configuration, 'git_mirror_cache_directory', None))
+    parser.add_argument('--compiler_cache_root_directory', type=str, required=False, default=getattr(configuration, 'compiler_cache_root_directory', None))
+    parser.add_argument('--vm_pool_directory', type=str, required=False, default=getattr(configuration, 'vm_pool_state_directory', None))
+    parser.add_argument('--build_output_collection_rules', type=json.loads, required=False, default=getattr(configuration, 'build_output_collection_rules', None))
+    parser.add_argument('--collection_rules', type=json.loads, required=False, default=getattr(configuration, 'artifact_collection_rules', None))
+    parser.add_argument('--job_scheduler_directory', type=str, required=False, default=getattr(configuration, 'job_scheduler_state_directory', None))
+    parser.add_argument('--job_priority', type=int, required=False, default=0, help='jobs with a higher priority are admitted first, e.g. release branches ahead of pull requests')
+    args = parser.parse_args()
+
+    library.register_log_handlers()
+    library.convert_sigterm_to_exception()
+
+    build_options = {
+        'artifact_cache_directory': args.artifact_cache_directory,
+        'vm_pool_directory': args.vm_pool_directory,
+        'git_mirror_cache_directory': args.git_mirror_cache_directory,
+        'compiler_cache_root_directory': args.compiler_cache_root_directory,
+        'build_output_collection_rules': args.build_output_collection_rules,
+    }
+    scheduler = job_scheduler.get_configured_scheduler(args.job_scheduler_directory)
+    vm_count = len(eval(args.platform_targets))
+    for zone_bundle_file in args.zone_bundles.values():
+        with open(zone_bundle_file) as f:
+            vm_count += test.get_zone_server_count(json.load(f))
+    try:
+        with job_scheduler.admitted_job(scheduler, args.build_name, 'pipeline', job_scheduler.get_configured_vm_demand(vm_count), args.job_priority):
+            with tracing.span('pipeline'):
+                pipeline(args.build_name, args.output_root_directory, args.irods_packages_root_directory, args.git_repository, args.git_commitish, args.platform_targets, args.debug_build,
+                         args.zone_bundles, test.read_test_plan(args.test_plan), args.test_output_root_directory, args.mungefs_packages_root_dir, args.fail_fast,
+                         zone_snapshot.get_snapshot_provider(args.zone_snapshot_provider) if args.zone_snapshot_provider else None, build_options, args.irods_core_packages_root_directory, args.collection_rules)
+    finally:
+        tracing.write_trace(args.test_output_root_directory, 'pipeline_trace.json')
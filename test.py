@@ -1,16 +1,25 @@
 import argparse
 import json
 import os
+import time
+import xml.etree.ElementTree as ET
 
+import artifact_collection
+import configuration
+import job_scheduler
 import library
+import test_results_database
+import tracing
+import zone_snapshot
 
 
-def main(zone_bundle, deployment_name, irods_core_packages_root_directory, plugin_package_root_directory, plugin_package_prefix, mungefs_packages_root_dir, ansible_module_to_run, python_test_module_to_run, output_directory):
+def main(zone_bundle, deployment_name, irods_core_packages_root_directory, plugin_package_root_directory, plugin_package_prefix, mungefs_packages_root_dir, ansible_module_to_run, python_test_module_to_run, output_directory, ansible_module_extra_args=None, collection_rules=None):
     zone_bundle_output_file = os.path.join(output_directory, 'deployed_zone.json')
     version_to_packages_map = {
         'deployment-determined': irods_core_packages_root_directory,
     }
-    deployed_zone_bundle = library.deploy(zone_bundle, deployment_name, version_to_packages_map, mungefs_packages_root_dir, zone_bundle_output_file)
+    with tracing.span('deploy_zone'):
+        deployed_zone_bundle = library.deploy(zone_bundle, deployment_name, version_to_packages_map, mungefs_packages_root_dir, zone_bundle_output_file)
     with library.deployed_zone_bundle_manager(deployed_zone_bundle):
         icat_ip = deployed_zone_bundle['zones'][0]['icat_server']['deployment_information']['ip_address']
 
@@ -20,11 +29,172 @@ def main(zone_bundle, deployment_name, irods_core_packages_root_directory, plugi
             'python_test_module_to_run': python_test_module_to_run,
             'output_directory': output_directory
         }
+        complex_args.update(ansible_module_extra_args or {})
 
         try:
-            library.run_ansible(module_name=ansible_module_to_run, complex_args=complex_args, host_list=[icat_ip], sudo=True)
+            with tracing.span('run_test_module', module=ansible_module_to_run):
+                ansible_results = library.run_ansible(module_name=ansible_module_to_run, complex_args=complex_args, host_list=[icat_ip], sudo=True)
+            tracing.add_remote_spans(ansible_results)
         finally:
-            library.gather(deployed_zone_bundle, output_directory)
+            artifact_collection.gather(deployed_zone_bundle, output_directory, collection_rules)
+
+def main_test_plan(zone_bundle, deployment_name, irods_core_packages_root_directory, plugin_package_root_directory, mungefs_packages_root_dir, test_plan, output_directory, zone_snapshot_provider=None, collection_rules=None):
+    zone_bundle_output_file = os.path.join(output_directory, 'deployed_zone.json')
+    version_to_packages_map = {
+        'deployment-determined': irods_core_packages_root_directory,
+    }
+    with tracing.span('deploy_zone'):
+        deployed_zone_bundle = library.deploy(zone_bundle, deployment_name, version_to_packages_map, mungefs_packages_root_dir, zone_bundle_output_file)
+    entry_results = []
+    with library.deployed_zone_bundle_manager(deployed_zone_bundle):
+        try:
+            if zone_snapshot_provider is not None:
+                with zone_snapshot.zone_snapshot_manager(zone_snapshot_provider, deployed_zone_bundle) as snapshots:
+                    with tracing.span('snapshot_zone'):
+                        snapshots.snapshot('after_deploy')
+                    run_test_plan_entries(deployed_zone_bundle, test_plan, plugin_package_root_directory, output_directory, entry_results, snapshots)
+            else:
+                run_test_plan_entries(deployed_zone_bundle, test_plan, plugin_package_root_directory, output_directory, entry_results)
+        finally:
+            with open(os.path.join(output_directory, 'test_plan_results.json'), 'w') as f:
+                json.dump(entry_results, f, indent=4, sort_keys=True)
+            artifact_collection.gather(deployed_zone_bundle, output_directory, collection_rules)
+
+    failed_entries = [r['entry'] for r in entry_results if not r['succeeded']]
+    if failed_entries:
+        raise RuntimeError('test plan entries failed: {0}'.format(failed_entries))
+    return entry_results
+
+def run_test_plan_entries(deployed_zone_bundle, test_plan, plugin_package_root_directory, output_directory, entry_results, snapshots=None):
+    icat_ip = deployed_zone_bundle['zones'][0]['icat_server']['deployment_information']['ip_address']
+    installed_plugin_package_prefixes = []
+    for i, entry in enumerate(test_plan):
+        entry_output_directory = os.path.join(output_directory, 'entry_{0}_{1}'.format(i, entry['ansible_module']))
+        if not os.path.isdir(entry_output_directory):
+            os.makedirs(entry_output_directory)
+        entry_result = {'entry': entry, 'output_directory': entry_output_directory}
+        start = time.time()
+        try:
+            if entry.get('reset_before', False) and installed_plugin_package_prefixes:
+                if snapshots is not None:
+                    with tracing.span('revert_zone', entry=i):
+                        snapshots.revert('after_deploy')
+                else:
+                    with tracing.span('reset_plugins', entry=i):
+                        library.run_ansible(module_name='irods_reset_plugin', complex_args={'plugin_package_prefixes': installed_plugin_package_prefixes}, host_list=[icat_ip], sudo=True)
+                installed_plugin_package_prefixes = []
+            complex_args = {
+                'plugin_package_root_directory': entry.get('plugin_package_root_directory', plugin_package_root_directory),
+                'plugin_package_prefix': entry['plugin_package_prefix'],
+                'python_test_module_to_run': entry['python_test_module'],
+                'output_directory': entry_output_directory,
+            }
+            complex_args.update(entry.get('extra_args', {}))
+            installed_plugin_package_prefixes.append(entry['plugin_package_prefix'])
+            with tracing.span('run_test_module', module=entry['ansible_module'], entry=i):
+                ansible_results = library.run_ansible(module_name=entry['ansible_module'], complex_args=complex_args, host_list=[icat_ip], sudo=True)
+            tracing.add_remote_spans(ansible_results)
+            entry_result['succeeded'] = True
+        except Exception as e:
+            entry_result['succeeded'] = False
+            entry_result['error'] = str(e)
+        entry_result['seconds'] = time.time() - start
+        entry_results.append(entry_result)
+
+def read_test_plan(test_plan_file):
+    with open(test_plan_file) as f:
+        test_plan = json.load(f)
+    for entry in test_plan:
+        for key in ['ansible_module', 'python_test_module', 'plugin_package_prefix']:
+            if key not in entry:
+                raise ValueError('test plan entry is missing [{0}]: {1}'.format(key, entry))
+    return test_plan
+
+def main_sharded(zone_bundle, deployment_name, irods_core_packages_root_directory, plugin_package_root_directory, plugin_package_prefix, mungefs_packages_root_dir, ansible_module_to_run, test_names, shard_count, output_directory, ansible_module_extra_args=None, results_database=None, results_platform='', collection_rules=None):
+    if results_database and os.path.isfile(results_database):
+        expected_durations = test_results_database.get_expected_durations(results_database, plugin_package_prefix, results_platform, test_names)
+        shards = [shard['test_names'] for shard in test_results_database.schedule_longest_processing_time_first(test_names, expected_durations, shard_count)]
+    else:
+        shards = split_into_shards(test_names, shard_count)
+    shard_output_directories = [os.path.join(output_directory, 'shard_{0}'.format(i)) for i in range(len(shards))]
+    for shard_output_directory in shard_output_directories:
+        if not os.path.isdir(shard_output_directory):
+            os.makedirs(shard_output_directory)
+
+    def run_shard(i):
+        with tracing.span('run_shard', shard=i):
+            main(zone_bundle, '{0}_shard_{1}'.format(deployment_name, i), irods_core_packages_root_directory, plugin_package_root_directory, plugin_package_prefix, mungefs_packages_root_dir, ansible_module_to_run, ' '.join(shards[i]), shard_output_directories[i], ansible_module_extra_args, collection_rules)
+
+    thread_pool = job_scheduler.get_vm_operation_thread_pool(len(shards))
+    try:
+        results = [thread_pool.apply_async(run_shard, (i,)) for i in range(len(shards))]
+        failed_shards = []
+        for i, result in enumerate(results):
+            try:
+                result.get()
+            except Exception:
+                failed_shards.append(i)
+    finally:
+        thread_pool.close()
+        thread_pool.join()
+        merge_junit_xml_reports(shard_output_directories, os.path.join(output_directory, 'merged_test_results.xml'))
+
+    if failed_shards:
+        raise RuntimeError('test shards failed: {0}'.format(failed_shards))
+
+def split_into_shards(test_names, shard_count):
+    shard_count = max(1, min(shard_count, len(test_names)))
+    shards = [[] for _ in range(shard_count)]
+    for i, test_name in enumerate(test_names):
+        shards[i % shard_count].append(test_name)
+    return shards
+
+def find_junit_xml_reports(directory):
+    reports = []
+    for root, _, files in os.walk(directory):
+        for f in sorted(files):
+            if f.endswith('.xml') and f != 'merged_test_results.xml':
+                reports.append(os.path.join(root, f))
+    return reports
+
+def merge_junit_xml_reports(directories, merged_report_file):
+    merged = ET.Element('testsuites')
+    totals = {'tests': 0, 'failures': 0, 'errors': 0, 'skipped': 0}
+    total_time = 0.0
+    for directory in directories:
+        for report in find_junit_xml_reports(directory):
+            try:
+                root = ET.parse(report).getroot()
+            except ET.ParseError:
+                continue
+            if root.tag == 'testsuite':
+                testsuites = [root]
+            elif root.tag == 'testsuites':
+                testsuites = root.findall('testsuite')
+            else:
+                continue
+            for testsuite in testsuites:
+                testsuite.set('shard', os.path.basename(directory))
+                for k in totals:
+                    totals[k] += int(testsuite.get(k, 0))
+                total_time += float(testsuite.get('time', 0))
+                merged.append(testsuite)
+    for k, v in totals.items():
+        merged.set(k, str(v))
+    merged.set('time', '{0:.3f}'.format(total_time))
+    ET.ElementTree(merged).write(merged_report_file, encoding='utf-8')
+    return totals
+
+def record_test_results(results_database, output_directory, plugin, git_commit, platform, test_name_prefixes=None):
+    with tracing.span('record_test_results'):
+        return test_results_database.ingest_junit_xml(results_database, find_junit_xml_reports(output_directory), plugin, git_commit, platform, test_name_prefixes)
+
+def get_zone_server_count(zone_bundle):
+    return sum(1 + len(zone.get('resource_servers', [])) for zone in zone_bundle['zones'])
+
+def read_test_names(test_names_file):
+    with open(test_names_file) as f:
+        return [l.strip() for l in f if l.strip() and not l.startswith('#')]
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Test a Plugin')
@@ -32,12 +202,28 @@ if __name__ == '__main__':
     parser.add_argument('--deployment_name', type=str, required=True)
     parser.add_argument('--irods_core_packages_root_directory', type=str, required=True)
     parser.add_argument('--plugin_package_root_directory', type=str, required=True)
-    parser.add_argument('--plugin_package_prefix', type=str, required=True)
+    parser.add_argument('--plugin_package_prefix', type=str, required=False, default=None)
     parser.add_argument('--mungefs_packages_root_dir', type=str, required=False, default=None)
-    parser.add_argument('--ansible_module_to_run', type=str, required=True)
-    parser.add_argument('--python_test_module_to_run', type=str, required=True)
+    parser.add_argument('--ansible_module_to_run', type=str, required=False, default=None)
+    parser.add_argument('--python_test_module_to_run', type=str, required=False, default=None)
+    parser.add_argument('--test_names_file', type=str, required=False, default=None)
+    parser.add_argument('--shard_count', type=int, required=False, default=1)
+    parser.add_argument('--test_plan', type=str, required=False, default=None, help='JSON list of {"ansible_module", "python_test_module", "plugin_package_prefix"} entries run against one zone')
+    parser.add_argument('--zone_snapshot_provider', type=str, required=False, choices=['govc', 'fake'], default=getattr(configuration, 'zone_snapshot_provider', None))
+    parser.add_argument('--results_database', type=str, required=False, default=getattr(configuration, 'test_results_database', None))
+    parser.add_argument('--results_commit', type=str, required=False, default='')
+    parser.add_argument('--results_platform', type=str, required=False, default='')
     parser.add_argument('--output_directory', type=str, required=True)
+    parser.add_argument('--ansible_module_extra_args', type=json.loads, required=False, default=None)
+    parser.add_argument('--collection_rules', type=json.loads, required=False, default=getattr(configuration, 'artifact_collection_rules', None), help='JSON object with source_directories, include, exclude, max_file_size, compress and uncompressed rules used instead of the zone bundle gather')
+    parser.add_argument('--job_scheduler_directory', type=str, required=False, default=getattr(configuration, 'job_scheduler_state_directory', None))
+    parser.add_argument('--job_priority', type=int, required=False, default=0, help='jobs with a higher priority are admitted first, e.g. release branches ahead of pull requests')
     args = parser.parse_args()
+    if args.test_plan is None:
+        if not args.python_test_module_to_run and not args.test_names_file:
+            parser.error('one of --python_test_module_to_run, --test_names_file or --test_plan is required')
+        if not args.ansible_module_to_run or not args.plugin_package_prefix:
+            parser.error('--ansible_module_to_run and --plugin_package_prefix are required without --test_plan')
 
     with open(args.zone_bundle_input) as f:
         zone_bundle = json.load(f)
@@ -45,4 +231,21 @@ if __name__ == '__main__':
     library.register_log_handlers()
     library.convert_sigterm_to_exception()
 
-    main(zone_bundle, args.deployment_name, args.irods_core_packages_root_directory, args.plugin_package_root_directory, args.plugin_package_prefix, args.mungefs_packages_root_dir, args.ansible_module_to_run, args.python_test_module_to_run, args.output_directory)
+    scheduler = job_scheduler.get_configured_scheduler(args.job_scheduler_directory)
+    demand = job_scheduler.get_configured_vm_demand(get_zone_server_count(zone_bundle) * (max(1, args.shard_count) if args.test_names_file and not args.test_plan else 1))
+    try:
+        with job_scheduler.admitted_job(scheduler, args.deployment_name, 'test', demand, args.job_priority):
+            with tracing.span('test'):
+                if args.test_plan:
+                    main_test_plan(zone_bundle, args.deployment_name, args.irods_core_packages_root_directory, args.plugin_package_root_directory, args.mungefs_packages_root_dir, read_test_plan(args.test_plan), args.output_directory, zone_snapshot.get_snapshot_provider(args.zone_snapshot_provider) if args.zone_snapshot_provider else None, args.collection_rules)
+                elif args.test_names_file:
+                    main_sharded(zone_bundle, args.deployment_name, args.irods_core_packages_root_directory, args.plugin_package_root_directory, args.plugin_package_prefix, args.mungefs_packages_root_dir, args.ansible_module_to_run, read_test_names(args.test_names_file), args.shard_count, args.output_directory, args.ansible_module_extra_args, args.results_database, args.results_platform, args.collection_rules)
+                else:
+                    main(zone_bundle, args.deployment_name, args.irods_core_packages_root_directory, args.plugin_package_root_directory, args.plugin_package_prefix, args.mungefs_packages_root_dir, args.ansible_module_to_run, args.python_test_module_to_run, args.output_directory, args.ansible_module_extra_args, args.collection_rules)
+    finally:
+        if args.results_database and args.test_plan:
+            for entry in read_test_plan(args.test_plan):
+                record_test_results(args.results_database, args.output_directory, entry['plugin_package_prefix'], args.results_commit, args.results_platform, entry['python_test_module'].split())
+        elif args.results_database:
+            record_test_results(args.results_database, args.output_directory, args.plugin_package_prefix, args.results_commit, args.results_platform)
+        tracing.write_trace(args.output_directory, 'test_trace.json')
@@ -0,0 +1,144 @@
+import argparse
+import contextlib
+import json
+import sqlite3
+import time
+import xml.etree.ElementTree as ET
+
+
+schema = '''
+CREATE TABLE IF NOT EXISTS test_results (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    plugin TEXT NOT NULL,
+    git_commit TEXT NOT NULL,
+    platform TEXT NOT NULL,
+    test_case TEXT NOT NULL,
+    duration REAL NOT NULL,
+    outcome TEXT NOT NULL,
+    recorded_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS test_results_lookup ON test_results (plugin, platform, test_case, recorded_at);
+'''
+
+@contextlib.contextmanager
+def open_database(database_file):
+    connection = sqlite3.connect(database_file, timeout=60)
+    try:
+        connection.executescript(schema)
+        yield connection
+        connection.commit()
+    finally:
+        connection.close()
+
+def parse_junit_xml(report_file):
+    try:
+        root = ET.parse(report_file).getroot()
+    except ET.ParseError:
+        return []
+    results = []
+    for testcase in root.iter('testcase'):
+        classname = testcase.get('classname', '')
+        name = testcase.get('name', '')
+        test_case = '{0}.{1}'.format(classname, name) if classname else name
+        if testcase.find('failure') is not None:
+            outcome = 'failure'
+        elif testcase.find('error') is not None:
+            outcome = 'error'
+        elif testcase.find('skipped') is not None:
+            outcome = 'skipped'
+        else:
+            outcome = 'success'
+        results.append({'test_case': test_case, 'duration': float(testcase.get('time', 0) or 0), 'outcome': outcome})
+    return results
+
+def normalize_test_name(test_name):
+    # iRODS 4.2 runs the tests as modules of the irods.test package, and the reports name them that way
+    if test_name.startswith('irods.test.'):
+        return test_name[len('irods.test.'):]
+    return test_name
+
+def ingest_junit_xml(database_file, report_files, plugin, git_commit, platform, test_name_prefixes=None):
+    recorded_at = time.time()
+    if test_name_prefixes is not None:
+        test_name_prefixes = [normalize_test_name(p) for p in test_name_prefixes]
+    rows = []
+    for report_file in report_files:
+        for result in parse_junit_xml(report_file):
+            test_case = normalize_test_name(result['test_case'])
+            if test_name_prefixes is not None and not any(test_case == p or test_case.startswith(p + '.') for p in test_name_prefixes):
+                continue
+            rows.append((plugin, git_commit, platform, test_case, result['duration'], result['outcome'], recorded_at))
+    with open_database(database_file) as connection:
+        connection.executemany('INSERT INTO test_results (plugin, git_commit, platform, test_case, duration, outcome, recorded_at) VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+    return len(rows)
+
+def median(values):
+    values = sorted(values)
+    if not values:
+        return None
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+def get_recent_durations(database_file, plugin, platform, history=5):
+    with open_database(database_file) as connection:
+        rows = connection.execute('SELECT test_case, duration FROM test_results WHERE plugin = ? AND platform = ? AND outcome != ? ORDER BY recorded_at DESC',
+                                  (plugin, platform, 'skipped')).fetchall()
+    durations = {}
+    for test_case, duration in rows:
+        test_case_durations = durations.setdefault(normalize_test_name(test_case), [])
+        if len(test_case_durations) < history:
+            test_case_durations.append(duration)
+    return durations
+
+def get_expected_durations(database_file, plugin, platform, test_names, history=5):
+    recent_durations = get_recent_durations(database_file, plugin, platform, history)
+    expected = {}
+    for test_name in test_names:
+        # a test name may be a module or class prefix of the recorded test cases
+        normalized_test_name = normalize_test_name(test_name)
+        matching = [median(d) for test_case, d in recent_durations.items() if test_case == normalized_test_name or test_case.startswith(normalized_test_name + '.')]
+        expected[test_name] = sum(matching) if matching else None
+    known = [d for d in expected.values() if d is not None]
+    default = median(known) if known else 1.0
+    return dict((test_name, d if d is not None else default) for test_name, d in expected.items())
+
+def schedule_longest_processing_time_first(test_names, expected_durations, shard_count):
+    shard_count = max(1, min(shard_count, len(test_names)))
+    shards = [{'test_names': [], 'expected_duration': 0.0} for _ in range(shard_count)]
+    for test_name in sorted(test_names, key=lambda t: (-expected_durations[t], t)):
+        shard = min(shards, key=lambda s: s['expected_duration'])
+        shard['test_names'].append(test_name)
+        shard['expected_duration'] += expected_durations[test_name]
+    return shards
+
+def find_duration_regressions(database_file, plugin, platform, history=5, threshold=1.5, minimum_duration=1.0):
+    with open_database(database_file) as connection:
+        rows = connection.execute('SELECT test_case, duration, git_commit FROM test_results WHERE plugin = ? AND platform = ? AND outcome = ? ORDER BY recorded_at DESC',
+                                  (plugin, platform, 'success')).fetchall()
+    runs = {}
+    for test_case, duration, git_commit in rows:
+        test_case_runs = runs.setdefault(normalize_test_name(test_case), [])
+        if len(test_case_runs) < history + 1:
+            test_case_runs.append((duration, git_commit))
+    regressions = []
+    for test_case, test_case_runs in sorted(runs.items()):
+        if len(test_case_runs) < 2:
+            continue
+        latest_duration, latest_commit = test_case_runs[0]
+        baseline = median([d for d, _ in test_case_runs[1:]])
+        if latest_duration >= minimum_duration and latest_duration > baseline * threshold:
+            regressions.append({'test_case': test_case, 'git_commit': latest_commit, 'duration': latest_duration, 'baseline_duration': baseline})
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Query the plugin test results database')
+    parser.add_argument('--database', type=str, required=True)
+    parser.add_argument('--plugin', type=str, required=True)
+    parser.add_argument('--platform', type=str, required=True)
+    parser.add_argument('--history', type=int, default=5)
+    parser.add_argument('--threshold', type=float, default=1.5)
+    args = parser.parse_args()
+
+    print(json.dumps(find_duration_regressions(args.database, args.plugin, args.platform, args.history, args.threshold), indent=4, sort_keys=True))
@@ -0,0 +1,68 @@
+import signal
+import subprocess
+import sys
+
+import pytest
+
+import job_scheduler
+
+
+def set_job_pid(scheduler, job_id, pid):
+    with scheduler.locked_state() as state:
+        for job in state['jobs']:
+            if job['job_id'] == job_id:
+                job['pid'] = pid
+
+def start_sleeping_process():
+    return subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(60)'])
+
+def test_queued_jobs_are_admitted_in_priority_order(tmpdir):
+    scheduler = job_scheduler.JobScheduler(str(tmpdir), {'vms': 2})
+    running = scheduler.submit('running', 'build', {'vms': 2})
+    low = scheduler.submit('low', 'build', {'vms': 2}, priority=0)
+    high = scheduler.submit('high', 'build', {'vms': 2}, priority=5)
+    assert [scheduler.get_job_state(job_id) for job_id in [running, low, high]] == ['running', 'queued', 'queued']
+    scheduler.finish(running)
+    assert [scheduler.get_job_state(job_id) for job_id in [low, high]] == ['queued', 'running']
+    scheduler.finish(high)
+    assert scheduler.get_job_state(low) == 'running'
+
+def test_smaller_jobs_do_not_overtake_a_queued_larger_one(tmpdir):
+    scheduler = job_scheduler.JobScheduler(str(tmpdir), {'vms': 3})
+    running = scheduler.submit('running', 'build', {'vms': 2})
+    large = scheduler.submit('large', 'test', {'vms': 3})
+    small = scheduler.submit('small', 'build', {'vms': 1})
+    assert [scheduler.get_job_state(job_id) for job_id in [running, large, small]] == ['running', 'queued', 'queued']
+
+def test_cancelling_a_queued_job_stops_its_admission(tmpdir):
+    scheduler = job_scheduler.JobScheduler(str(tmpdir), {'vms': 1})
+    scheduler.submit('running', 'build', {'vms': 1})
+    queued = scheduler.submit('queued', 'build', {'vms': 1})
+    assert scheduler.cancel(queued) == 'cancelled'
+    with pytest.raises(RuntimeError):
+        scheduler.wait_for_admission(queued, poll_interval=0)
+    assert scheduler.get_job_state(queued) is None
+
+def test_cancelling_a_running_job_sends_it_sigterm(tmpdir):
+    scheduler = job_scheduler.JobScheduler(str(tmpdir), {'vms': 1})
+    job_id = scheduler.submit('running', 'build', {'vms': 1})
+    process = start_sleeping_process()
+    try:
+        set_job_pid(scheduler, job_id, process.pid)
+        assert scheduler.cancel(job_id) == 'cancelling'
+        assert process.wait() == -signal.SIGTERM
+    finally:
+        if process.poll() is None:
+            process.kill()
+
+def test_jobs_of_crashed_processes_are_reaped(tmpdir):
+    scheduler = job_scheduler.JobScheduler(str(tmpdir), {'vms': 1})
+    crashed = scheduler.submit('crashed', 'build', {'vms': 1})
+    process = start_sleeping_process()
+    set_job_pid(scheduler, crashed, process.pid)
+    waiting = scheduler.submit('waiting', 'build', {'vms': 1})
+    assert scheduler.get_job_state(waiting) == 'queued'
+    process.kill()
+    process.wait()
+    assert scheduler.get_job_state(crashed) is None
+    assert scheduler.get_job_state(waiting) == 'running'
@@ -0,0 +1,38 @@
+import os
+
+import test_results_database
+
+
+def write_junit_xml(report_file, test_cases):
+    with open(report_file, 'w') as f:
+        f.write('<testsuite>\n')
+        for classname, name, duration in test_cases:
+            f.write('<testcase classname="{0}" name="{1}" time="{2}"/>\n'.format(classname, name, duration))
+        f.write('</testsuite>\n')
+
+def test_longest_processing_time_first_is_deterministic():
+    test_names = ['test_{0}'.format(i) for i in range(20)]
+    expected_durations = dict((test_name, float(i % 7 + 1)) for i, test_name in enumerate(test_names))
+    shards = test_results_database.schedule_longest_processing_time_first(test_names, expected_durations, 4)
+    assert shards == test_results_database.schedule_longest_processing_time_first(list(reversed(test_names)), expected_durations, 4)
+    assert sorted(t for shard in shards for t in shard['test_names']) == sorted(test_names)
+    shard_durations = [shard['expected_duration'] for shard in shards]
+    assert max(shard_durations) - min(shard_durations) <= max(expected_durations.values())
+
+def test_longest_processing_time_first_balances_shards():
+    expected_durations = {'a': 10.0, 'b': 6.0, 'c': 5.0, 'd': 4.0, 'e': 3.0, 'f': 2.0}
+    shards = test_results_database.schedule_longest_processing_time_first(sorted(expected_durations), expected_durations, 3)
+    assert [shard['test_names'] for shard in shards] == [['a'], ['b', 'e', 'f'], ['c', 'd']]
+    assert [shard['expected_duration'] for shard in shards] == [10.0, 11.0, 9.0]
+
+def test_longest_processing_time_first_uses_no_more_shards_than_tests():
+    shards = test_results_database.schedule_longest_processing_time_first(['a', 'b'], {'a': 1.0, 'b': 1.0}, 5)
+    assert len(shards) == 2
+
+def test_irods_42_test_names_match_recorded_durations(tmpdir):
+    database_file = str(tmpdir.join('results.sqlite'))
+    report_file = str(tmpdir.join('report.xml'))
+    write_junit_xml(report_file, [('irods.test.test_plugin.TestPlugin', 'test_put', 8.0), ('irods.test.test_other.TestOther', 'test_get', 1.0)])
+    assert test_results_database.ingest_junit_xml(database_file, [report_file], 'plugin', 'abc', 'Ubuntu_16', ['irods.test.test_plugin']) == 1
+    expected_durations = test_results_database.get_expected_durations(database_file, 'plugin', 'Ubuntu_16', ['test_plugin', 'irods.test.test_plugin', 'test_unknown'])
+    assert expected_durations == {'test_plugin': 8.0, 'irods.test.test_plugin': 8.0, 'test_unknown': 8.0}
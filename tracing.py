@@ -0,0 +1,75 @@
+import contextlib
+import functools
+import json
+import os
+import threading
+import time
+
+
+class Tracer(object):
+    def __init__(self, process_name='controller'):
+        self.lock = threading.Lock()
+        self.events = []
+        self.process_ids = {}
+        self.process_name = process_name
+
+    def get_process_id(self, process_name):
+        with self.lock:
+            if process_name not in self.process_ids:
+                self.process_ids[process_name] = len(self.process_ids) + 1
+                self.events.append({'name': 'process_name', 'ph': 'M', 'pid': self.process_ids[process_name], 'tid': 0,
+                                    'args': {'name': process_name}})
+            return self.process_ids[process_name]
+
+    @contextlib.contextmanager
+    def span(self, name, **args):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add_span(name, start, time.time(), args=args)
+
+    def add_span(self, name, start, end, process_name=None, thread_id=None, args=None):
+        event = {
+            'name': name,
+            'ph': 'X',
+            'ts': int(start * 1000000),
+            'dur': int((end - start) * 1000000),
+            'pid': self.get_process_id(process_name or self.process_name),
+            'tid': thread_id if thread_id is not None else threading.current_thread().ident % 100000,
+            'args': args or {},
+        }
+        with self.lock:
+            self.events.append(event)
+
+    def add_remote_spans(self, ansible_results):
+        if not isinstance(ansible_results, dict):
+            return
+        for host, result in ansible_results.get('contacted', {}).items():
+            if not isinstance(result, dict):
+                continue
+            for span in result.get('trace_spans', []):
+                self.add_span(span['name'], span['start'], span['end'], process_name=host, thread_id=0, args=span.get('args'))
+
+    def write(self, filename):
+        with self.lock:
+            trace = {'traceEvents': list(self.events), 'displayTimeUnit': 'ms'}
+        with open(filename, 'w') as f:
+            json.dump(trace, f, indent=4, sort_keys=True)
+
+def traced(name):
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with tracer.span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+tracer = Tracer()
+span = tracer.span
+add_remote_spans = tracer.add_remote_spans
+
+def write_trace(output_directory, basename):
+    if os.path.isdir(output_directory):
+        tracer.write(os.path.join(output_directory, basename))
@@ -0,0 +1,400 @@
+import argparse
+import contextlib
+import fcntl
+import functools
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+
+import job_scheduler
+
+
+ready_snapshot_name = 'vm_pool_ready'
+
+class VSphereVMProvider(object):
+    def __init__(self, snapshot_provider=None):
+        self.snapshot_provider = snapshot_provider
+
+    def deploy(self, vm_name, platform_target):
+        import library
+        return library.deploy_vm_return_ip(vm_name, platform_target)
+
+    def destroy(self, vm_name):
+        import library
+        library.destroy_vm(vm_name)
+
+    def save_ready_state(self, vm_name):
+        if self.snapshot_provider is not None:
+            self.snapshot_provider.create(vm_name, ready_snapshot_name)
+
+    def reset(self, vm_name, ip_address):
+        # irods_testing_zone_bundle has no snapshot revert, so without a snapshot provider leased VMs are recycled
+        if self.snapshot_provider is None:
+            return False
+        self.snapshot_provider.revert(vm_name, ready_snapshot_name)
+        return True
+
+class FakeVMProvider(object):
+    def __init__(self, deploy_latency=0, destroy_latency=0, reset_latency=0, supports_reset=True):
+        self.deploy_latency = deploy_latency
+        self.destroy_latency = destroy_latency
+        self.reset_latency = reset_latency
+        self.supports_reset = supports_reset
+        self.lock = threading.Lock()
+        self.vms = {}
+        self.deploy_count = 0
+        self.destroy_count = 0
+        self.reset_count = 0
+
+    def deploy(self, vm_name, platform_target):
+        time.sleep(self.deploy_latency)
+        with self.lock:
+            self.deploy_count += 1
+            ip_address = '10.{0}.{1}.{2}'.format(self.deploy_count // 65536 % 256, self.deploy_count // 256 % 256, self.deploy_count % 256)
+            self.vms[vm_name] = {'ip_address': ip_address, 'platform_target': tuple(platform_target)}
+        return ip_address
+
+    def destroy(self, vm_name):
+        time.sleep(self.destroy_latency)
+        with self.lock:
+            self.destroy_count += 1
+            del self.vms[vm_name]
+
+    def save_ready_state(self, vm_name):
+        with self.lock:
+            self.vms[vm_name]['ready'] = True
+
+    def reset(self, vm_name, ip_address):
+        if not self.supports_reset:
+            return False
+        time.sleep(self.reset_latency)
+        with self.lock:
+            self.reset_count += 1
+            return vm_name in self.vms and self.vms[vm_name].get('ready', False)
+
+def platform_key(platform_target):
+    return '{0}_{1}'.format(platform_target[0].strip(), platform_target[1])
+
+class VMPool(object):
+    def __init__(self, state_directory, provider, pool_sizes=None, name_prefix='vm_pool', prepare_vm=None):
+        self.state_directory = state_directory
+        self.provider = provider
+        self.pool_sizes = dict((tuple(k), v) for k, v in (pool_sizes or {}).items())
+        self.name_prefix = name_prefix
+        self.prepare_vm = prepare_vm
+        self.refill_threads = []
+        self.refill_threads_lock = threading.Lock()
+        self.state_lock = threading.Lock()
+        if not os.path.isdir(state_directory):
+            os.makedirs(state_directory)
+
+    @property
+    def state_file(self):
+        return os.path.join(self.state_directory, 'vm_pool_state.json')
+
+    @contextlib.contextmanager
+    def locked_state(self):
+        with self.state_lock:
+            with open(os.path.join(self.state_directory, 'vm_pool.lock'), 'a') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    if os.path.isfile(self.state_file):
+                        with open(self.state_file) as f:
+                            state = json.load(f)
+                    else:
+                        state = {'vms': []}
+                    yield state
+                    temporary_state_file = self.state_file + '.tmp'
+                    with open(temporary_state_file, 'w') as f:
+                        json.dump(state, f, indent=4, sort_keys=True)
+                    os.rename(temporary_state_file, self.state_file)
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def get_owner(self):
+        return {'pid': os.getpid(), 'hostname': socket.gethostname()}
+
+    def reap_abandoned_vms(self):
+        # a killed build or refill leaves its provisioning, leased, resetting and destroying entries behind; provisioning
+        # entries count as pool capacity, so their VMs are destroyed and forgotten to let the pool refill
+        hostname = socket.gethostname()
+        with self.locked_state() as state:
+            abandoned_vms = [vm for vm in state['vms'] if vm['state'] in ['provisioning', 'leased', 'resetting', 'destroying'] and
+                             vm.get('hostname') == hostname and vm.get('pid') is not None and not job_scheduler.process_is_alive(vm['pid'])]
+            for vm in abandoned_vms:
+                logging.getLogger(__name__).warning('reaping %s vm %s, its process %s is gone', vm['state'], vm['vm_name'], vm['pid'])
+                vm['state'] = 'destroying'
+                vm.update(self.get_owner())
+        for vm in abandoned_vms:
+            try:
+                self.provider.destroy(vm['vm_name'])
+            except Exception:
+                logging.getLogger(__name__).exception('could not destroy abandoned vm %s', vm['vm_name'])
+            finally:
+                self.forget(vm['vm_name'])
+        return len(abandoned_vms)
+
+    def generate_vm_name(self, platform_target):
+        return '{0} :: pool :: {1} :: {2}'.format(self.name_prefix, platform_key(platform_target), uuid.uuid4().hex[:8])
+
+    def status(self):
+        with self.locked_state() as state:
+            counts = {}
+            for vm in state['vms']:
+                platform_counts = counts.setdefault(platform_key(vm['platform_target']), {})
+                platform_counts[vm['state']] = platform_counts.get(vm['state'], 0) + 1
+            return counts
+
+    def create_vm(self, vm_name, platform_target):
+        ip_address = self.provider.deploy(vm_name, tuple(platform_target))
+        try:
+            if self.prepare_vm is not None:
+                self.prepare_vm(ip_address, tuple(platform_target))
+            self.provider.save_ready_state(vm_name)
+        except Exception:
+            self.provider.destroy(vm_name)
+            raise
+        return ip_address
+
+    def lease(self, platform_target, lease_name=None):
+        platform_target = tuple(platform_target)
+        with self.locked_state() as state:
+            for vm in state['vms']:
+                if vm['state'] == 'idle' and tuple(vm['platform_target']) == platform_target:
+                    vm['state'] = 'leased'
+                    vm['lease_name'] = lease_name
+                    vm['leased_at'] = time.time()
+                    vm.update(self.get_owner())
+                    lease = dict(vm)
+                    break
+            else:
+                lease = None
+
+        if lease is None:
+            # recorded before the clone starts so that a killed build's VM is reaped rather than leaked
+            vm_name = self.generate_vm_name(platform_target)
+            lease = {'vm_name': vm_name, 'ip_address': None, 'platform_target': list(platform_target),
+                     'state': 'leased', 'lease_name': lease_name, 'leased_at': time.time()}
+            lease.update(self.get_owner())
+            with self.locked_state() as state:
+                state['vms'].append(lease)
+            try:
+                lease['ip_address'] = self.create_vm(vm_name, platform_target)
+            except Exception:
+                self.forget(vm_name)
+                raise
+            with self.locked_state() as state:
+                for vm in state['vms']:
+                    if vm['vm_name'] == vm_name:
+                        vm['ip_address'] = lease['ip_address']
+                        break
+            logging.getLogger(__name__).info('vm pool miss for %s, deployed %s', platform_target, vm_name)
+        else:
+            logging.getLogger(__name__).info('vm pool hit for %s, leased %s', platform_target, lease['vm_name'])
+
+        self.refill_in_background()
+        return lease
+
+    def lease_many(self, platform_targets, lease_name=None):
+        if not platform_targets:
+            return []
+        self.reap_abandoned_vms()
+        thread_pool = job_scheduler.get_vm_operation_thread_pool(len(platform_targets))
+        try:
+            results = [thread_pool.apply_async(self.lease, (platform_target, lease_name)) for platform_target in platform_targets]
+            leases = []
+            errors = []
+            for result in results:
+                try:
+                    leases.append(result.get())
+                except Exception as e:
+                    errors.append(e)
+            if errors:
+                # the leases that did succeed are still good VMs, so they go back into the pool
+                self.release_many(leases, reusable=True)
+                raise errors[0]
+            return leases
+        finally:
+            thread_pool.close()
+            thread_pool.join()
+
+    def release(self, lease, reusable=False):
+        # capacity is checked before the reset, so only VMs that go back into the pool pay for a snapshot revert
+        with self.locked_state() as state:
+            platform_target = tuple(lease['platform_target'])
+            available = len([vm for vm in state['vms']
+                             if tuple(vm['platform_target']) == platform_target and vm['state'] in ['idle', 'provisioning', 'resetting']])
+            keep = reusable and available < self.pool_sizes.get(platform_target, 0)
+            for vm in state['vms']:
+                if vm['vm_name'] == lease['vm_name']:
+                    vm['state'] = 'resetting' if keep else 'destroying'
+                    vm.update(self.get_owner())
+                    break
+        reset = False
+        if keep:
+            try:
+                reset = self.provider.reset(lease['vm_name'], lease['ip_address'])
+            except Exception:
+                logging.getLogger(__name__).exception('could not reset vm %s', lease['vm_name'])
+            with self.locked_state() as state:
+                for vm in state['vms']:
+                    if vm['vm_name'] == lease['vm_name']:
+                        if reset:
+                            vm['state'] = 'idle'
+                            for key in ['lease_name', 'leased_at', 'pid', 'hostname']:
+                                vm.pop(key, None)
+                        else:
+                            vm['state'] = 'destroying'
+                        break
+        if not reset:
+            try:
+                self.provider.destroy(lease['vm_name'])
+            finally:
+                self.forget(lease['vm_name'])
+        self.refill_in_background()
+
+    def release_many(self, leases, reusable=False):
+        if not leases:
+            return
+        thread_pool = job_scheduler.get_vm_operation_thread_pool(len(leases))
+        try:
+            results = [thread_pool.apply_async(self.release, (lease, reusable)) for lease in leases]
+            for result in results:
+                result.get()
+        finally:
+            thread_pool.close()
+            thread_pool.join()
+
+    def forget(self, vm_name):
+        with self.locked_state() as state:
+            state['vms'] = [vm for vm in state['vms'] if vm['vm_name'] != vm_name]
+
+    def claim_refill_slots(self):
+        slots = []
+        with self.locked_state() as state:
+            for platform_target, pool_size in sorted(self.pool_sizes.items()):
+                available = len([vm for vm in state['vms']
+                                 if tuple(vm['platform_target']) == platform_target and vm['state'] in ['idle', 'provisioning', 'resetting']])
+                for _ in range(pool_size - available):
+                    vm = {'vm_name': self.generate_vm_name(platform_target), 'ip_address': None,
+                          'platform_target': list(platform_target), 'state': 'provisioning'}
+                    vm.update(self.get_owner())
+                    state['vms'].append(vm)
+                    slots.append(vm)
+        return slots
+
+    def fill_slot(self, slot):
+        try:
+            ip_address = self.create_vm(slot['vm_name'], slot['platform_target'])
+        except Exception:
+            logging.getLogger(__name__).exception('vm pool refill failed for %s', slot['vm_name'])
+            self.forget(slot['vm_name'])
+            return
+        with self.locked_state() as state:
+            for vm in state['vms']:
+                if vm['vm_name'] == slot['vm_name']:
+                    vm['ip_address'] = ip_address
+                    vm['state'] = 'idle'
+                    vm.pop('pid', None)
+                    vm.pop('hostname', None)
+                    break
+
+    def refill(self):
+        self.reap_abandoned_vms()
+        slots = self.claim_refill_slots()
+        if not slots:
+            return 0
+        thread_pool = job_scheduler.get_vm_operation_thread_pool(len(slots))
+        try:
+            thread_pool.map(self.fill_slot, slots)
+        finally:
+            thread_pool.close()
+            thread_pool.join()
+        return len(slots)
+
+    def refill_in_background(self):
+        if not self.pool_sizes:
+            return
+        # daemon threads so that a build exits without waiting for replacement clones; a refill cut short leaves
+        # provisioning entries that the next refill reaps
+        thread = threading.Thread(target=self.refill)
+        thread.daemon = True
+        thread.start()
+        with self.refill_threads_lock:
+            self.refill_threads = [t for t in self.refill_threads if t.is_alive()] + [thread]
+
+    def wait_for_refill(self):
+        with self.refill_threads_lock:
+            threads = list(self.refill_threads)
+        for thread in threads:
+            thread.join()
+
+    def drain(self):
+        self.wait_for_refill()
+        with self.locked_state() as state:
+            idle_vms = [vm for vm in state['vms'] if vm['state'] == 'idle']
+            for vm in idle_vms:
+                vm['state'] = 'destroying'
+                vm.update(self.get_owner())
+        for vm in idle_vms:
+            try:
+                self.provider.destroy(vm['vm_name'])
+            finally:
+                self.forget(vm['vm_name'])
+        return len(idle_vms)
+
+@contextlib.contextmanager
+def lease_manager(pool, leases, reusable=False):
+    try:
+        yield leases
+    finally:
+        pool.release_many(leases, reusable)
+
+def install_build_dependencies(irods_packages_root_directory, ip_address, platform_target):
+    import library
+    complex_args = {
+        'irods_packages_root_directory': irods_packages_root_directory,
+        'prepare_only': True,
+    }
+    library.run_ansible(module_name='irods_build_plugin', complex_args=complex_args, host_list=[ip_address])
+
+def get_configured_pool(state_directory, name_prefix='vm_pool'):
+    import configuration
+    import zone_snapshot
+    pool_sizes = getattr(configuration, 'vm_pool_sizes', {})
+    prepare_vm = None
+    irods_packages_root_directory = getattr(configuration, 'vm_pool_irods_packages_root_directory', None)
+    if irods_packages_root_directory:
+        prepare_vm = functools.partial(install_build_dependencies, irods_packages_root_directory)
+    snapshot_provider = None
+    snapshot_provider_name = getattr(configuration, 'vm_pool_snapshot_provider', None)
+    if snapshot_provider_name:
+        snapshot_provider = zone_snapshot.get_snapshot_provider(snapshot_provider_name)
+    return VMPool(state_directory, VSphereVMProvider(snapshot_provider), pool_sizes, name_prefix, prepare_vm)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Manage the warm pool of pre-provisioned VMs')
+    parser.add_argument('--state_directory', type=str, required=True)
+    parser.add_argument('--action', type=str, choices=['status', 'refill', 'maintain', 'drain'], default='status')
+    parser.add_argument('--maintain_interval', type=float, default=60)
+    args = parser.parse_args()
+
+    import library
+    library.register_log_handlers()
+    library.convert_sigterm_to_exception()
+
+    pool = get_configured_pool(args.state_directory)
+    if args.action == 'status':
+        print(json.dumps(pool.status(), indent=4, sort_keys=True))
+    elif args.action == 'refill':
+        pool.refill()
+    elif args.action == 'maintain':
+        while True:
+            pool.refill()
+            time.sleep(args.maintain_interval)
+    elif args.action == 'drain':
+        pool.drain()
@@ -0,0 +1,105 @@
+import contextlib
+import copy
+import logging
+import subprocess
+import threading
+
+import job_scheduler
+
+
+def get_zone_server_vm_names(deployed_zone_bundle):
+    vm_names = []
+    for zone in deployed_zone_bundle['zones']:
+        servers = [zone['icat_server']] + zone.get('resource_servers', [])
+        for server in servers:
+            deployment_information = server['deployment_information']
+            if 'vm_name' not in deployment_information:
+                raise KeyError('deployed zone server has no vm_name in its deployment_information: {0}'.format(deployment_information))
+            vm_names.append(deployment_information['vm_name'])
+    return vm_names
+
+class GovcSnapshotProvider(object):
+    # govc reads the vSphere endpoint and credentials from the GOVC_* environment variables
+    def run_govc(self, args):
+        subprocess.check_call(['govc'] + args)
+
+    def create(self, vm_name, snapshot_name):
+        self.run_govc(['snapshot.create', '-vm', vm_name, '-m=true', snapshot_name])
+
+    def revert(self, vm_name, snapshot_name):
+        self.run_govc(['snapshot.revert', '-vm', vm_name, snapshot_name])
+
+    def remove(self, vm_name, snapshot_name):
+        self.run_govc(['snapshot.remove', '-vm', vm_name, snapshot_name])
+
+class FakeSnapshotProvider(object):
+    # snapshots the state a fake backend keeps for each VM (anything with get_vm_state and set_vm_state)
+    def __init__(self, backend):
+        self.backend = backend
+        self.lock = threading.Lock()
+        self.snapshots = {}
+        self.calls = []
+
+    def create(self, vm_name, snapshot_name):
+        state = copy.deepcopy(self.backend.get_vm_state(vm_name))
+        with self.lock:
+            self.calls.append(('create', vm_name, snapshot_name))
+            self.snapshots[(vm_name, snapshot_name)] = state
+
+    def revert(self, vm_name, snapshot_name):
+        with self.lock:
+            self.calls.append(('revert', vm_name, snapshot_name))
+            state = copy.deepcopy(self.snapshots[(vm_name, snapshot_name)])
+        self.backend.set_vm_state(vm_name, state)
+
+    def remove(self, vm_name, snapshot_name):
+        with self.lock:
+            self.calls.append(('remove', vm_name, snapshot_name))
+            del self.snapshots[(vm_name, snapshot_name)]
+
+class ZoneSnapshotManager(object):
+    def __init__(self, provider, deployed_zone_bundle):
+        self.provider = provider
+        self.vm_names = get_zone_server_vm_names(deployed_zone_bundle)
+        self.snapshot_names = []
+
+    def for_each_vm(self, function, snapshot_name):
+        thread_pool = job_scheduler.get_vm_operation_thread_pool(len(self.vm_names))
+        try:
+            results = [thread_pool.apply_async(function, (vm_name, snapshot_name)) for vm_name in self.vm_names]
+            for result in results:
+                result.get()
+        finally:
+            thread_pool.close()
+            thread_pool.join()
+
+    def snapshot(self, snapshot_name):
+        self.for_each_vm(self.provider.create, snapshot_name)
+        self.snapshot_names.append(snapshot_name)
+
+    def revert(self, snapshot_name):
+        self.for_each_vm(self.provider.revert, snapshot_name)
+
+    def remove_all(self):
+        for snapshot_name in reversed(self.snapshot_names):
+            try:
+                self.for_each_vm(self.provider.remove, snapshot_name)
+            except Exception:
+                logging.getLogger(__name__).exception('could not remove zone snapshot %s', snapshot_name)
+        self.snapshot_names = []
+
+@contextlib.contextmanager
+def zone_snapshot_manager(provider, deployed_zone_bundle):
+    manager = ZoneSnapshotManager(provider, deployed_zone_bundle)
+    try:
+        yield manager
+    finally:
+        manager.remove_all()
+
+def get_snapshot_provider(name):
+    if name == 'govc':
+        return GovcSnapshotProvider()
+    if name == 'fake':
+        import fake_library
+        return FakeSnapshotProvider(fake_library)
+    raise ValueError('unknown zone snapshot provider: {0}'.format(name))